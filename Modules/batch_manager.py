@@ -0,0 +1,327 @@
+###############################################################################
+# File:  batch_manager.py
+#
+# Description:
+# GDOP processing of a whole campaign: a folder (or a manifest listing) of
+# position files, with one Calc_manager per file. The files are grouped by
+# the date of their first UTC time. Each day's navigation file is fetched
+# and parsed once (Orbital_data), and the satellite positions are computed
+# once for all sampled epochs of the day's flights (Day_sats). The
+# flights then run concurrently on these shared, read-only caches. Ten
+# flights of the same day cost about one navigation file and one satellite
+# position computation instead of ten.
+#
+#   batch = Batch_manager.from_folder(folder, ts=5)
+#   batch.set_FOV(FOV_view_match())
+#   batch.add_calc(Calc_gdop())
+#   report = batch.process()      # also written to batch_summary.csv
+#
+# FOV models and Calcs are copied for each flight, so Calcs keeping state
+# between rows are never shared between threads.
+#                                                                             #
+###############################################################################
+
+# %%
+import os
+import copy
+import glob
+import time
+import threading
+import datetime as dt
+import numpy as np
+from csv import writer
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import Modules.common as c
+import Modules.reader_rinex as rr
+from Modules.calc_manager import Calc_manager
+from Modules.fov_models import FOV_model
+from Modules.calcs import Calc
+from Modules.sat_block import Sat_block, to_datetime64
+from Modules.d_print import Debug, Info
+
+SUMMARY_FILE = 'batch_summary.csv'
+SUMMARY_COLUMNS = ['file', 'day', 'status', 'rows', 'output', 'read_s', 'process_s', 'message']
+
+
+class Day_sats:
+  """
+    Orbital data of one day and the satellite positions of all epochs
+    requested by the day's flights. Used in place of Orbital_data by
+    Calc_manager (same setup/get_sats_pos methods).
+  """
+  def __init__(self, day: dt.date, orbital_data=None):
+    self.day = day
+    self.orbital = orbital_data if orbital_data is not None else rr.Orbital_data()
+    self.block = None                 # Sat_block of all epochs of the day
+    self.done_setup = False
+    self.misses = 0                   # requests outside the block
+    self.seconds = {'nav': 0.0, 'satellites': 0.0}
+    self.__times = []
+    self.__lock = threading.Lock()
+
+  def add_times(self, times) -> None:
+    """
+      Epochs (ISO strings, datetimes) a flight will request
+    """
+    with self.__lock:
+      self.__times.append(to_datetime64(times))
+
+  def setup(self, utc: str = '') -> None:
+    """
+      Fetch and parse the navigation file of the day, once
+    """
+    with self.__lock:
+      if self.done_setup:
+        return
+      now = time.perf_counter()
+      self.orbital.setup(str(self.day) + ' 00:00:00')
+      self.done_setup = True
+      self.seconds['nav'] = time.perf_counter() - now
+
+  def compute(self) -> Sat_block:
+    """
+      Satellite positions of all added epochs (each distinct epoch once)
+    """
+    self.setup()
+    with self.__lock:
+      now = time.perf_counter()
+      times = np.unique(np.concatenate(self.__times)) if len(self.__times) > 0 \
+              else np.array([], dtype='datetime64[us]')
+      self.block = self.orbital.get_sats_pos(list(times.astype(dt.datetime)))
+      self.seconds['satellites'] = time.perf_counter() - now
+      Debug(f'{self.day}: {len(times)} epochs for {len(self.__times)} flights '
+            f'({sum(len(t) for t in self.__times)} requested)')
+    return self.block
+
+  def get_sats_pos(self, time_list) -> Sat_block:
+    """
+      Satellite positions at the given times, views of the day's block.
+      Times the block does not have are computed directly.
+    """
+    if self.block is None:
+      self.compute()
+    index = self.block.index_of(time_list)
+    if np.any(index < 0):
+      with self.__lock:
+        self.misses += 1
+        return self.orbital.get_sats_pos(time_list)
+    return self.block.take(index)
+
+
+class Batch_manager:
+  def __init__(self, files: List[str],
+               out_folder: str = '',
+               ts = 5,
+               max_workers: int = 0,
+               summary_file: str = ''):
+    # INPUTS:
+    #   files         position files (csv, as for Calc_manager)
+    #   out_folder    folder of the _gdop.csv files (default: next to the inputs)
+    #   ts            sampling period (sec)
+    #   max_workers   flights processed at the same time (default: CPU count)
+    #   summary_file  summary csv (default: out_folder/batch_summary.csv)
+    self.files = [os.path.abspath(f) for f in files]
+    self.out_folder = out_folder
+    self.ts = ts
+    self.max_workers = max_workers if max_workers > 0 else (os.cpu_count() or 1)
+    if summary_file == '':
+      folder = out_folder if out_folder != '' else \
+               (os.path.dirname(self.files[0]) if len(self.files) > 0 else '.')
+      summary_file = os.path.join(folder, SUMMARY_FILE)
+    self.summary_file = summary_file
+
+    self.fov_obj = FOV_model()
+    self.calcs_q: List[Calc] = []
+    self.orbital_factory = rr.Orbital_data   # one Orbital_data per day
+    self.days = {}                           # date -> Day_sats
+
+  @classmethod
+  def from_folder(cls, folder: str, pattern: str = '*.csv', **kwargs) -> 'Batch_manager':
+    """
+      All position files of a folder (outputs of earlier runs excluded)
+    """
+    files = sorted(f for f in glob.glob(os.path.join(folder, pattern))
+                   if not f.endswith('_gdop.csv') and os.path.basename(f) != SUMMARY_FILE)
+    return cls(files, **kwargs)
+
+  @classmethod
+  def from_manifest(cls, manifest: str, **kwargs) -> 'Batch_manager':
+    """
+      Position files listed in a text file, one per line ('#' comments,
+      paths relative to the manifest)
+    """
+    folder = os.path.dirname(os.path.abspath(manifest))
+    files = []
+    with open(manifest, 'r') as fh:
+      for line in fh:
+        line = line.split('#')[0].strip()
+        if line != '':
+          files.append(line if os.path.isabs(line) else os.path.join(folder, line))
+    return cls(files, **kwargs)
+
+  def set_FOV(self, model: FOV_model) -> None:
+    """
+      FOV model of all flights (copied for each one)
+    """
+    self.fov_obj = model
+
+  def add_calc(self, calc: Calc) -> None:
+    """
+      Calc of all flights (copied for each one)
+    """
+    if calc not in self.calcs_q:
+      self.calcs_q.append(calc)
+
+  def output_file(self, in_file: str) -> str:
+    if self.out_folder == '':
+      return in_file[:-4] + '_gdop.csv'
+    return os.path.join(self.out_folder, os.path.basename(in_file)[:-4] + '_gdop.csv')
+
+  def process(self) -> dict:
+    """
+      Process all files, write the summary csv and return the report:
+      per flight rows and per day navigation/satellite times
+    """
+    tot = time.perf_counter()
+    if self.out_folder != '' and not os.path.exists(self.out_folder):
+      os.makedirs(self.out_folder)
+    flights = [{'file': f, 'day': '', 'status': 'ok', 'rows': 0, 'output': self.output_file(f),
+                'read_s': 0.0, 'process_s': 0.0, 'message': ''} for f in self.files]
+    managers = [None]*len(flights)
+
+    # Read and sample all position files
+    def read(k):
+      now = time.perf_counter()
+      m = Calc_manager(flights[k]['file'], out_file=flights[k]['output'], data_folder='',
+                       out_folder='', ts=self.ts)
+      m.set_FOV(copy.deepcopy(self.fov_obj))
+      for calc in self.calcs_q:
+        m.add_calc(copy.deepcopy(calc))
+      times = m.sample_times()
+      flights[k]['day'] = dt.datetime.fromisoformat(times[0]).date() if len(times) > 0 else ''
+      flights[k]['rows'] = len(times)
+      flights[k]['read_s'] = time.perf_counter() - now
+      managers[k] = m
+      return times
+
+    with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+      sampled = list(pool.map(lambda k: self.__guard(flights[k], read, k), range(len(flights))))
+
+    # One Day_sats per day with the epochs of all its flights
+    self.days = {}
+    for f, times in zip(flights, sampled):
+      if f['status'] != 'ok' or f['rows'] == 0:
+        continue
+      if f['day'] not in self.days:
+        self.days[f['day']] = Day_sats(f['day'], self.orbital_factory())
+      self.days[f['day']].add_times(times)
+
+    # Days load in their own threads, the flights of a day start when it is ready
+    def run(k):
+      ready[flights[k]["day"]].result()
+      now = time.perf_counter()
+      managers[k].set_orbital_data(self.days[flights[k]['day']])
+      managers[k].process_data()
+      flights[k]['process_s'] = time.perf_counter() - now
+
+    with ThreadPoolExecutor(max_workers=min(len(self.days), self.max_workers) or 1) as day_pool, \
+         ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+      ready = {d: day_pool.submit(sats.compute) for d, sats in self.days.items()}
+      todo = [k for k, f in enumerate(flights) if f['status'] == 'ok' and f['rows'] > 0]
+      list(pool.map(lambda k: self.__guard(flights[k], run, k), todo))
+
+    for f in flights:
+      if f['status'] == 'ok' and f['rows'] == 0:
+        f['status'], f['message'] = 'empty', 'no position rows'
+    wall = time.perf_counter() - tot
+    report = {'flights': flights, 'wall': wall,
+              'days': {str(d): {'flights': sum(f['day'] == d for f in flights),
+                                'epochs': len(s.block) if s.block is not None else 0,
+                                'nav_s': s.seconds['nav'], 'satellites_s': s.seconds['satellites'],
+                                'misses': s.misses}
+                       for d, s in self.days.items()}}
+    self.__write_summary(report)
+    n_ok = sum(f['status'] == 'ok' for f in flights)
+    Info(f'Batch: {n_ok}/{len(flights)} flights over {len(self.days)} days in {wall:.3f}s, '
+         f'summary in {self.summary_file}')
+    return report
+
+  def __guard(self, flight: dict, fn, *args):
+    # A failing flight is reported in the summary, the others go on
+    try:
+      return fn(*args)
+    except Exception as ex:
+      flight['status'] = 'failed'
+      flight['message'] = f'{type(ex).__name__}: {ex}'
+      Info(f'{flight["file"]}: {flight["message"]}')
+      return None
+
+  def __write_summary(self, report: dict) -> None:
+    with open(self.summary_file, 'w', newline='') as csvfile:
+      wr = writer(csvfile)
+      wr.writerow(SUMMARY_COLUMNS)
+      for f in report['flights']:
+        wr.writerow([f[k] if not isinstance(f[k], float) else f'{f[k]:.3f}' for k in SUMMARY_COLUMNS])
+      wr.writerow([])
+      wr.writerow(['day', 'flights', 'epochs', 'nav_s', 'satellites_s', 'misses'])
+      for d, s in report['days'].items():
+        wr.writerow([d, s['flights'], s['epochs'], f'{s["nav_s"]:.3f}', f'{s["satellites_s"]:.3f}', s['misses']])
+
+
+def test():
+  import tempfile
+  from Modules.fov_models import FOV_view_match
+  from Modules.calcs import Calc_gdop
+
+  # Ten flights on one day and two on the next, with a fake Orbital_data that
+  # takes 0.5 s to load a navigation file
+  folder = tempfile.mkdtemp()
+  for k in range(12):
+    day = 3 if k < 10 else 4
+    with open(os.path.join(folder, f'flight_{k:02d}.csv'), 'w', newline='') as fh:
+      wr = writer(fh)
+      wr.writerow([c.CHN_TMS, c.CHN_UTC, c.CHN_LAT, c.CHN_LON, c.CHN_ALT, c.CHN_SAT])
+      for i in range(600):
+        s = 8*3600 + k*300 + i
+        wr.writerow([i, f'2021-12-{day:02d} {s//3600:02d}:{(s//60)%60:02d}:{s%60:02d}',
+                     60.0 + i*1e-5, 5.0 + k*0.01, 300, 8])
+
+  loads = []
+  class Fake_orbital:
+    def setup(self, utc):
+      time.sleep(0.5)
+      loads.append(utc)
+    def get_sats_pos(self, times):
+      t = to_datetime64(times).astype(float)
+      a = 2*np.pi*(t[:, None]/43082e6 + np.arange(24)[None, :]/24)
+      inc = np.radians(55) + 0.1*np.arange(24)[None, :]
+      pos = 26560e3*np.stack([np.cos(a), np.sin(a)*np.cos(inc), np.sin(a)*np.sin(inc)], axis=-1)
+      return Sat_block(times, [f'G{j + 1:02d}' for j in range(24)], pos)
+
+  batch = Batch_manager.from_folder(folder, out_folder=os.path.join(folder, 'out'), ts=5)
+  batch.orbital_factory = Fake_orbital
+  batch.set_FOV(FOV_view_match())
+  batch.add_calc(Calc_gdop())
+  report = batch.process()
+  assert len(loads) == 2 and all(f['status'] == 'ok' for f in report['flights'])
+  assert all(d['misses'] == 0 for d in report['days'].values())
+  print(f'12 flights, 2 days: {report["wall"]:.2f}s, '
+        + ', '.join(f'{d}: {s["flights"]} flights {s["epochs"]} epochs' for d, s in report['days'].items()))
+
+  # Same output as a flight processed alone
+  alone = Calc_manager(os.path.join(folder, 'flight_04.csv'), out_file=os.path.join(folder, 'alone.csv'),
+                       data_folder='', out_folder='', ts=5)
+  alone.set_orbital_data(Fake_orbital())
+  alone.set_FOV(FOV_view_match())
+  alone.add_calc(Calc_gdop())
+  alone.process_data()
+  with open(os.path.join(folder, 'alone.csv')) as a, open(report['flights'][4]['output']) as b:
+    assert a.read() == b.read()
+  with open(batch.summary_file) as fh:
+    print(fh.read())
+
+
+if __name__ == '__main__':
+  test()
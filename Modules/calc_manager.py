@@ -16,15 +16,18 @@
 
 # %%
 from typing import Dict, Mapping, List
-from xarray import DataArray
 from csv import writer
 import datetime as dt
 import time,sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import Modules.common as c
 import Modules.reader_rinex as rr
 import Modules.reader_pos_data as rpc
 from Modules.fov_models import FOV_model, FOV_view_match
-from Modules.calcs import Calc, Calc_gdop
+from Modules.calcs import Calc, Calc_gdop, Calc_graph
+from Modules.sat_block import Sat_block
 from Modules.d_print import Debug, Info
 
 
@@ -55,7 +58,10 @@ class Calc_manager:
     self.sat_obj = rr.Orbital_data()
     self.fov_obj = FOV_model()      # real obj created in setup_FOV()
     self.calcs_q: List[Calc] = []   # A queue for calculations
+    self.graph = None               # Calc_graph of calcs_q, built in setup
+    self.cache = {}                 # Intermediates shared by FOV_model and Calcs
     self.req_vars = set()           # The variables required by FOV_model and Calc
+    self.sampled = None             # Sampled positions, read once
 
     # Processed data
     self.output_map: Dict[str, list] = {}
@@ -69,6 +75,26 @@ class Calc_manager:
     self.fov_obj = model
 
 
+  def set_orbital_data(self, sat_obj) -> None:
+    """
+      Use another source of satellite positions (set up once and shared by
+      several managers, see batch_manager.Day_sats) in place of this
+      manager's own Orbital_data
+    """
+    self.sat_obj = sat_obj
+
+
+  def sample_times(self) -> List[str]:
+    """
+      Read and sample the position file, return the UTC time of the sampled
+      rows. The samples are kept for process_data/process_pipelined.
+    """
+    self.__check()
+    if not self.pos_obj.done_setup:
+      self.pos_obj.setup()
+    return self.__sample_pos()[c.CHN_UTC]
+
+
   def add_calc(self, calc: Calc) -> None:
     """
       Add a Calc object to the queue to perform calculations on the data
@@ -79,9 +105,9 @@ class Calc_manager:
       self.calcs_q.append(calc)
 
 
-  def __setup(self) -> None:
+  def __check(self) -> None:
     """
-      Perform checks and do setups before starting to process data
+      Check the FOV model and Calcs and collect the required variables
     """
     if self.fov_obj == FOV_model():
       raise Exception("FOV_model is the base class, it cannot be used.\
@@ -95,13 +121,22 @@ class Calc_manager:
       if i == Calc():
         raise Exception("Calc cannot be used as a calculation.\
                         Select an inherited class.")
-      else:
-        self.req_vars.union(set(i.required_vars()))
 
+    # Calcs and their intermediates in dependency order
+    self.graph = Calc_graph(self.calcs_q)
+    self.req_vars = self.req_vars.union(self.graph.required_vars())
     self.req_vars = self.req_vars.union(set(self.fov_obj.required_vars()))
 
+
+  def __setup(self) -> None:
+    """
+      Perform checks and do setups before starting to process data
+    """
+    self.__check()
+
     # Have readers check for existance of their files and folders
-    self.pos_obj.setup()
+    if not self.pos_obj.done_setup:
+      self.pos_obj.setup()
     self.sat_obj.setup(self.pos_obj.get_first_utc())
 
 
@@ -109,6 +144,9 @@ class Calc_manager:
     """
       Get the position data from file and return a sampled version
     """
+    if self.sampled is not None:
+      return self.sampled
+
     # Get pos data
     all_pos = self.pos_obj.get_merged_cols(list(self.req_vars))
     all_pos_row_count = self.pos_obj.row_count
@@ -134,21 +172,24 @@ class Calc_manager:
         
         last_saved = last_saved + dif
 
+    self.sampled = sampled
     return sampled  
 
 
-  def __acquire_sats(self, pos_timestamps) -> Dict[str, DataArray]:
+  def __acquire_sats(self, pos_timestamps) -> Sat_block:
     """
-      Return all satellites for all pos in time
+      Return all satellites for all pos in time (epochs x satellites)
     """
     return self.sat_obj.get_sats_pos(pos_timestamps)
     
 
-  def __sats_in_fov(self, pos_pos, sats_pos):
+  def __sats_in_fov(self, pos_pos, sats_pos) -> Sat_block:
     """
       Return all satellites in view from pos_pos, given sats_pos and FOV_model
+      (one epoch per row of pos_pos, positions shared with sats_pos)
     """
-    return self.fov_obj.get_sats(pos_pos, sats_pos)
+    self.cache = {}
+    return self.fov_obj.get_sats(pos_pos, sats_pos, self.cache)
     
 
   def __do_calcs(self, pos_pos, sats_LOS_pos): # Positions in ECEF
@@ -161,8 +202,9 @@ class Calc_manager:
     if len(self.calcs_q) == 0:
       raise Exception("No calculations were queued")
 
-    for calc in self.calcs_q:
-      self.__add_dict_to_output_map(calc.do_calc(pos_pos, sats_LOS_pos))
+    # Each intermediate is computed once, the ones of the FOV model are reused
+    results, self.cache = self.graph.run(pos_pos, sats_LOS_pos, self.cache)
+    self.__add_dict_to_output_map(results)
   
 
   def __add_dict_to_output_map(self, data: dict):
@@ -248,8 +290,154 @@ class Calc_manager:
 
 
 
+  def process_pipelined(self, chunk_rows: int = 500) -> dict:
+    """
+      process_data with overlapped stages:\n
+      - the navigation file is fetched and parsed in a background thread as
+        soon as the first time of the position file is known, while the
+        position file is read and sampled\n
+      - the sampled rows are processed in chunks: the satellite positions
+        of chunk N+1 are computed while chunk N goes through the FOV model
+        and the Calcs\n
+      - the rows are written to the csv by a writer thread\n
+      Returns the busy time of each stage, the wall time and the overlap
+      (sum of the busy times minus the wall time).
+    """
+    tot = time.perf_counter()
+    busy = {'nav': 0.0, 'positions': 0.0, 'satellites': 0.0, 'calcs': 0.0, 'write': 0.0}
+
+    def timed(stage, fn, *args):
+      # Each stage runs on a single thread, so its counter has one writer
+      now = time.perf_counter()
+      try:
+        return fn(*args)
+      finally:
+        busy[stage] += time.perf_counter() - now
+
+    self.__check()
+    rows = queue.Queue(maxsize=2)
+    written = []
+    writer_error = []
+
+    def write_rows():
+      try:
+        with open(self.out_dir + self.output_file, 'w') as csvfile:
+          wr = writer(csvfile)
+          while True:
+            item = rows.get()
+            if item is None:
+              return
+            now = time.perf_counter()
+            keys, chunk, results = item
+            if len(written) == 0:
+              wr.writerow(keys)
+            cols = [chunk[k] if k in chunk else results[k] for k in keys]
+            wr.writerows(zip(*cols))
+            written.append(len(cols[0]))
+            busy['write'] += time.perf_counter() - now
+      except Exception as ex:
+        writer_error.append(ex)
+        while rows.get() is not None:
+          pass
+
+    out_thread = threading.Thread(target=write_rows, daemon=True)
+    out_thread.start()
+    try:
+      with ThreadPoolExecutor(max_workers=2) as pool:
+        # Navigation data as soon as the first timestamp is known
+        nav = pool.submit(timed, 'nav', self.sat_obj.setup, self.pos_obj.peek_first_utc())
+
+        def read_positions():
+          if not self.pos_obj.done_setup:
+            self.pos_obj.setup()
+          return self.__sample_pos()
+        pos = timed('positions', read_positions)
+
+        n = len(pos[c.CHN_UTC])
+        bounds = [(a, min(a + chunk_rows, n)) for a in range(0, n, chunk_rows)]
+        chunks = [{k: v[a:b] for k, v in pos.items()} for a, b in bounds]
+
+        def acquire(k):
+          nav.result()
+          return timed('satellites', self.__acquire_sats, chunks[k][c.CHN_UTC])
+
+        # Double buffer: satellites of chunk k+1 while chunk k is processed
+        pending = pool.submit(acquire, 0) if len(chunks) > 0 else None
+        for k, chunk in enumerate(chunks):
+          sats = pending.result()
+          if k + 1 < len(chunks):
+            pending = pool.submit(acquire, k + 1)
+
+          now = time.perf_counter()
+          los = self.__sats_in_fov(chunk, sats)
+          results, _ = self.graph.run(chunk, los, self.cache)
+          busy['calcs'] += time.perf_counter() - now
+
+          keys = [key for key in chunk if key in self.req_vars] + list(results.keys())
+          rows.put((keys, chunk, results))
+          if len(writer_error) > 0:
+            break
+    finally:
+      rows.put(None)
+      out_thread.join()
+    if len(writer_error) > 0:
+      raise writer_error[0]
+
+    wall = time.perf_counter() - tot
+    report = {'busy': busy, 'wall': wall, 'overlap': sum(busy.values()) - wall,
+              'chunks': len(chunks), 'rows': sum(written)}
+    for stage, t in busy.items():
+      Debug(f'{stage:10}: {t:.3f}s busy')
+    Info(f'{report["rows"]} rows in {report["chunks"]} chunks: {wall:.3f}s wall, '
+         f'{sum(busy.values()):.3f}s of stages, {report["overlap"]:.3f}s overlapped')
+    return report
+
+
 
 def test():
+  import tempfile
+  import shutil
+  import numpy as np
+  from Modules.sat_block import to_datetime64
+
+  # process_pipelined against process_data on a synthetic flight, with a
+  # fake Orbital_data that takes 0.5 s to fetch its navigation file
+  folder = tempfile.mkdtemp() + '/'
+  try:
+    with open(folder + 'flight.csv', 'w', newline='') as fh:
+      wr = writer(fh)
+      wr.writerow([c.CHN_TMS, c.CHN_UTC, c.CHN_LAT, c.CHN_LON, c.CHN_ALT, c.CHN_SAT])
+      for i in range(3000):
+        s = 8*3600 + i
+        wr.writerow([i, f'2021-12-03 {s//3600:02d}:{(s//60)%60:02d}:{s%60:02d}', 60.0 + i*1e-5, 5.0, 300, 8])
+
+    class Fake_orbital:
+      def setup(self, utc):
+        time.sleep(0.5)
+      def get_sats_pos(self, times):
+        t = to_datetime64(times).astype(float)
+        a = 2*np.pi*(t[:, None]/43082e6 + np.arange(24)[None, :]/24)
+        inc = np.radians(55) + 0.1*np.arange(24)[None, :]
+        pos = 26560e3*np.stack([np.cos(a), np.sin(a)*np.cos(inc), np.sin(a)*np.sin(inc)], axis=-1)
+        return Sat_block(times, [f'G{j + 1:02d}' for j in range(24)], pos)
+
+    out = {}
+    for name in ('serial', 'pipelined'):
+      manager = Calc_manager('flight.csv', out_file=name + '.csv', data_folder=folder, out_folder=folder, ts=2)
+      manager.set_orbital_data(Fake_orbital())
+      manager.set_FOV(FOV_view_match())
+      manager.add_calc(Calc_gdop())
+      now = time.perf_counter()
+      report = manager.process_data() if name == 'serial' else manager.process_pipelined(chunk_rows=200)
+      print(f'{name}: {time.perf_counter() - now:.3f}s')
+      with open(folder + name + '.csv') as fh:
+        out[name] = fh.read()
+    assert out['serial'] == out['pipelined'] and len(out['serial'].splitlines()) == 1501
+    assert report['chunks'] == 8 and report['rows'] == 1500
+    print(f'Overlap: {report["overlap"]:.3f}s of {report["wall"]:.3f}s')
+  finally:
+    shutil.rmtree(folder)
+
   drone_data = '/Pos_UTC.csv'
 
   gdoper = Calc_manager(drone_data, ts=10)
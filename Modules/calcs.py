@@ -4,6 +4,8 @@ from typing import Tuple, List
 import numpy as np
 from numpy.core.fromnumeric import trace
 import Modules.common as c
+from Modules.dop_planning import enu_axes
+from Modules.sat_block import Sat_block
 
 class Calc:
   def __init__(self):
@@ -16,12 +18,202 @@ class Calc:
   def required_vars(self) -> List[str]:
     pass
 
-  def do_calc(self, sampled_pos, sats_FOV) -> Tuple[str, list]:
-    # Expected sats_FOV heirarchy is:  time{} -> prn{} -> (x,y,z)
+  def consumes(self) -> List[str]:
+    """
+      Intermediates (INTERMEDIATES keys) read from the cache by do_calc
+    """
+    return []
+
+  def produces(self) -> List[str]:
+    """
+      Intermediates written to the cache by do_calc
+    """
+    return []
+
+  def do_calc(self, sampled_pos, sats_FOV, cache: dict = None) -> Tuple[str, list]:
+    # Expected sats_FOV is a Sat_block with one epoch per sampled row, or
+    # the heirarchy:  time{} -> prn{} -> (x,y,z)
     # Expected sampled_pos order is :  chn{} -> data[]
+    # cache holds the consumed intermediates: name{} -> value
     pass
 
 
+###############################################################################
+# Intermediates: Calcs without output channels that compute a value shared
+# by other Calcs once per run and store it in the cache. Per row values are
+# lists in the order of the sampled positions.
+###############################################################################
+
+class Inter_rx_ecef(Calc):
+  def get_chn(self) -> List[str]:
+    return []
+
+  def required_vars(self) -> List[str]:
+    return [c.CHN_LAT, c.CHN_LON, c.CHN_ALT]
+
+  def produces(self) -> List[str]:
+    return ['rx_ecef']
+
+  def do_calc(self, pos_pos, sats_FOV, cache: dict = None) -> dict:
+    # Receiver ECEF positions (n, 3), one transformation for all rows
+    lat = np.asarray(pos_pos[c.CHN_LAT], dtype=float)
+    lon = np.asarray(pos_pos[c.CHN_LON], dtype=float)
+    alt = np.asarray(pos_pos[c.CHN_ALT], dtype=float)
+    cache['rx_ecef'] = np.stack(c.lla2ecef(lat, lon, alt), axis=-1).reshape(-1, 3)
+    return {}
+
+
+class Inter_los(Calc):
+  def get_chn(self) -> List[str]:
+    return []
+
+  def required_vars(self) -> List[str]:
+    return [c.CHN_UTC]
+
+  def consumes(self) -> List[str]:
+    return ['rx_ecef']
+
+  def produces(self) -> List[str]:
+    return ['los']
+
+  def do_calc(self, pos_pos, sats_FOV, cache: dict = None) -> dict:
+    # Per row: (prns, unit vectors receiver -> satellite (k, 3))
+    los = []
+    for i, t in enumerate(pos_pos[c.CHN_UTC]):
+      if isinstance(sats_FOV, Sat_block):
+        prns, p = sats_FOV.row(i)     # epochs of the block are the rows
+      else:
+        prns = list(sats_FOV[t].keys())
+        p = np.array([sats_FOV[t][j] for j in prns], dtype=float).reshape(-1, 3)
+      d = p - cache['rx_ecef'][i]
+      los.append((list(prns), d/np.linalg.norm(d, axis=1, keepdims=True)))
+    cache['los'] = los
+    return {}
+
+
+class Inter_elev_az(Calc):
+  def get_chn(self) -> List[str]:
+    return []
+
+  def required_vars(self) -> List[str]:
+    return [c.CHN_LAT, c.CHN_LON]
+
+  def consumes(self) -> List[str]:
+    return ['los']
+
+  def produces(self) -> List[str]:
+    return ['elev_az']
+
+  def do_calc(self, pos_pos, sats_FOV, cache: dict = None) -> dict:
+    # Per row: (elevation (k,), azimuth (k,)) in degrees
+    axes = enu_axes(np.asarray(pos_pos[c.CHN_LAT], dtype=float),
+                    np.asarray(pos_pos[c.CHN_LON], dtype=float))
+    elev_az = []
+    for (prns, e), R in zip(cache['los'], axes):
+      enu = e@R.T
+      elev_az.append((np.degrees(np.arcsin(np.clip(enu[:, 2], -1, 1))),
+                      np.degrees(np.arctan2(enu[:, 0], enu[:, 1])) % 360))
+    cache['elev_az'] = elev_az
+    return {}
+
+
+class Inter_geometry(Calc):
+  def get_chn(self) -> List[str]:
+    return []
+
+  def required_vars(self) -> List[str]:
+    return []
+
+  def consumes(self) -> List[str]:
+    return ['los']
+
+  def produces(self) -> List[str]:
+    return ['geometry']
+
+  def do_calc(self, pos_pos, sats_FOV, cache: dict = None) -> dict:
+    # Per row: geometry matrix G (k, 4), rows [-los, 1] in ECEF
+    cache['geometry'] = [np.hstack([-e, np.ones((len(e), 1))]) for _, e in cache['los']]
+    return {}
+
+
+# Intermediate name -> Calc computing it
+INTERMEDIATES = {'rx_ecef': Inter_rx_ecef,
+                 'los': Inter_los,
+                 'elev_az': Inter_elev_az,
+                 'geometry': Inter_geometry}
+
+
+class Calc_graph:
+  def __init__(self, calcs: List[Calc], intermediates: dict = INTERMEDIATES):
+    """
+      Calcs and the intermediates they need, scheduled in dependency order.
+    """
+    self.calcs = list(calcs)
+    self.nodes = list(calcs)
+    producers = {}
+    for calc in self.calcs:
+      for name in calc.produces():
+        producers[name] = calc
+
+    # Add the producers of all consumed intermediates
+    todo = [name for calc in self.calcs for name in calc.consumes()]
+    while len(todo) > 0:
+      name = todo.pop()
+      if name in producers:
+        continue
+      if name not in intermediates:
+        raise Exception(f'No Calc produces the intermediate "{name}"')
+      node = intermediates[name]()
+      self.nodes.append(node)
+      for p in node.produces():
+        producers[p] = node
+      todo.extend(node.consumes())
+    self.producers = producers
+    self.order = self.__schedule()
+
+  def __schedule(self) -> List[Calc]:
+    # Kahn's algorithm, Calcs keep their queue order among the ready ones
+    deps = {id(n): {id(self.producers[k]) for k in n.consumes()} for n in self.nodes}
+    order = []
+    done = set()
+    while len(order) < len(self.nodes):
+      ready = [n for n in self.nodes if id(n) not in done and deps[id(n)] <= done]
+      if len(ready) == 0:
+        raise Exception('Calc_graph: dependency cycle between Calcs')
+      ready.sort(key=lambda n: n in self.calcs)
+      order.append(ready[0])
+      done.add(id(ready[0]))
+    return order
+
+  def required_vars(self) -> set:
+    """
+      Position channels needed by all Calcs and intermediates
+    """
+    req = set()
+    for n in self.nodes:
+      req = req.union(set(n.required_vars() or []))
+    return req
+
+  def run(self, pos_pos, sats_FOV, cache: dict = None) -> Tuple[dict, dict]:
+    """
+      Run all nodes in order. Intermediates already in the cache (e.g. from
+      the FOV model) are not recomputed. Returns the outputs of the Calcs
+      in queue order and the cache.
+    """
+    cache = {} if cache is None else cache
+    outputs = {}
+    for n in self.order:
+      if n not in self.calcs and all(k in cache for k in n.produces()):
+        continue
+      res = n.do_calc(pos_pos, sats_FOV, cache)
+      if n in self.calcs:
+        outputs[id(n)] = res
+    ordered = {}
+    for calc in self.calcs:
+      ordered.update(outputs[id(calc)])
+    return ordered, cache
+
+
 class Calc_gdop(Calc):
   def __init__(self):
     super().__init__()
@@ -33,30 +225,18 @@ class Calc_gdop(Calc):
   def required_vars(self) -> List[str]:
     return [c.CHN_UTC, c.CHN_LAT, c.CHN_LON, c.CHN_ALT,c.CHN_TMS]
 
-  def do_calc(self, pos_pos, sats_FOV) -> Tuple[str, list]:
-    # sats_FOV is ordered like:  times{} -> prn{} = (x,y,z)
-
-    results = {'HDOP': [], 'VDOP': [], 'GDOP': []}
-
-    for i in range(len(pos_pos[c.CHN_UTC])):
-      t = pos_pos[c.CHN_UTC][i]
-
-      lat = pos_pos[c.CHN_LAT][i]
-      lon = pos_pos[c.CHN_LON][i]
-      alt = pos_pos[c.CHN_ALT][i]
+  def consumes(self) -> List[str]:
+    return ['geometry']
 
-      u = np.array(c.lla2ecef(lat, lon, alt))
+  def do_calc(self, pos_pos, sats_FOV, cache: dict = None) -> Tuple[str, list]:
+    # sats_FOV: Sat_block or times{} -> prn{} = (x,y,z)
+    if cache is None:
+      _, cache = Calc_graph([Inter_geometry()]).run(pos_pos, sats_FOV)
 
-      mat: np.array = []
-
-      # Add visible satellites to LOS matrix
-      for j in sats_FOV[t]:
-        sat_pos = sats_FOV[t][j]                # tuple, ECEF coord of a sat
-        d = lambda ax: sat_pos[ax] - u[ax]      # float, axis value difference (x=0, y=1, z=2)
-        psd = np.sqrt(d(0)**2 + d(1)**2 + d(2)**2)    # pseudo range from receiver to sat
-        m_row = [-d(0)/psd, -d(1)/psd, -d(2)/psd, 1]  # Row in GDOP matrix
-        mat.append(m_row)
+    results = {'HDOP': [], 'VDOP': [], 'GDOP': []}
 
+    # Rows of the LOS matrix of the visible satellites
+    for mat in cache['geometry']:
       m = np.matmul(np.transpose(mat), mat)
       Q = np.linalg.inv(m)
       T = [Q[0][0], Q[1][1], Q[2][2], Q[3][3]]
@@ -67,3 +247,111 @@ class Calc_gdop(Calc):
       results['GDOP'].append(np.sqrt(np.trace(Q)))
     
     return results
+
+
+class Calc_elevation(Calc):
+  def __init__(self):
+    super().__init__()
+    pass
+
+  def get_chn(self) -> List[str]:
+    return ['ELEV_MIN', 'ELEV_MEAN', 'AZ_GAP']
+
+  def required_vars(self) -> List[str]:
+    return [c.CHN_UTC, c.CHN_LAT, c.CHN_LON, c.CHN_ALT]
+
+  def consumes(self) -> List[str]:
+    return ['elev_az']
+
+  def do_calc(self, pos_pos, sats_FOV, cache: dict = None) -> Tuple[str, list]:
+    # Lowest and mean elevation (deg) of the satellites in the FOV and the
+    # largest azimuth interval without a satellite (deg)
+    if cache is None:
+      _, cache = Calc_graph([Inter_elev_az()]).run(pos_pos, sats_FOV)
+
+    results = {'ELEV_MIN': [], 'ELEV_MEAN': [], 'AZ_GAP': []}
+    for el, az in cache['elev_az']:
+      if len(el) == 0:
+        results['ELEV_MIN'].append(np.nan)
+        results['ELEV_MEAN'].append(np.nan)
+        results['AZ_GAP'].append(360.0)
+        continue
+      a = np.sort(az)
+      results['ELEV_MIN'].append(np.min(el))
+      results['ELEV_MEAN'].append(np.mean(el))
+      results['AZ_GAP'].append(np.max(np.diff(np.append(a, a[0] + 360))))
+    return results
+
+
+class Calc_mask_count(Calc):
+  def __init__(self, mask_angle: float = 15):
+    super().__init__()
+    self.mask_angle = mask_angle
+    pass
+
+  def get_chn(self) -> List[str]:
+    return [f'ns_{self.mask_angle:g}']
+
+  def required_vars(self) -> List[str]:
+    return [c.CHN_UTC, c.CHN_LAT, c.CHN_LON, c.CHN_ALT]
+
+  def consumes(self) -> List[str]:
+    return ['elev_az']
+
+  def do_calc(self, pos_pos, sats_FOV, cache: dict = None) -> Tuple[str, list]:
+    # Satellites of the FOV above a higher elevation mask
+    if cache is None:
+      _, cache = Calc_graph([Inter_elev_az()]).run(pos_pos, sats_FOV)
+    return {self.get_chn()[0]: [int(np.count_nonzero(el >= self.mask_angle)) for el, _ in cache['elev_az']]}
+
+
+def test():
+  from Modules.fov_models import FOV_view_match
+
+  # 200 rows with 12 satellites, 8 in view
+  rng = np.random.default_rng(2)
+  n = 200
+  times = [f'2021-12-03 08:{i//60:02d}:{i % 60:02d}' for i in range(n)]
+  pos = {c.CHN_UTC: times, c.CHN_TMS: list(range(n)), c.CHN_SAT: [8]*n,
+         c.CHN_LAT: list(60.39 + 1e-4*np.arange(n)), c.CHN_LON: [5.32]*n, c.CHN_ALT: [300.0]*n}
+  rx = np.array(c.lla2ecef(60.39, 5.32, 300.0))
+  sats = {}
+  for i, t in enumerate(times):
+    dirs = rng.normal(0, 1, (12, 3)) + 2*rx/np.linalg.norm(rx)
+    sats[t] = {f'G{k + 1:02d}': tuple(rx + 2.2e7*d/np.linalg.norm(d)) for k, d in enumerate(dirs)}
+
+  calcs = [Calc_gdop(), Calc_elevation(), Calc_mask_count(15)]
+  graph = Calc_graph(calcs)
+  names = [type(n).__name__ for n in graph.order]
+  assert names.index('Inter_los') < names.index('Inter_geometry') < names.index('Calc_gdop')
+  assert graph.required_vars() >= {c.CHN_TMS, c.CHN_LAT}
+
+  # The FOV model provides rx_ecef, every intermediate runs once
+  runs = {}
+
+  def counted(node):
+    do_calc = node.do_calc
+    def run(*args):
+      runs[type(node).__name__] = runs.get(type(node).__name__, 0) + 1
+      return do_calc(*args)
+    node.do_calc = run
+
+  for node in graph.nodes:
+    counted(node)
+  cache = {}
+  los_sats = FOV_view_match().get_sats(pos, sats, cache)
+  results, cache = graph.run(pos, los_sats, cache)
+  assert 'Inter_rx_ecef' not in runs and all(v == 1 for v in runs.values())
+  assert list(results.keys()) == ['HDOP', 'VDOP', 'GDOP', 'ELEV_MIN', 'ELEV_MEAN', 'AZ_GAP', 'ns_15']
+
+  # Same values as each Calc on its own, and from the old dict shape
+  assert isinstance(los_sats, Sat_block) and np.all(los_sats.n_visible() == 8)
+  assert np.allclose(Calc_gdop().do_calc(pos, los_sats.to_dict())['GDOP'], results['GDOP'])
+  alone = Calc_gdop().do_calc(pos, los_sats)
+  assert np.allclose(alone['GDOP'], results['GDOP'])
+  assert all(0 <= k <= 8 for k in results['ns_15'])
+  print(f'{len(graph.order)} nodes: {", ".join(names)}')
+
+
+if __name__ == '__main__':
+  test()
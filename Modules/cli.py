@@ -0,0 +1,262 @@
+###############################################################################
+# File:  cli.py
+#
+# Description:
+# Command line entry point of the processing chain, for scripted and
+# scheduled runs without the notebooks:
+#
+#   python -m Modules.cli gdop  <positions.csv> ...   GDOP along a track
+#   python -m Modules.cli batch <folder|manifest> ... GDOP of many flights
+#   python -m Modules.cli fuse  <folder> <file.pos> ... loosely coupled
+#                                                       GNSS/INS fusion
+#   python -m Modules.cli ppk   --rover ... --base ... PPK with rnx2rtkp
+#   python -m Modules.cli bench --baseline ...       fusion regression
+#                                                       benchmark
+#
+# Only the standard library is imported here; each subcommand imports the
+# modules it needs (numpy, pandas, xarray, georinex, pyproj, ...) when it
+# runs, so `--help` and argument errors return at once. Importing this
+# module has no side effects. --base-folder replaces common.BASE_FOLDER
+# (GNSS_INS_BASE_FOLDER environment variable) for the run.
+#                                                                             #
+###############################################################################
+
+# %%
+import argparse
+import os
+import sys
+import time
+
+
+def _parser() -> argparse.ArgumentParser:
+  parser = argparse.ArgumentParser(prog='python -m Modules.cli',
+                                   description='GNSS/INS processing: GDOP, fusion and PPK.')
+  parser.add_argument('--base-folder', default='',
+                      help='data folder (default: GNSS_INS_BASE_FOLDER or common.BASE_FOLDER)')
+  parser.add_argument('-q', '--quiet', action='store_true', help='only print errors')
+  sub = parser.add_subparsers(dest='command', metavar='command')
+  sub.required = True
+
+  g = sub.add_parser('gdop', help='DOP and visible satellites along a track (Calc_manager)')
+  g.add_argument('positions', help='position CSV (Timestamp, UTC_Time, Latitude, Longitude, Height, ns)')
+  g.add_argument('-o', '--out', default='', help='output CSV (default: <positions>_gdop.csv)')
+  g.add_argument('--ts', type=float, default=5, help='sampling period (sec)')
+  g.add_argument('--rinex-folder', default='', help='navigation file folder (default: common.RINEX_FOLDER)')
+  g.add_argument('--calcs', default='gdop',
+                 help='comma separated: gdop, elevation, mask<deg> (e.g. mask15)')
+  g.add_argument('--pipelined', action='store_true', help='overlap download, reading, compute and writing')
+  g.add_argument('--chunk-rows', type=int, default=500, help='rows per chunk with --pipelined')
+  g.set_defaults(run=run_gdop)
+
+  b = sub.add_parser('batch', help='GDOP of all position files of a folder or manifest (batch_manager)')
+  b.add_argument('inputs', help='folder of position CSVs, or text file listing them')
+  b.add_argument('--pattern', default='*.csv', help='file pattern in a folder')
+  b.add_argument('-o', '--out-dir', default='', help='output folder (default: next to the inputs)')
+  b.add_argument('--ts', type=float, default=5, help='sampling period (sec)')
+  b.add_argument('--calcs', default='gdop', help='as for gdop')
+  b.add_argument('--workers', type=int, default=0, help='flights processed at the same time (default: CPU count)')
+  b.set_defaults(run=run_batch)
+
+  f = sub.add_parser('fuse', help='loosely coupled GNSS/INS EKF (lc_ins_gnss)')
+  f.add_argument('folder', help='folder of the .pos and IMU files')
+  f.add_argument('pos_file', help='RTKLIB .pos file name')
+  f.add_argument('--imu', default='IMU_Data.csv', help='IMU CSV file name')
+  f.add_argument('--start', type=float, default=467000, help='first fused epoch (sec of week)')
+  f.add_argument('--end', type=float, default=469440, help='last fused epoch (sec of week)')
+  f.add_argument('--gnss-interval', type=float, default=0.2, help='time between GNSS updates (sec)')
+  f.add_argument('--cov-decimation', type=int, default=0, help='see run_LC_EKF')
+  f.add_argument('--mech-decimation', type=int, default=1, help='see run_LC_EKF')
+  f.add_argument('-o', '--out', default='', help='output CSV (default: <folder>/<pos_file>_fused.csv)')
+  f.add_argument('--archive', default='', help='also write the solution to this flight archive')
+  f.add_argument('--flight', default='', help='flight name in the archive (default: pos file name)')
+  f.set_defaults(run=run_fuse)
+
+  p = sub.add_parser('ppk', help='PPK with RTKLIB rnx2rtkp (ppk_runner)')
+  p.add_argument('--rnx2rtkp', required=True, help='rnx2rtkp executable')
+  p.add_argument('--config', required=True, help='rnx2rtkp configuration file')
+  p.add_argument('--rover', required=True, action='append', help='rover observation file (repeat for several)')
+  p.add_argument('--base', required=True, help='base observation file')
+  p.add_argument('--nav', required=True, help='navigation file')
+  p.add_argument('--extra', action='append', default=[], help='precise orbit/clock file (repeatable)')
+  p.add_argument('--out-dir', default='', help='folder of the .pos files (default: next to the rover files)')
+  p.add_argument('--workers', type=int, default=0, help='parallel rnx2rtkp runs (default: CPU count)')
+  p.set_defaults(run=run_ppk)
+
+  r = sub.add_parser('bench', help='speed/accuracy benchmark of the fusion on synthetic flights (fusion_bench)')
+  r.add_argument('-o', '--out', default='fusion_bench.json', help='results JSON')
+  r.add_argument('--baseline', default='', help='baseline JSON, exit code 1 on regression')
+  r.add_argument('--update-baseline', action='store_true', help='write the results to --baseline instead')
+  r.add_argument('--scenarios', default='straight,survey,climb', help='comma separated flights')
+  r.add_argument('--variants', default='full,block40,preint4', help='comma separated filter variants')
+  r.add_argument('--duration', type=float, default=120.0, help='flight length (sec)')
+  r.add_argument('--no-memory', action='store_true', help='skip the peak memory run')
+  r.set_defaults(run=run_bench)
+  return parser
+
+
+def _calcs(names: str) -> list:
+  from Modules.calcs import Calc_gdop, Calc_elevation, Calc_mask_count
+  calcs = []
+  for name in [n.strip() for n in names.split(',') if n.strip() != '']:
+    if name == 'gdop':
+      calcs.append(Calc_gdop())
+    elif name == 'elevation':
+      calcs.append(Calc_elevation())
+    elif name.startswith('mask'):
+      calcs.append(Calc_mask_count(float(name[4:])))
+    else:
+      raise ValueError(f'Unknown calc "{name}"')
+  return calcs
+
+
+def run_gdop(args) -> int:
+  from Modules.calc_manager import Calc_manager
+  from Modules.fov_models import FOV_view_match
+  import Modules.common as c
+
+  positions = os.path.abspath(args.positions)
+  out = os.path.abspath(args.out) if args.out != '' else positions[:-4] + '_gdop.csv'
+  manager = Calc_manager(positions, out_file=out,
+                         rinex_folder=args.rinex_folder if args.rinex_folder != '' else c.RINEX_FOLDER,
+                         data_folder='', out_folder='', ts=args.ts)
+  manager.set_FOV(FOV_view_match())
+  for calc in _calcs(args.calcs):
+    manager.add_calc(calc)
+  if args.pipelined:
+    manager.process_pipelined(chunk_rows=args.chunk_rows)
+  else:
+    manager.process_data()
+  _say(args, f'Written {out}')
+  return 0
+
+
+def run_batch(args) -> int:
+  from Modules.batch_manager import Batch_manager
+  from Modules.fov_models import FOV_view_match
+
+  options = dict(out_folder=args.out_dir, ts=args.ts, max_workers=args.workers)
+  if os.path.isdir(args.inputs):
+    batch = Batch_manager.from_folder(args.inputs, args.pattern, **options)
+  else:
+    batch = Batch_manager.from_manifest(args.inputs, **options)
+  batch.set_FOV(FOV_view_match())
+  for calc in _calcs(args.calcs):
+    batch.add_calc(calc)
+  report = batch.process()
+  failed = [f for f in report['flights'] if f['status'] != 'ok']
+  for f in failed:
+    print(f'{f["file"]}: {f["status"]} {f["message"]}', file=sys.stderr)
+  _say(args, f'{len(report["flights"]) - len(failed)} flights processed, summary in {batch.summary_file}')
+  return 1 if len(failed) > 0 else 0
+
+
+def run_fuse(args) -> int:
+  import numpy as np
+  from Modules.ins_gnss_data import get_all_INS_GNSS_data
+  from Modules.ins_ekf import data_packet
+  from Modules.lc_ins_gnss import run_LC_EKF
+  from Modules.flight_archive import PROFILE_COLUMNS
+
+  no_epochs, in_profile_data, InitP = get_all_INS_GNSS_data(args.folder, args.pos_file, args.start,
+                                                            args.end, args.imu)
+  out_profile_data = run_LC_EKF(in_profile_data, no_epochs, data_packet(InitP), args.gnss_interval,
+                                args.cov_decimation, args.mech_decimation)
+
+  out = args.out if args.out != '' else os.path.join(args.folder, os.path.splitext(args.pos_file)[0] + '_fused.csv')
+  np.savetxt(out, out_profile_data, delimiter=',', header=','.join(PROFILE_COLUMNS), comments='', fmt='%.10g')
+  _say(args, f'{len(out_profile_data)} epochs written to {out}')
+
+  if args.archive != '':
+    from Modules.flight_archive import Flight_archive, columns_from_out_profile
+    flight = args.flight if args.flight != '' else os.path.splitext(args.pos_file)[0]
+    Flight_archive(args.archive).write(flight, columns_from_out_profile(out_profile_data), source=out)
+    _say(args, f'Archived as "{flight}" in {args.archive}')
+  return 0
+
+
+def run_ppk(args) -> int:
+  from Modules.ppk_runner import PPK_job, PPK_runner
+
+  jobs = []
+  for rover in args.rover:
+    pos_out = ''
+    if args.out_dir != '':
+      pos_out = os.path.join(args.out_dir, os.path.splitext(os.path.basename(rover))[0] + '.pos')
+    jobs.append(PPK_job(rover, args.base, args.nav, extra=args.extra, pos_out=pos_out))
+  results = PPK_runner(args.rnx2rtkp, args.config, max_workers=args.workers).run(jobs, parse=False)
+  failed = 0
+  for r in results:
+    if r.pos_file == '':
+      failed += 1
+      print(f'{r.job.rover_obs}: rnx2rtkp failed (code {r.returncode}), see {r.log_file}', file=sys.stderr)
+    else:
+      _say(args, f'{r.pos_file}{" (cached)" if r.cached else ""}')
+  return 1 if failed > 0 else 0
+
+
+def run_bench(args) -> int:
+  from Modules.fusion_bench import VARIANTS, run_bench, compare, write_json, read_json
+
+  variants = {v: VARIANTS[v] for v in args.variants.split(',')}
+  results = run_bench(args.scenarios.split(','), variants, args.duration, memory=not args.no_memory)
+  write_json(results, args.out)
+  _say(args, f'Results in {args.out}')
+  if args.baseline == '':
+    return 0
+  if args.update_baseline:
+    write_json(results, args.baseline)
+    _say(args, f'Baseline {args.baseline} updated')
+    return 0
+  failures = compare(results, read_json(args.baseline))
+  for failure in failures:
+    print(f'REGRESSION {failure}', file=sys.stderr)
+  return 1 if len(failures) > 0 else 0
+
+
+def _say(args, text: str) -> None:
+  if not args.quiet:
+    print(text)
+
+
+def main(argv: list = None) -> int:
+  args = _parser().parse_args(argv)
+  if args.base_folder != '':
+    os.environ['GNSS_INS_BASE_FOLDER'] = os.path.join(os.path.abspath(args.base_folder), '')
+    if 'Modules.common' in sys.modules:
+      raise RuntimeError('--base-folder must be set before Modules.common is imported')
+  now = time.perf_counter()
+  code = args.run(args)
+  _say(args, f'{args.command}: {time.perf_counter() - now:.2f} s')
+  return code
+
+
+def test():
+  import subprocess
+
+  # --help does not import numpy or any processing module
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  code = ('import sys, time; now = time.perf_counter(); import Modules.cli as cli\n'
+          'try:\n  cli.main(["--help"])\nexcept SystemExit:\n  pass\n'
+          'heavy = [m for m in ("numpy", "pandas", "xarray", "georinex", "pyproj", "Modules.common") if m in sys.modules]\n'
+          'print(heavy, time.perf_counter() - now, file=sys.stderr)')
+  now = time.perf_counter()
+  res = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True)
+  wall = time.perf_counter() - now
+  assert res.returncode == 0 and 'gdop' in res.stdout, res.stderr
+  heavy, t_in = res.stderr.split(']')
+  assert heavy == '[', heavy
+  print(f'--help: {float(t_in)*1e3:.0f} ms in process, {wall*1e3:.0f} ms with interpreter start')
+
+  # Argument errors before any import
+  res = subprocess.run([sys.executable, '-m', 'Modules.cli', 'ppk', '--rover', 'x'], cwd=root,
+                       capture_output=True, text=True)
+  assert res.returncode == 2 and 'required' in res.stderr
+
+  # No import-time side effects
+  cwd = os.getcwd()
+  import Modules.reader_pos_data
+  assert os.getcwd() == cwd
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,10 +1,10 @@
 #Modified by Bourriz mohamed 2023
-from pyproj.transformer import Transformer
 import datetime as d
 import typing as t
 import os
 
-BASE_FOLDER = 'C:/Users/bourriz/GNSS_INS_Processing/UIS_PosPac_HyspexNav_processing/Result/' #Path u can change it
+# Path u can change it, or set the GNSS_INS_BASE_FOLDER environment variable
+BASE_FOLDER = os.environ.get('GNSS_INS_BASE_FOLDER', 'C:/Users/bourriz/GNSS_INS_Processing/UIS_PosPac_HyspexNav_processing/Result/')
 RINEX_FOLDER = BASE_FOLDER + 'Corrections_files'
 POS_DATA_FOLDER = BASE_FOLDER +'Position'
 # print(RINEX_FOLDER)
@@ -38,8 +38,14 @@ LOS_ANGLE = 5
 
 # Functions
 
+_lla2ecef_transformer = None
+
 def lla2ecef(lat, lon, alt) -> tuple:
   # https://epsg.io/4978 and http://epsg.io/4979
   # WGS84 lat,lon,alt    and WGS84 ECEF
-  t = Transformer.from_crs("epsg:4979", "epsg:4978")
-  return (t.transform(lat, lon, alt))
\ No newline at end of file
+  # pyproj is imported and the transformer built on the first call only
+  global _lla2ecef_transformer
+  if _lla2ecef_transformer is None:
+    from pyproj.transformer import Transformer
+    _lla2ecef_transformer = Transformer.from_crs("epsg:4979", "epsg:4978")
+  return (_lla2ecef_transformer.transform(lat, lon, alt))
\ No newline at end of file
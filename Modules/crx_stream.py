@@ -0,0 +1,651 @@
+###############################################################################
+# File:  crx_stream.py
+#
+# Description:
+# Compact RINEX (Hatanaka) decompression in Python, replacing crx2rnx.exe of
+# download_corr (2_Download_Corrections_Files.ipynb). A .crx.gz file is
+# read through gzip and decoded line by line, so the RINEX observation text
+# is produced in one pass without the .crx and .rnx copies on disk.
+#
+# Crx_file(fn) is a file-like iterator of RINEX lines: it can be given to
+# rinex_obs_merge.read_obs_header/iter_obs_epochs (read_crx()) or written
+# out (crx_to_rnx()). decompress_files() converts several files in parallel
+# processes. CRINEX 1 (RINEX 2) and CRINEX 3 (RINEX 3) are supported.
+#
+# Format (Hatanaka, 2008): the epoch line is a text difference from the
+# previous one (unchanged char -> ' ', char changed to blank -> '&'), the
+# satellites follow at column 32 (CRINEX 1) or 41 (CRINEX 3). A clock
+# offset line follows, then one line per satellite with the observations
+# (x1000 integers) as differences of order up to 3; 'k&value' starts a new
+# arc of order k, an empty field is a missing observation. The LLI/SSI
+# flags follow as a text difference. Crx_file writes the same RINEX text
+# as crx2rnx 4.1 (F format, no 0 before the point of values below 1) and
+# rnx_to_crx_lines() the same CRINEX as rnx2crx 4.1, checked against files
+# of these programs in the test.
+#                                                                             #
+###############################################################################
+
+# %%
+import gzip
+import os
+from concurrent.futures import ProcessPoolExecutor
+from Modules.rinex_obs_merge import read_obs_header, iter_obs_epochs
+from Modules.d_print import Debug
+
+
+def _text_merge(old: str, diff: str) -> str:
+  out = []
+  for i in range(max(len(old), len(diff))):
+    c = diff[i] if i < len(diff) else ' '
+    if c == ' ':
+      c = old[i] if i < len(old) else ' '
+    elif c == '&':
+      c = ' '
+    out.append(c)
+  return ''.join(out).rstrip()
+
+
+def _text_diff(old: str, new: str) -> str:
+  out = []
+  for i in range(max(len(old), len(new))):
+    c = new[i] if i < len(new) else ' '
+    if c == (old[i] if i < len(old) else ' '):
+      c = ' '
+    elif c == ' ':
+      c = '&'
+    out.append(c)
+  return ''.join(out).rstrip()
+
+
+def _diff_decode(arc, field: str):
+  # (value, arc) from a field; arc = [order, epochs since start, differences]
+  if field == '':
+    return None, None
+  if len(field) > 1 and field[1] == '&':
+    d = [int(field[2:])]
+    return d[0], [int(field[0]), 0, d]
+  order, count, d = arc
+  count += 1
+  n = min(count, order)
+  d = d[:n] + [int(field)]
+  for k in range(n, 0, -1):
+    d[k - 1] += d[k]
+  return d[0], [order, count, d]
+
+
+def _diff_encode(arc, value, order: int = 3):
+  # (field, arc) of a value, arc None starts a new arc
+  if value is None:
+    return '', None
+  if arc is None:
+    return f'{order}&{value}', [order, 0, [value]]
+  order, count, d = arc
+  count += 1
+  n = min(count, order)
+  e = [value]
+  for k in range(1, n + 1):
+    e.append(e[k - 1] - d[k - 1])
+  # As rnx2crx: a new arc when the difference does not fit its upper 5 and
+  # lower 5 digits (floor split)
+  if not -100000 <= e[n]//100000 <= 100000:
+    return f'{order}&{value}', [order, 0, [value]]
+  return str(e[n]), [order, count, e]
+
+
+def _to_int(s: str, decimals: int):
+  s = s.strip()
+  if s == '':
+    return None
+  neg = s.startswith('-')
+  ip, _, fp = s.lstrip('-').partition('.')
+  v = int((ip or '0') + fp.ljust(decimals, '0')[:decimals])
+  return -v if neg else v
+
+
+def _to_fixed(v: int, decimals: int, width: int) -> str:
+  # As CRX2RNX (Fortran F format): no 0 before the point, ' -.250'
+  ip, fp = divmod(abs(v), 10**decimals)
+  return f'{"-" if v < 0 else ""}{ip if ip > 0 else ""}.{fp:0{decimals}d}'.rjust(width)
+
+
+class Crx_file:
+  def __init__(self, fn: str):
+    self.name = fn
+    self.__fh = gzip.open(fn, 'rt') if fn.endswith('.gz') else open(fn, 'r')
+    self.__lines = self.__decode()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self) -> str:
+    return next(self.__lines)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self) -> None:
+    self.__fh.close()
+
+  def __decode(self):
+    fh = self.__fh
+    crx_version = fh.readline()
+    if 'CRINEX VERS' not in crx_version:
+      raise ValueError(f'{self.name}: not a Compact RINEX file')
+    v3 = crx_version.strip().startswith('3')
+    fh.readline()                               # CRINEX PROG / DATE
+
+    lines = []
+    for line in fh:
+      lines.append(line.rstrip('\n'))
+      yield lines[-1] + '\n'
+      if lines[-1][60:80].strip() == 'END OF HEADER':
+        break
+    header = read_obs_header(iter(lines))
+
+    sat_at = 41 if v3 else 32
+    epoch = ''
+    clock = None
+    arcs = {}
+    flags = {}
+    for line in fh:
+      line = line.rstrip('\n')
+      if line.startswith('>' if v3 else '&'):
+        epoch = line if v3 else ' ' + line[1:]
+      else:
+        epoch = _text_merge(epoch, line)
+      flag = int(epoch[31] if v3 else epoch[28])
+      n = int(epoch[32:35] if v3 else epoch[29:32])
+
+      if 2 <= flag <= 5:
+        # Event: header records copied as is
+        yield epoch[:sat_at].rstrip() + '\n'
+        for _ in range(n):
+          yield next(fh)
+        continue
+
+      # Receiver clock offset (x1e12 for CRINEX 3, x1e9 for CRINEX 1)
+      clock_line = next(fh).rstrip('\n')
+      value, clock = _diff_decode(clock, clock_line)
+      clock_txt = '' if value is None else _to_fixed(value, 12 if v3 else 9, 15 if v3 else 12)
+
+      sats = [epoch[sat_at + 3*i:sat_at + 3*i + 3] for i in range(n)]
+      if v3:
+        yield (epoch[:35] + ('      ' + clock_txt if clock_txt != '' else '')).rstrip() + '\n'
+      else:
+        head = epoch[:32] + ''.join(sats[:12])
+        if clock_txt != '':
+          head = head.ljust(68) + clock_txt
+        yield head + '\n'
+        for i in range(12, n, 12):
+          yield ' '*32 + ''.join(sats[i:i + 12]) + '\n'
+
+      new_arcs = {}
+      new_flags = {}
+      for sv in sats:
+        n_obs = len(header.types_of(sv.replace(' ', '0')))
+        parts = next(fh).rstrip('\n').split(' ', n_obs)
+        fields = parts[:n_obs] + ['']*(n_obs - len(parts[:n_obs]))
+        sv_flags = _text_merge(flags.get(sv, ''), parts[n_obs] if len(parts) > n_obs else '').ljust(2*n_obs)
+        sv_arcs = arcs.get(sv, [None]*n_obs)
+        obs = []
+        for j in range(n_obs):
+          value, sv_arcs[j] = _diff_decode(sv_arcs[j], fields[j])
+          if value is None:
+            # No flags for a missing observation (rnx2crx clears them
+            # without writing '&' in CRINEX 1)
+            obs.append(' '*16)
+            sv_flags = sv_flags[:2*j] + '  ' + sv_flags[2*j + 2:]
+          else:
+            obs.append(_to_fixed(value, 3, 14) + sv_flags[2*j:2*j + 2])
+        new_arcs[sv] = sv_arcs
+        new_flags[sv] = sv_flags
+        if v3:
+          yield (sv + ''.join(obs)).rstrip() + '\n'
+        else:
+          for i in range(0, n_obs, 5):
+            yield ''.join(obs[i:i + 5]).rstrip() + '\n'
+      arcs = new_arcs
+      flags = new_flags
+
+
+def rnx_to_crx_lines(lines, order: int = 3):
+
+  # Compact RINEX lines of RINEX observation lines (inverse of Crx_file)
+  #
+  # INPUTS:
+  #   lines       Iterator of RINEX observation lines
+  #   order       Difference order of the observations
+  #
+  # OUTPUTS
+  #   Generator of Compact RINEX lines (with '\n')
+
+  lines = iter(lines)
+  header = []
+  for line in lines:
+    header.append(line.rstrip('\n'))
+    if header[-1][60:80].strip() == 'END OF HEADER':
+      break
+  h = read_obs_header(iter(header))
+  v3 = h.version >= 3.0
+  yield ('3.0' if v3 else '1.0').ljust(20) + 'COMPACT RINEX FORMAT'.ljust(40) + 'CRINEX VERS   / TYPE\n'
+  yield 'crx_stream'.ljust(60) + 'CRINEX PROG / DATE\n'
+  for line in header:
+    yield line + '\n'
+
+  sat_at = 41 if v3 else 32
+  prev = None
+  clock = None
+  arcs = {}
+  flags = {}
+  for line in lines:
+    line = line.rstrip('\n')
+    if line.strip() == '':
+      continue
+    flag = int(line[31] if v3 else line[28])
+    n = int(line[32:35] if v3 else line[29:32])
+    if 2 <= flag <= 5:
+      yield (line if v3 else '&' + line[1:]) + '\n'
+      for _ in range(n):
+        yield next(lines)
+      prev = None
+      continue
+
+    if v3:
+      clock_txt = line[41:56]
+      sats = []
+      recs = []
+      for _ in range(n):
+        rec = next(lines).rstrip('\n')
+        sats.append(rec[0:3])
+        recs.append(rec[3:])
+    else:
+      clock_txt = line[68:80]
+      sat_txt = line[32:68]
+      for _ in range((n - 1)//12):
+        sat_txt += next(lines).rstrip('\n')[32:68]
+      sats = [sat_txt[3*i:3*i + 3] for i in range(n)]
+      n_obs = len(h.types_of(''))
+      recs = [''.join(next(lines).rstrip('\n').ljust(80) for _ in range((n_obs + 4)//5)) for _ in sats]
+
+    epoch = (line[:35] if v3 else line[:32]).ljust(sat_at) + ''.join(sats)
+    if prev is None:
+      yield (epoch if v3 else '&' + epoch[1:]) + '\n'
+    else:
+      yield _text_diff(prev, epoch) + '\n'
+    prev = epoch
+
+    field, clock = _diff_encode(clock, _to_int(clock_txt, 12 if v3 else 9), order)
+    yield field + '\n'
+
+    new_arcs = {}
+    new_flags = {}
+    for sv, rec in zip(sats, recs):
+      n_obs = len(h.types_of(sv.replace(' ', '0')))
+      rec = rec.ljust(16*n_obs)
+      sv_arcs = arcs.get(sv, [None]*n_obs)
+      fields = []
+      for j in range(n_obs):
+        field, sv_arcs[j] = _diff_encode(sv_arcs[j], _to_int(rec[16*j:16*j + 14], 3), order)
+        fields.append(field)
+      # Flags of a new satellite: in full (blanks as '&') in CRINEX 3, from
+      # blanks in CRINEX 1
+      ref = flags.get(sv, '&'*2*n_obs if v3 else '')
+      sv_flags = ''.join(rec[16*j + 14:16*j + 16] for j in range(n_obs))
+      if not v3:
+        # Flags of missing observations: unchanged in the difference,
+        # cleared in the reference
+        shown = ''.join(ref.ljust(2*n_obs)[2*j:2*j + 2] if fields[j] == '' else sv_flags[2*j:2*j + 2]
+                        for j in range(n_obs))
+        diff = _text_diff(ref, shown)
+        sv_flags = ''.join('  ' if fields[j] == '' else sv_flags[2*j:2*j + 2] for j in range(n_obs))
+      else:
+        diff = _text_diff(ref, sv_flags)
+      new_arcs[sv] = sv_arcs
+      new_flags[sv] = sv_flags
+      yield (' '.join(fields) + ' ' + diff).rstrip() + '\n'
+    arcs = new_arcs
+    flags = new_flags
+
+
+def read_crx(fn: str):
+
+  # Observation header and epochs of a Compact RINEX file
+  #
+  # INPUTS:
+  #   fn          .crx or .crx.gz file
+  #
+  # OUTPUTS
+  #   header      Obs_header
+  #   epochs      Generator of Obs_epoch (the file is closed at its end)
+
+  fh = Crx_file(fn)
+  header = read_obs_header(fh)
+
+  def epochs():
+    with fh:
+      yield from iter_obs_epochs(fh, header)
+  return header, epochs()
+
+
+def rnx_name(fn: str) -> str:
+  # X.crx(.gz) -> X.rnx, X.YYd(.gz) -> X.YYo
+  name = fn[:-3] if fn.endswith('.gz') else fn
+  root, ext = os.path.splitext(name)
+  if ext.lower() == '.crx':
+    return root + '.rnx'
+  return root + ext[:-1] + ('O' if ext[-1].isupper() else 'o')
+
+
+def crx_to_rnx(fn: str, output: str = '') -> str:
+
+  # Decompress one file to RINEX
+  #
+  # INPUTS:
+  #   fn          .crx/.YYd file, gzipped or not
+  #   output      RINEX file (rnx_name(fn) by default)
+  #
+  # OUTPUTS
+  #   output
+
+  output = output if output != '' else rnx_name(fn)
+  with Crx_file(fn) as src, open(output + '.part', 'w') as dst:
+    dst.writelines(src)
+  os.replace(output + '.part', output)
+  Debug(f'{fn} -> {output}')
+  return output
+
+
+def decompress_files(files: list, out_dir: str = '', max_workers: int = 0) -> list:
+
+  # Decompress files in parallel processes
+  #
+  # INPUTS:
+  #   files       .crx(.gz) files
+  #   out_dir     Output folder (next to the inputs by default)
+  #   max_workers Processes (cpu count by default)
+  #
+  # OUTPUTS
+  #   RINEX files, in the order of files
+
+  outputs = [rnx_name(fn) if out_dir == '' else os.path.join(out_dir, os.path.basename(rnx_name(fn)))
+             for fn in files]
+  with ProcessPoolExecutor(max_workers=max_workers if max_workers > 0 else None) as pool:
+    return list(pool.map(crx_to_rnx, files, outputs))
+
+
+# Reference files for the test: small RINEX 2.11 and 3.04 files compressed
+# by RNX2CRX 4.1.0, and the RINEX written back by CRX2RNX 4.1.0 (clock
+# offsets, a satellite rising and one missing for an epoch, blank fields,
+# LLI flags, values below 1)
+_REF_CRX1 = """\
+1.0                 COMPACT RINEX FORMAT                    CRINEX VERS   / TYPE
+RNX2CRX ver.4.1.0                       19-Oct-26 16:05     CRINEX PROG / DATE
+     2.11           OBSERVATION DATA    M (MIXED)           RINEX VERSION / TYPE
+STAT                                                        MARKER NAME
+     5    C1    L1    L2    P2    S1                        # / TYPES OF OBSERV
+    30.000                                                  INTERVAL
+                                                            END OF HEADER
+&21 12  3  8  0  0.0000000  0  4G01G05G12R07
+3&125000
+3&21234567123 3&111588403391 3&86952002642 3&21234569468 3&40000  5 6 7 8
+3&23456789456 3&123266260570 3&96051631613 3&23456791801 3&41000  6 7 8 5
+3&20987654321 3&110290867859 3&85940935994 3&20987656666 3&42000  7 8 5 6
+3&22345678900 3&117427335189 3&91501819627 3&22345681245 3&43000  8 5 6 7
+                3
+-375000
+3&250 80760436 62930210 15368200 250
+3&-500 -49104628 -38263347 -9344300 250  5
+2644450 13896679  2644450 250
+-19221800 -101011241 -78710057 -19221800 250
+              1 &              5            G20
+1000000
+3&21265304923 7358 5733 1400 0   1 1
+3&23438102256 7358 5734 1400 0  6
+1400 7356 3&85962598888 1400 0      5
+1400 7358 5732 1400 0
+3&25122544500 3&132019862408 3&102872620058 3&25122546845 3&44500  5 6 7 8
+                3              4    12R07G20&&&
+-1500000
+15371000 -2 -1 0 0   & &
+0 2 10840046 0 -1000  6 7 8 5
+0 -2 1 0 -1000  7 8 5 6
+-454000 -2385786 -1859054 -454000 -750  8 5 6 7
+              2 &              5    05G12R07G20
+500000
+1400 1 2 0 0
+3&23419420656 3&123069886201 3&95898612624 3&23419423001 3&42000  6 7 8 5
+0 -1 5733 0 3000  7 8 5 6
+ 1 -1 0 3000    5 6 7
+1400 7357 5733 1400 2000  5 6 7 8
+"""
+
+_REF_RNX2 = """\
+     2.11           OBSERVATION DATA    M (MIXED)           RINEX VERSION / TYPE
+STAT                                                        MARKER NAME
+     5    C1    L1    L2    P2    S1                        # / TYPES OF OBSERV
+    30.000                                                  INTERVAL
+                                                            END OF HEADER
+ 21 12  3  8  0  0.0000000  0  4G01G05G12R07                          .000125000
+  21234567.123 5 111588403.391 6  86952002.642 7  21234569.468 8        40.000
+  23456789.456 6 123266260.570 7  96051631.613 8  23456791.801 5        41.000
+  20987654.321 7 110290867.859 8  85940935.994 5  20987656.666 6        42.000
+  22345678.900 8 117427335.189 5  91501819.627 6  22345681.245 7        43.000
+ 21 12  3  8  0 30.0000000  0  4G01G05G12R07                         -.000250000
+          .250 5 111669163.827 6  87014932.852 7  21249937.668 8        40.250
+         -.500 5 123217155.942 7  96013368.266 8  23447447.501 5        41.250
+  20990298.771 7 110304764.538 8                  20990301.116 6        42.250
+  22326457.100 8 117326323.948 5  91423109.570 6  22326459.445 7        43.250
+ 21 12  3  8  1  0.0000000  0  5G01G05G12R07G20                       .000375000
+  21265304.923 5 111749931.62116  87077868.79517  21265307.268 8        40.500
+  23438102.256 6 123168058.672 7  95975110.653 8  23438104.601 5        41.500
+  20992944.621 7 110318668.573 8  85962598.888 5  20992946.966 6        42.500
+  22307236.700 8 117225320.065 5  91344405.245 6  22307239.045 7        43.500
+  25122544.500 5 132019862.408 6 102872620.058 7  25122546.845 8        44.500
+ 21 12  3  8  1 30.0000000  0  4G01G12R07G20                          .000500000
+  21280675.923 5 111830706.771 6  87140810.470 7  21280678.268 8        40.750
+  20995591.871 6 110332579.966 7  85973438.934 8  20995594.216 5        41.750
+  22288017.700 7 117124323.538 8  91265706.653 5  22288020.045 6        42.750
+  25122090.500 8 132017476.622 5 102870761.004 6  25122092.845 7        43.750
+ 21 12  3  8  2  0.0000000  0  5G01G05G12R07G20                       .000625000
+  21296048.323 5 111911489.278 6  87203757.879 7  21296050.668 8        41.000
+  23419420.656 6 123069886.201 7  95898612.624 8  23419423.001 5        42.000
+  20998240.521 7 110346498.716 8  85984284.713 5  20998242.866 6        43.000
+                 117023334.368 5  91187013.793 6  22268802.445 7        44.000
+  25121637.900 5 132015098.193 6 102868907.683 7  25121640.245 8        45.000
+"""
+
+_REF_CRX3 = """\
+3.0                 COMPACT RINEX FORMAT                    CRINEX VERS   / TYPE
+RNX2CRX ver.4.1.0                       19-Oct-26 16:05     CRINEX PROG / DATE
+     3.04           OBSERVATION DATA    M (MIXED)           RINEX VERSION / TYPE
+STAT                                                        MARKER NAME
+E    3 C1C L1C S1C                                          SYS / # / OBS TYPES
+G    4 C1C L1C L2W C2W                                      SYS / # / OBS TYPES
+R    2 C1C L1C                                              SYS / # / OBS TYPES
+    30.000                                                  INTERVAL
+                                                            END OF HEADER
+> 2021 12 03 08 00  0.0000000  0  5      G01G05G12R07E11
+
+3&21234567123 3&111588403391 3&86952002642 3&21234569468 &5&6&7&8
+3&23456789456 3&123266260570 3&96051631613 3&23456791801 &6&7&8&5
+3&20987654321 3&110290867859 3&85940935994 3&20987656666 &7&8&5&6
+3&22345678900 3&117427335189 &8&5
+3&24567890120 3&129105133969 3&44000 &5&6&&
+                   3
+3&-250000000
+3&250 80760436 62930210 15368200
+-9344300 -49104628 -38263347 -9344300
+2644450 13896679  2644450      &
+-19221800 -101011241
+6675700 35081040 250
+                 1 &              6                     G20
+625000123
+3&21265304923 7358 5733 1400   1 1
+1400 7358 5734 1400
+1400 7356 3&85962598888 1400      5
+1400 7358
+1400 7357 0
+3&25122544500 3&132019862408 3&102872620058 3&25122546845 &6&7&8&5
+                   3              5          12R07E11G20&&&
+
+15371000 -2 -1 0   & &
+0 2 10840046 0  6 7 8 5
+0 -2  7 8
+0 1 -1000  8 5
+-454000 -2385786 -1859054 -454000  5 6 7 8
+                 2 &              6          05G12R07E11G20
+
+1400 1 2 0
+3&23419420656 3&123069886201 3&95898612624 3&23419423001 &6&7&8&5
+0 -1 5733 0  7 8 5 6
+ 1  & 5
+0 -2 3000  5 6
+1400 7357 5733 1400  6 7 8 5
+"""
+
+_REF_RNX3 = """\
+     3.04           OBSERVATION DATA    M (MIXED)           RINEX VERSION / TYPE
+STAT                                                        MARKER NAME
+E    3 C1C L1C S1C                                          SYS / # / OBS TYPES
+G    4 C1C L1C L2W C2W                                      SYS / # / OBS TYPES
+R    2 C1C L1C                                              SYS / # / OBS TYPES
+    30.000                                                  INTERVAL
+                                                            END OF HEADER
+> 2021 12 03 08 00  0.0000000  0  5
+G01  21234567.123 5 111588403.391 6  86952002.642 7  21234569.468 8
+G05  23456789.456 6 123266260.570 7  96051631.613 8  23456791.801 5
+G12  20987654.321 7 110290867.859 8  85940935.994 5  20987656.666 6
+R07  22345678.900 8 117427335.189 5
+E11  24567890.120 5 129105133.969 6        44.000
+> 2021 12 03 08 00 30.0000000  0  5       -.000250000000
+G01          .250 5 111669163.827 6  87014932.852 7  21249937.668 8
+G05  23447445.156 6 123217155.942 7  96013368.266 8  23447447.501 5
+G12  20990298.771 7 110304764.538 8                  20990301.116 6
+R07  22326457.100 8 117326323.948 5
+E11  24574565.820 5 129140215.009 6        44.250
+> 2021 12 03 08 01  0.0000000  0  6        .000375000123
+G01  21265304.923 5 111749931.62116  87077868.79517  21265307.268 8
+G05  23438102.256 6 123168058.672 7  95975110.653 8  23438104.601 5
+G12  20992944.621 7 110318668.573 8  85962598.888 5  20992946.966 6
+R07  22307236.700 8 117225320.065 5
+E11  24581242.920 5 129175303.406 6        44.500
+G20  25122544.500 6 132019862.408 7 102872620.058 8  25122546.845 5
+> 2021 12 03 08 01 30.0000000  0  5
+G01  21280675.923 5 111830706.771 6  87140810.470 7  21280678.268 8
+G12  20995591.871 6 110332579.966 7  85973438.934 8  20995594.216 5
+R07  22288017.700 7 117124323.538 8
+E11  24587921.420 8 129210399.161 5        43.750
+G20  25122090.500 5 132017476.622 6 102870761.004 7  25122092.845 8
+> 2021 12 03 08 02  0.0000000  0  6
+G01  21296048.323 5 111911489.278 6  87203757.879 7  21296050.668 8
+G05  23419420.656 6 123069886.201 7  95898612.624 8  23419423.001 5
+G12  20998240.521 7 110346498.716 8  85984284.713 5  20998242.866 6
+R07                 117023334.368 5
+E11  24594601.320 5 129245502.272 6        45.000
+G20  25121637.900 6 132015098.193 7 102868907.683 8  25121640.245 5
+"""
+
+
+def test():
+  import datetime as dt
+  import tempfile
+  import shutil
+  import time
+  import numpy as np
+  from Modules.rinex_obs_merge import Obs_epoch, format_epoch, format_types, _time
+
+  rng = np.random.default_rng(3)
+
+  def fixture(fn, version, n_epochs):
+    # 30 s RINEX observation file: smooth ranges/phases, satellites rising
+    # and setting, missing observations, LLI/SSI flags and clock offsets
+    types = ['C1', 'L1', 'P2', 'L2', 'S1', 'D1'] if version < 3.0 else ['C1C', 'L1C', 'C2W', 'L2W', 'S1C']
+    svs = [f'G{p:2d}' if version >= 3.0 and p < 10 else f'G{p:02}' for p in range(1, 17)] + ['R07', 'E11']
+    systems = {'' if version < 3.0 else sv[0] for sv in svs}
+    obs_types = {s: types for s in sorted(systems)}
+    hdr = [f'{version:9.2f}           OBSERVATION DATA    M (MIXED)'.ljust(60) + 'RINEX VERSION / TYPE',
+           'STATION'.ljust(60) + 'MARKER NAME'] + format_types(version, obs_types) + \
+          ['    30.000'.ljust(60) + 'INTERVAL', ' '*60 + 'END OF HEADER']
+    r0 = rng.uniform(2e7, 2.5e7, len(svs))
+    rate = rng.uniform(-800, 800, len(svs))
+    with open(fn, 'w') as fh:
+      fh.write('\n'.join(hdr) + '\n')
+      for i in range(n_epochs):
+        t = dt.datetime(2021, 12, 3) + dt.timedelta(seconds=30*i)
+        date = (t.year, t.month, t.day, t.hour, t.minute, float(t.second))
+        obs = {}
+        for k, sv in enumerate(svs):
+          if (i//40 + k) % 7 == 0:
+            continue
+          r = r0[k] + rate[k]*30*i + 0.5*(30*i)**2*1e-3
+          vals = [r + rng.normal(0, 0.3), r/0.19 + 0.001*i, r + 2.1, r/0.244, 45.0 + k, -rate[k]/0.19]
+          fields = []
+          for j in range(len(types)):
+            if (i + j*k) % 53 == 0:
+              fields.append(' '*16)
+              continue
+            lli = '1' if (i + k) % 97 == 0 and j in (1, 3) else ' '
+            fields.append(f'{round(vals[j], 3):14.3f}{lli}{(k + j) % 9 + 1}')
+          obs[sv] = fields
+        clock = f'{1e-4*np.sin(i/50):.9f}' if version < 3.0 else ''
+        text = format_epoch(Obs_epoch(_time(date), date, 0, clock, obs), version, obs_types)
+        if clock != '':
+          # Clock written as CRX2RNX does, without the 0 before the point
+          text = text[:68] + text[68:80].replace(' 0.', '  .').replace('-0.', ' -.') + text[80:]
+        fh.write(text)
+    return fn
+
+  tmp = tempfile.mkdtemp()
+  try:
+    # Files of the reference RNX2CRX give the RINEX of CRX2RNX, byte for byte
+    for crx_text, rnx_text in ((_REF_CRX1, _REF_RNX2), (_REF_CRX3, _REF_RNX3)):
+      crx = os.path.join(tmp, 'REF.crx')
+      with open(crx, 'w') as dst:
+        dst.write(crx_text)
+      with Crx_file(crx) as fh:
+        assert ''.join(fh) == rnx_text
+      assert sum(1 for _ in read_crx(crx)[1]) == 5
+      # and that RINEX is encoded as RNX2CRX does (but the program line)
+      ours = list(rnx_to_crx_lines(iter(rnx_text.splitlines(True))))
+      ref = crx_text.splitlines(True)
+      assert ours[:1] + ours[2:] == ref[:1] + ref[2:]
+
+    for version in (2.11, 3.04):
+      rnx = fixture(os.path.join(tmp, f'STAT{int(version)}.rnx'), version, 2880)
+      with open(rnx) as src:
+        text = src.read()
+      crx = os.path.join(tmp, f'STAT{int(version)}.crx.gz')
+      with gzip.open(crx, 'wt') as dst:
+        dst.writelines(rnx_to_crx_lines(iter(text.splitlines(True))))
+
+      now = time.perf_counter()
+      with Crx_file(crx) as fh:
+        back = ''.join(fh)
+      t_dec = time.perf_counter() - now
+      assert back == text
+      header, epochs = read_crx(crx)
+      assert sum(1 for _ in epochs) == 2880
+      print(f'CRINEX {1 if version < 3.0 else 3}: {len(text)/1e6:.1f} MB RINEX, {os.path.getsize(crx)/1e3:.0f} kB '
+            f'.crx.gz, decoded in {t_dec:.2f} s')
+
+    files = []
+    for k in range(4):
+      files.append(shutil.copy(os.path.join(tmp, 'STAT3.crx.gz'), os.path.join(tmp, f'S{k}.crx.gz')))
+    now = time.perf_counter()
+    out = decompress_files(files, max_workers=4)
+    assert out[2] == os.path.join(tmp, 'S2.rnx') and open(out[2]).read() == open(os.path.join(tmp, 'STAT3.rnx')).read()
+    print(f'{len(files)} files decompressed in parallel in {time.perf_counter() - now:.2f} s')
+
+    # Merged straight from the compressed files
+    from Modules.rinex_obs_merge import merge_obs
+    report = merge_obs(files[:2], os.path.join(tmp, 'merged.rnx'))
+    assert report['epochs'] == 2880 and report['duplicates'] == 2880
+  finally:
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  test()
@@ -0,0 +1,192 @@
+###############################################################################
+# File:  dop_incremental.py
+#
+# Description:
+# Incremental DOP for many streams of epochs at once (every point of a
+# planning grid along time, dop_planning.dop_stream). Between consecutive epochs the visible set
+# usually changes by zero or one satellite, so instead of building G^T G and
+# inverting it at every epoch, Q = (G^T G)^-1 is kept per stream and updated
+# with Sherman-Morrison rank-one terms for the satellites that enter or
+# leave:
+#
+#   enter g:  Q <- Q - (Q g)(Q g)^T / (1 + g^T Q g)
+#   leave g:  Q <- Q + (Q g)(Q g)^T / (1 - g^T Q g)
+#
+# The rows g of the satellites already in view are frozen between two
+# refreshes of the geometry (every `refresh_every` epochs), where Q is
+# re-factorized from the current rows. A stream is also re-factorized at
+# once when an update is badly conditioned (|denominator| < min_denominator
+# or trace(Q) > max_trace), or when it comes back to 4 satellites or more.
+#
+# With refresh_every = 1 the result is the full inversion of every epoch.
+# Between refreshes only the visibility is needed for all satellites: the
+# rows can be given as a function, called for the entering satellites and
+# the re-factorized streams only.
+#
+# The updates are vectorized over the streams: for a single stream (one
+# track) the numpy call overhead of an epoch exceeds a 4x4 inversion, and
+# Calc_gdop is faster.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+
+
+class Incremental_dop:
+  def __init__(self, refresh_every: int = 10, min_denominator: float = 1e-3,
+               max_trace: float = 1e4):
+    self.refresh_every = refresh_every
+    self.min_denominator = min_denominator
+    self.max_trace = max_trace
+
+    self.Q = None           # (P, 4, 4) inverse normal matrices
+    self.G = None           # (P, S, 4) rows used in Q (frozen geometry)
+    self.visible = None     # (P, S) satellites in Q
+    self.valid = None       # (P,) Q defined (4 satellites or more)
+    self.epochs = 0
+
+    # Counters: full re-factorizations (streams) and rank-one updates
+    self.n_full = 0
+    self.n_rank1 = 0
+
+  def update(self, G, visible) -> np.ndarray:
+    """
+      Next epoch of all streams. G (P, S, 4) are the geometry rows of all
+      satellites, or a function G(points, sats) returning the rows of
+      G[points][:, sats] (only called for the satellites entering the view
+      and for the streams re-factorized). visible (P, S) are the satellites
+      in view. Returns Q (P, 4, 4), NaN for streams with fewer than 4
+      satellites.
+    """
+    if not callable(G):
+      G_all = np.asarray(G, dtype=float)
+      G = lambda points, sats: G_all[points][:, sats]
+    visible = np.asarray(visible, dtype=bool)
+    if self.Q is None or self.epochs % self.refresh_every == 0 or visible.shape != self.visible.shape:
+      self.__factorize(G, visible, np.ones(len(visible), dtype=bool))
+      self.epochs += 1
+      return self.__output()
+    self.epochs += 1
+
+    changed = visible != self.visible
+    redo = self.valid != (np.count_nonzero(visible, axis=1) >= 4)
+    redo |= ~self.valid & np.any(changed, axis=1)
+
+    # Satellites entering first, so a set of 4 losing one and gaining one
+    # never goes through a singular Q
+    for sign in (1.0, -1.0):
+      for s in np.flatnonzero(np.any(changed & ~redo[:, None], axis=0)):
+        rows = np.flatnonzero(changed[:, s] & ~redo & (visible[:, s] == (sign > 0)))
+        if len(rows) == 0:
+          continue
+        g = G(rows, [s])[:, 0] if sign > 0 else self.G[rows, s]
+        Q = self.Q[rows]
+        Qg = np.einsum('pij,pj->pi', Q, g)
+        den = 1.0 + sign*np.einsum('pi,pi->p', g, Qg)
+        bad = np.abs(den) < self.min_denominator
+        ok = rows[~bad]
+        self.Q[ok] = Q[~bad] - sign*Qg[~bad, :, None]*Qg[~bad, None, :]/den[~bad, None, None]
+        self.G[ok, s] = g[~bad]
+        self.visible[ok, s] = visible[ok, s]
+        redo[rows[bad]] = True
+        self.n_rank1 += len(ok)
+
+    tr = np.trace(self.Q, axis1=1, axis2=2)
+    redo |= self.valid & ~((tr > 0) & (tr < self.max_trace))
+    if np.any(redo):
+      self.__factorize(G, visible, redo)
+    return self.__output()
+
+  def __factorize(self, G, visible, rows) -> None:
+    if self.Q is None or visible.shape != self.visible.shape:
+      P, S = visible.shape
+      self.Q = np.zeros((P, 4, 4))
+      self.G = np.zeros((P, S, 4))
+      self.visible = np.zeros((P, S), dtype=bool)
+      self.valid = np.zeros(P, dtype=bool)
+    G_rows = G(slice(None) if np.all(rows) else np.flatnonzero(rows), slice(None))
+    Gv = np.where(visible[rows, :, None], G_rows, 0.0)
+    A = np.swapaxes(Gv, -1, -2)@Gv
+    ok = np.count_nonzero(visible[rows], axis=1) >= 4
+    A[~ok] = np.eye(4)
+    try:
+      Q = np.linalg.inv(A)
+    except np.linalg.LinAlgError:
+      Q = np.linalg.pinv(A)
+    self.Q[rows] = Q
+    self.G[rows] = G_rows
+    self.visible[rows] = visible[rows]
+    self.valid[rows] = ok
+    self.n_full += int(np.count_nonzero(rows))
+
+  def __output(self) -> np.ndarray:
+    Q = self.Q.copy()
+    Q[~self.valid] = np.nan
+    return Q
+
+
+def test():
+  import time
+
+  # 2000 streams over 600 epochs of 12 satellites rising and setting
+  rng = np.random.default_rng(5)
+  P, S, T = 2000, 12, 600
+  az0 = rng.uniform(0, 2*np.pi, (P, S))
+  el0 = rng.uniform(-0.3, 1.4, (P, S))
+  rate = rng.uniform(-1e-4, 1e-4, (P, S))
+  rise = rng.uniform(0, T, (P, S))
+
+  def epoch(k, drift=1.0):
+    # Elevations drift, each satellite crosses the mask once
+    el = el0 + drift*rate*k
+    az = az0 + drift*0.5*rate*k
+    e = np.stack([np.cos(el)*np.sin(az), np.cos(el)*np.cos(az), np.sin(el)], axis=-1)
+    G = np.concatenate([-e, np.ones((P, S, 1))], axis=-1)
+    return G, (el > 0.0873) != (k > rise)
+
+  def full(G, vis):
+    Gv = np.where(vis[..., None], G, 0.0)
+    A = np.swapaxes(Gv, -1, -2)@Gv
+    ok = np.count_nonzero(vis, axis=1) >= 4
+    A[~ok] = np.eye(4)
+    Q = np.linalg.inv(A)
+    Q[~ok] = np.nan
+    return Q
+
+  def gdop(Q):
+    return np.sqrt(np.trace(Q, axis1=1, axis2=2))
+
+  # Fixed geometry: the rank-one updates give the full inversion
+  inc = Incremental_dop(refresh_every=T)
+  for k in range(0, T, 3):
+    G, vis = epoch(k, drift=0.0)
+    Q = inc.update(G, vis)
+    assert np.allclose(Q, full(G, vis), rtol=1e-6, atol=1e-9, equal_nan=True)
+  assert inc.n_rank1 > 0
+
+  # Moving geometry: exact at the refreshes, drift error in between
+  for refresh in (1, 10, 30):
+    inc = Incremental_dop(refresh_every=refresh)
+    err = 0.0
+    t_inc = t_full = 0.0
+    for k in range(T):
+      G, vis = epoch(k)
+      now = time.perf_counter()
+      Q = inc.update(G, vis)
+      t_inc += time.perf_counter() - now
+      now = time.perf_counter()
+      Qf = full(G, vis)
+      t_full += time.perf_counter() - now
+      gd, gdf = gdop(Q), gdop(Qf)
+      assert np.array_equal(np.isnan(gd), np.isnan(gdf))
+      m = np.isfinite(gdf) & (gdf < 10)
+      err = max(err, np.max(np.abs(gd[m] - gdf[m])/gdf[m]))
+      if k % refresh == 0:
+        assert np.allclose(gd[m], gdf[m])
+    print(f'refresh every {refresh:2d}: {inc.n_full} factorizations, {inc.n_rank1} rank-one updates, '
+          f'max GDOP error {err:.2%}, {t_inc:.2f} s (full inversion {t_full:.2f} s)')
+    assert err < (1e-9 if refresh == 1 else 0.05)
+
+if __name__ == '__main__':
+  test()
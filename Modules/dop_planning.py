@@ -0,0 +1,408 @@
+###############################################################################
+# File:  dop_planning.py
+#
+# Description:
+# Mission planning: predicted satellite count and DOP over a survey area for
+# every epoch of a planned time window, before the flight. Calc_manager only
+# evaluates DOP along a flown track, one row and one satellite dict at a
+# time; here the area is a regular lat/lon grid at a fixed altitude and the
+# result is a (epochs, rows, cols) cube per quantity.
+#
+# Satellite positions are taken once per epoch for the whole grid (from
+# reader_rinex.Orbital_data or any (epochs, sats, 3) ECEF array). Grid
+# points and epochs are processed in tiles of at most `chunk_cells`
+# point x epoch x satellite values: line of sight unit vectors, elevation
+# mask and the 4x4 normal matrices G^T G of the whole tile are built with
+# numpy and inverted as one stack. Tiles can run on a thread pool.
+#
+# DOP is expressed in the local east/north/up frame of each grid point:
+#   HDOP = sqrt(qE + qN), VDOP = sqrt(qU), PDOP = sqrt(qE + qN + qU),
+#   TDOP = sqrt(qT), GDOP = sqrt(trace(Q)), Q = (G^T G)^-1
+# Cells with fewer than 4 satellites above the mask are NaN.
+#
+# The cube is saved as .npz (axes and all layers) and single layers can be
+# written as ESRI ASCII grids for GIS tools.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import datetime as dt
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from Modules.ins_nav import LLA_to_ECEF, DTOR, RTOD, a
+from Modules.dop_incremental import Incremental_dop
+from Modules.d_print import Info
+import Modules.common as c
+
+
+DOP_LAYERS = ('ns', 'GDOP', 'PDOP', 'HDOP', 'VDOP', 'TDOP')
+
+# lat (ny,), lon (nx,) (deg), alt (m), times (T,) datetime64[s], then one
+# (T, ny, nx) array per DOP_LAYERS entry
+Dop_cube = namedtuple('Dop_cube', ['lat', 'lon', 'alt', 'times'] + list(DOP_LAYERS))
+
+
+def grid_axes(bbox, spacing: float) -> tuple:
+
+  # Grid axes covering a bounding box
+  #
+  # INPUTS:
+  #   bbox        (lat_min, lon_min, lat_max, lon_max) (deg)
+  #   spacing     Grid spacing (m), the same north and east at the box center
+  #
+  # OUTPUTS
+  #   lat, lon    Axes (deg), increasing
+
+  lat_min, lon_min, lat_max, lon_max = bbox
+  d_lat = spacing/(a*DTOR)
+  d_lon = d_lat/np.cos(0.5*(lat_min + lat_max)*DTOR)
+  lat = lat_min + d_lat*np.arange(int(np.floor((lat_max - lat_min)/d_lat + 1e-9)) + 1)
+  lon = lon_min + d_lon*np.arange(int(np.floor((lon_max - lon_min)/d_lon + 1e-9)) + 1)
+  return lat, lon
+
+
+def time_axis(start, stop, step: float = 60.0) -> np.ndarray:
+  # Epochs from start to stop (datetime or ISO string) every step seconds
+  t0 = np.datetime64(dt.datetime.fromisoformat(start) if isinstance(start, str) else start, 's')
+  t1 = np.datetime64(dt.datetime.fromisoformat(stop) if isinstance(stop, str) else stop, 's')
+  return np.arange(t0, t1 + np.timedelta64(1, 's'), np.timedelta64(int(step), 's'))
+
+
+def sat_positions(orbital_data, times) -> tuple:
+
+  # Satellite positions of a set up reader_rinex.Orbital_data at the epochs
+  #
+  # OUTPUTS
+  #   prns        Satellite ids (S,)
+  #   pos         ECEF positions (T, S, 3) (m)
+
+  iso = [str(t).replace('T', ' ') for t in np.asarray(times, dtype='datetime64[s]')]
+  block = orbital_data.get_sats_pos(iso)
+  return block.prns, block.pos
+
+
+def enu_axes(lat, lon) -> np.ndarray:
+  # East, north and up unit vectors in ECEF at lat/lon (deg), shape (n, 3, 3)
+  la = np.asarray(lat, dtype=float)*DTOR
+  lo = np.asarray(lon, dtype=float)*DTOR
+  sla, cla, slo, clo = np.sin(la), np.cos(la), np.sin(lo), np.cos(lo)
+  east = np.stack([-slo, clo, np.zeros_like(lo)], axis=-1)
+  north = np.stack([-sla*clo, -sla*slo, cla], axis=-1)
+  up = np.stack([cla*clo, cla*slo, sla], axis=-1)
+  return np.stack([east, north, up], axis=-2)
+
+
+def geometry(rx, axes, sat_pos, mask_angle: float = c.LOS_ANGLE) -> tuple:
+
+  # Geometry rows and visibility for points x epochs
+  #
+  # INPUTS:
+  #   rx          Receiver ECEF positions (P, 3) (m)
+  #   axes        enu_axes of the points (P, 3, 3)
+  #   sat_pos     Satellite ECEF positions (T, S, 3) (m), NaN if unavailable
+  #   mask_angle  Elevation mask (deg)
+  #
+  # OUTPUTS
+  #   G           Rows [-e, -n, -u, 1] of the line of sight (T, P, S, 4),
+  #               zero for the satellites below the mask
+  #   visible     Satellites above the mask (T, P, S)
+
+  d = sat_pos[:, None, :, :] - rx[None, :, None, :]
+  los = d/np.linalg.norm(d, axis=-1, keepdims=True)
+  local = los@np.swapaxes(axes, -1, -2)[None]
+  visible = local[..., 2] >= np.sin(mask_angle*DTOR)
+  G = np.concatenate([-local, np.ones(local.shape[:-1] + (1,))], axis=-1)
+  return np.where(visible[..., None], G, 0.0), visible
+
+
+def dop_batch(rx, axes, sat_pos, mask_angle: float = c.LOS_ANGLE) -> tuple:
+
+  # Visible satellites and DOP for points x epochs
+  #
+  # INPUTS:
+  #   rx, axes, sat_pos, mask_angle as in geometry
+  #
+  # OUTPUTS
+  #   ns          Satellites above the mask (T, P)
+  #   q           Diagonal of (G^T G)^-1 in east/north/up/clock (T, P, 4),
+  #               NaN where ns < 4
+
+  G, visible = geometry(rx, axes, sat_pos, mask_angle)
+  ns = np.count_nonzero(visible, axis=-1)
+  A = np.swapaxes(G, -1, -2)@G
+  ok = ns >= 4
+  A[~ok] = np.eye(4)
+  try:
+    Q = np.linalg.inv(A)
+  except np.linalg.LinAlgError:
+    Q = np.linalg.pinv(A)
+  q = np.diagonal(Q, axis1=-2, axis2=-1).copy()
+  q[~ok] = np.nan
+  return ns, q
+
+
+def dop_stream(rx, axes, sat_pos, mask_angle: float = c.LOS_ANGLE,
+               refresh_every: int = 10) -> tuple:
+
+  # dop_batch with the points as streams along the epochs: Q is updated
+  # with rank-one terms when satellites cross the mask and re-factorized
+  # every refresh_every epochs (dop_incremental.Incremental_dop). Between
+  # refreshes only the elevation test is evaluated for all points and
+  # satellites (two (P, 3) x (3, S) products); geometry rows are built
+  # for the satellites crossing the mask only.
+
+  inc = Incremental_dop(refresh_every)
+  ns = np.zeros((len(sat_pos), len(rx)), dtype=int)
+  q = np.zeros((len(sat_pos), len(rx), 4))
+  up = axes[:, 2]
+  rx_up = np.einsum('pj,pj->p', rx, up)
+  rx_2 = np.einsum('pj,pj->p', rx, rx)
+  sin_mask = np.sin(mask_angle*DTOR)
+  for k in range(len(sat_pos)):
+    sat = sat_pos[k]
+    if k % refresh_every == 0:
+      G, visible = geometry(rx, axes, sat[None], mask_angle)
+      G, visible = G[0], visible[0]
+    else:
+      # sin(elevation) >= sin(mask): (sat - rx).up >= sin(mask) |sat - rx|
+      r = np.sqrt(np.maximum(rx_2[:, None] - 2.0*rx@sat.T + np.einsum('sj,sj->s', sat, sat)[None], 0.0))
+      visible = up@sat.T - rx_up[:, None] >= sin_mask*r
+
+      def G(points, sats, sat=sat):
+        return geometry(rx[points], axes[points], sat[sats][None], mask_angle)[0][0]
+    Q = inc.update(G, visible)
+    ns[k] = np.count_nonzero(visible, axis=-1)
+    q[k] = np.diagonal(Q, axis1=-2, axis2=-1)
+  return ns, q
+
+
+def dop_grid(lat, lon, alt: float, times, sat_pos, mask_angle: float = c.LOS_ANGLE,
+             chunk_cells: float = 1e6, workers: int = 0, refresh_every: int = 0) -> Dop_cube:
+
+  # Predicted satellite count and DOP over a grid and time window
+  #
+  # INPUTS:
+  #   lat, lon      Grid axes (deg), see grid_axes
+  #   alt           Altitude of the grid (m)
+  #   times         Epochs (T,), see time_axis
+  #   sat_pos       Satellite ECEF positions at the epochs (T, S, 3) (m)
+  #   mask_angle    Elevation mask (deg)
+  #   chunk_cells   Maximum point x epoch x satellite values per tile
+  #   workers       Threads for the tiles (0: run in the calling thread)
+  #   refresh_every Incremental DOP along the epochs (dop_stream) with the
+  #                 geometry refreshed every refresh_every epochs; 0 inverts
+  #                 every cell
+  #
+  # OUTPUTS
+  #   Dop_cube
+
+  lat = np.asarray(lat, dtype=float)
+  lon = np.asarray(lon, dtype=float)
+  sat_pos = np.asarray(sat_pos, dtype=float)
+  T, S = sat_pos.shape[:2]
+  glat, glon = np.meshgrid(lat, lon, indexing='ij')
+  glat, glon = glat.ravel(), glon.ravel()
+  P = len(glat)
+  rx = np.stack([np.ravel(v) for v in LLA_to_ECEF(glat*DTOR, glon*DTOR, np.full(P, float(alt)))], axis=-1)
+  axes = enu_axes(glat, glon)
+
+  # Tiles: all epochs for a block of points if it fits, else epoch blocks.
+  # Streams need all epochs of their points.
+  if refresh_every > 0:
+    n_pts = int(max(1, min(P, chunk_cells//max(S, 1))))
+    n_eps = T
+  else:
+    n_pts = int(max(1, min(P, chunk_cells//max(T*S, 1))))
+    n_eps = int(max(1, min(T, chunk_cells//max(n_pts*S, 1))))
+  tiles = [(slice(i, min(i + n_pts, P)), slice(j, min(j + n_eps, T)))
+           for i in range(0, P, n_pts) for j in range(0, T, n_eps)]
+
+  ns = np.zeros((T, P), dtype=np.int16)
+  q = np.full((T, P, 4), np.nan)
+
+  def run(tile):
+    ps, ts = tile
+    if refresh_every > 0:
+      ns[ts, ps], q[ts, ps] = dop_stream(rx[ps], axes[ps], sat_pos[ts], mask_angle, refresh_every)
+    else:
+      ns[ts, ps], q[ts, ps] = dop_batch(rx[ps], axes[ps], sat_pos[ts], mask_angle)
+
+  now = time.perf_counter()
+  if workers > 0:
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      list(pool.map(run, tiles))
+  else:
+    for tile in tiles:
+      run(tile)
+  Info(f'DOP grid {len(lat)}x{len(lon)} points, {T} epochs, {S} satellites: '
+       f'{len(tiles)} tiles in {time.perf_counter() - now:.2f} s')
+
+  shape = (T, len(lat), len(lon))
+  layers = {'ns': ns.reshape(shape),
+            'GDOP': np.sqrt(q.sum(axis=-1)),
+            'PDOP': np.sqrt(q[..., :3].sum(axis=-1)),
+            'HDOP': np.sqrt(q[..., 0] + q[..., 1]),
+            'VDOP': np.sqrt(q[..., 2]),
+            'TDOP': np.sqrt(q[..., 3])}
+  for k in DOP_LAYERS[1:]:
+    layers[k] = layers[k].reshape(shape)
+  return Dop_cube(lat, lon, float(alt), np.asarray(times, dtype='datetime64[s]'),
+                  **{k: layers[k] for k in DOP_LAYERS})
+
+
+def plan_dop(bbox, spacing: float, alt: float, start, stop, step: float = 60.0,
+             orbital_data = None, mask_angle: float = c.LOS_ANGLE,
+             chunk_cells: float = 1e6, workers: int = 0, refresh_every: int = 0) -> Dop_cube:
+
+  # Planning cube for an area and time window
+  #
+  # INPUTS:
+  #   bbox            (lat_min, lon_min, lat_max, lon_max) (deg)
+  #   spacing         Grid spacing (m)
+  #   alt             Flight altitude (m)
+  #   start, stop     Time window (datetime or ISO string, UTC)
+  #   step            Epoch interval (sec)
+  #   orbital_data    reader_rinex.Orbital_data of the day (set up for
+  #                   `start` if None)
+  #   mask_angle, chunk_cells, workers, refresh_every as in dop_grid
+  #
+  # OUTPUTS
+  #   Dop_cube
+
+  lat, lon = grid_axes(bbox, spacing)
+  times = time_axis(start, stop, step)
+  if orbital_data is None:
+    import Modules.reader_rinex as rr
+    orbital_data = rr.Orbital_data()
+    orbital_data.setup(str(times[0]).replace('T', ' '))
+  _, pos = sat_positions(orbital_data, times)
+  return dop_grid(lat, lon, alt, times, pos, mask_angle, chunk_cells, workers, refresh_every)
+
+
+def save_cube(fn: str, cube: Dop_cube) -> None:
+  # All axes and layers in one .npz file
+  np.savez_compressed(fn, **cube._asdict())
+
+
+def load_cube(fn: str) -> Dop_cube:
+  with np.load(fn) as z:
+    d = {k: z[k] for k in Dop_cube._fields}
+  d['alt'] = float(d['alt'])
+  return Dop_cube(**d)
+
+
+def write_ascii_grid(fn: str, cube: Dop_cube, layer: str = 'GDOP', epoch: int = None,
+                     reduce: str = 'max', nodata: float = -9999.0) -> None:
+
+  # One layer as an ESRI ASCII grid (lat/lon cells, first row north)
+  #
+  # INPUTS:
+  #   fn          Output .asc file
+  #   cube        Dop_cube
+  #   layer       Layer name (DOP_LAYERS)
+  #   epoch       Epoch index, or None for a reduction over the window
+  #   reduce      'max', 'min' or 'mean' when epoch is None
+
+  values = np.asarray(getattr(cube, layer), dtype=float)
+  if epoch is not None:
+    grid = values[epoch]
+  else:
+    grid = {'max': np.nanmax, 'min': np.nanmin, 'mean': np.nanmean}[reduce](values, axis=0)
+  grid = np.where(np.isfinite(grid), grid, nodata)[::-1]
+
+  d_lat = cube.lat[1] - cube.lat[0] if len(cube.lat) > 1 else 1.0
+  d_lon = cube.lon[1] - cube.lon[0] if len(cube.lon) > 1 else d_lat
+  with open(fn, 'w') as fh:
+    fh.write(f'ncols {len(cube.lon)}\nnrows {len(cube.lat)}\n'
+             f'xllcorner {cube.lon[0] - d_lon/2:.9f}\nyllcorner {cube.lat[0] - d_lat/2:.9f}\n'
+             f'dx {d_lon:.9f}\ndy {d_lat:.9f}\nNODATA_value {nodata}\n')
+    np.savetxt(fh, grid, fmt='%.3f')
+
+
+def test():
+  import tempfile
+  import os
+
+  # 24 satellites in 6 circular orbits (55 deg), Earth rotation applied
+  def constellation(times):
+    t = (times - times[0]).astype(float)
+    r = 26560e3
+    n = 2*np.pi/43082.0
+    pos = np.zeros((len(t), 24, 3))
+    for k in range(24):
+      plane, slot = k//4, k % 4
+      raan = plane*60*DTOR - 7.2921151467e-5*t
+      u = slot*90*DTOR + plane*15*DTOR + n*t
+      x, y = r*np.cos(u), r*np.sin(u)
+      inc = 55*DTOR
+      pos[:, k] = np.stack([x*np.cos(raan) - y*np.cos(inc)*np.sin(raan),
+                            x*np.sin(raan) + y*np.cos(inc)*np.cos(raan),
+                            y*np.sin(inc)], axis=-1)
+    return pos
+
+  bbox = (60.30, 5.20, 60.50, 5.50)
+  lat, lon = grid_axes(bbox, 500.0)
+  times = time_axis('2021-12-03 08:00:00', '2021-12-03 10:00:00', 60)
+  pos = constellation(times)
+  pos[:, 3] = np.nan
+
+  now = time.perf_counter()
+  cube = dop_grid(lat, lon, 300.0, times, pos, chunk_cells=2e6)
+  t_grid = time.perf_counter() - now
+  n_eval = len(times)*len(lat)*len(lon)
+  assert cube.GDOP.shape == (121, len(lat), len(lon)) and np.all(cube.ns >= 4)
+
+  # Reference: one point and epoch at a time
+  for ti, i, j in ((0, 0, 0), (60, 10, 20), (120, len(lat) - 1, len(lon) - 1)):
+    u = np.ravel(LLA_to_ECEF(lat[i]*DTOR, lon[j]*DTOR, 300.0))
+    R = enu_axes(lat[i], lon[j])
+    rows = []
+    for s in pos[ti]:
+      if np.any(np.isnan(s)):
+        continue
+      e = R@((s - u)/np.linalg.norm(s - u))
+      if np.arcsin(e[2])*RTOD >= c.LOS_ANGLE:
+        rows.append([-e[0], -e[1], -e[2], 1.0])
+    Q = np.linalg.inv(np.array(rows).T@np.array(rows))
+    assert cube.ns[ti, i, j] == len(rows)
+    assert np.isclose(cube.GDOP[ti, i, j], np.sqrt(np.trace(Q)))
+    assert np.isclose(cube.HDOP[ti, i, j], np.sqrt(Q[0, 0] + Q[1, 1]))
+
+  # Threads and tile size do not change the result
+  cube2 = dop_grid(lat, lon, 300.0, times, pos, chunk_cells=1e5, workers=2)
+  assert np.array_equal(cube.ns, cube2.ns) and np.allclose(cube.GDOP, cube2.GDOP)
+
+  # Incremental along the epochs, geometry refreshed every 3 minutes
+  now = time.perf_counter()
+  inc = dop_grid(lat, lon, 300.0, times, pos, refresh_every=3)
+  t_inc = time.perf_counter() - now
+  assert np.array_equal(cube.ns, inc.ns)
+  err = np.nanmax(np.abs(inc.GDOP - cube.GDOP)/cube.GDOP)
+  assert np.allclose(inc.GDOP[::3], cube.GDOP[::3]) and err < 0.05
+  print(f'incremental: {t_inc:.2f} s ({t_grid/t_inc:.1f}x faster), max GDOP error {err:.2%}')
+  assert t_inc < t_grid
+
+  # Below 4 satellites: NaN
+  few = dop_grid(lat[:2], lon[:2], 300.0, times[:1], pos[:1, :5])
+  assert np.all(np.isnan(few.GDOP[few.ns < 4]))
+
+  tmp = tempfile.mkdtemp()
+  try:
+    fn = os.path.join(tmp, 'plan.npz')
+    save_cube(fn, cube)
+    back = load_cube(fn)
+    assert np.array_equal(back.times, cube.times) and np.allclose(back.PDOP, cube.PDOP)
+    write_ascii_grid(os.path.join(tmp, 'gdop_max.asc'), cube)
+    with open(os.path.join(tmp, 'gdop_max.asc')) as fh:
+      assert fh.readline().split() == ['ncols', str(len(lon))]
+  finally:
+    import shutil
+    shutil.rmtree(tmp)
+  print(f'{n_eval} point-epochs ({len(lat)}x{len(lon)}x{len(times)}) in {t_grid:.2f} s, '
+        f'GDOP {np.nanmin(cube.GDOP):.2f}-{np.nanmax(cube.GDOP):.2f}')
+
+
+if __name__ == '__main__':
+  test()
@@ -0,0 +1,366 @@
+###############################################################################
+# File:  ekf_stream.py
+#
+# Description:
+# Streaming form of the loosely coupled GNSS/INS EKF of lc_ins_gnss. IMU and
+# GNSS messages are consumed one at a time from two time-ordered sources
+# (iterators or asyncio queues) and a navigation state is produced for each
+# message, so fusion can run while a log is replayed or data arrive from a
+# socket.
+#
+# A GNSS update is applied at the GNSS time stamp: if it falls between two
+# IMU samples, the mechanization is first advanced to that time with the last
+# IMU measurement held, then corrected. The next IMU sample continues from
+# the GNSS time. No fixed GNSS rate is assumed.
+#
+# With GNSS time stamps on IMU sample times (profile_messages), the output is
+# the same as run_LC_EKF on the same profile.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import math as ma
+import heapq
+import time as tm
+from collections import deque, namedtuple
+from Modules.ins_nav import (RTOD, DTOR, Euler_to_CTM, CTM_to_Euler,
+                             LLA_to_ECEF, ECEF_to_NED, LLA_to_NED,
+                             INS_Equations_NED)
+from Modules.ins_ekf import (Get_dem_EKF_matrices, Get_meas_matrices,
+                             initialize_P_EKF, prediction_step,
+                             correction_step, innovation, correct_NED_errors,
+                             Block_cov_propagator)
+
+
+# time (sec), gyro (rad/sec, 3), accel (m/sec^2, 3)
+IMU_msg = namedtuple('IMU_msg', ['time', 'gyro', 'accel'])
+# time (sec), lat/lon (rad), alt (m), NED velocity (m/sec, 3)
+GNSS_msg = namedtuple('GNSS_msg', ['time', 'lat', 'lon', 'alt', 'vel'])
+# source ('imu' or 'gnss'), output row in the out_profile_data layout,
+# processing time of the message (sec)
+Nav_state = namedtuple('Nav_state', ['source', 'row', 'latency'])
+
+
+class LC_EKF_stream:
+  def __init__(self, KF_param, first_fix: GNSS_msg, init_rpy,
+               cov_decimation: int = 0,
+               heading_range: float = 10.0,
+               max_track: int = 100000):
+    self.KF_param = KF_param
+    self.heading_range = heading_range
+    self.max_track = max_track
+
+    # Navigation solution initialized to the first GNSS reading
+    self.time = first_fix.time
+    self.latR = first_fix.lat
+    self.longR = first_fix.lon
+    self.alt = first_fix.alt
+    self.prev_latR = self.latR    # latitude before the last step
+    self.v_eb_n = np.array(first_fix.vel, dtype=float)
+    self.C_b_n = Euler_to_CTM(np.asarray(init_rpy, dtype=float))
+    self.IMU_bias = np.array([KF_param.init_accel_bias.T,
+                              KF_param.init_gyro_bias.T], dtype=float)
+
+    # NED frame ECEF reference
+    self.latR_base = self.latR
+    self.longR_base = self.longR
+    self.alt_base = 0.0
+    self.ECEF_ref = np.array(LLA_to_ECEF(self.latR_base, self.longR_base, self.alt_base))
+
+    self.P = initialize_P_EKF(KF_param)
+    self.H, self.R = Get_meas_matrices(KF_param)
+    self.prop = (Block_cov_propagator(KF_param, self.P, cov_decimation) if cov_decimation > 0 else None)
+
+    # Last raw IMU sample, held when stepping to a GNSS time
+    self.gyro = np.zeros(3)
+    self.accel = np.zeros(3)
+
+    # Heading from the track: positions not yet 10 m behind, and the last
+    # one that was
+    self.track = deque()
+    self.track_last = np.zeros(2)
+    self.heading = 0.0
+    self.ned = np.array([0.0, 0.0, -self.alt])
+    self.pending = True    # current state not yet added to the track
+
+    self.n_imu = 0
+    self.n_gnss = 0
+
+  def row(self) -> np.ndarray:
+    """
+      Current state in the out_profile_data layout.
+    """
+    row = np.zeros(19)
+    row[0] = self.time
+    row[1:4] = CTM_to_Euler(self.C_b_n)*RTOD
+    if self.n_imu + self.n_gnss > 0:
+      row[3] = (row[3] + 360) % 360
+    row[4:7] = self.v_eb_n
+    row[7] = self.latR*RTOD
+    row[8] = self.longR*RTOD
+    row[9] = self.alt
+    row[10:13] = self.ned
+    row[13:16] = self.IMU_bias[0]
+    row[16:19] = self.IMU_bias[1]
+    return row
+
+  def imu(self, msg: IMU_msg):
+    """
+      Mechanize up to the time of an IMU sample. Returns a Nav_state, or
+      None if the sample is not later than the current state.
+    """
+    now = tm.perf_counter()
+    tor_i = msg.time - self.time
+    self.gyro = np.asarray(msg.gyro, dtype=float)
+    self.accel = np.asarray(msg.accel, dtype=float)
+    if tor_i <= 0.0:
+      return None
+
+    self.__step(tor_i)
+    self.n_imu += 1
+    return Nav_state('imu', self.row(), tm.perf_counter() - now)
+
+  def gnss(self, msg: GNSS_msg):
+    """
+      Correct the solution with a GNSS fix, at the fix time.
+    """
+    now = tm.perf_counter()
+    if msg.time > self.time:
+      self.__step(msg.time - self.time)
+    old_latR = self.prev_latR
+
+    # Compute INS and GNSS solutions in NED frame
+    xE, yE, zE = LLA_to_ECEF(self.latR, self.longR, self.alt)
+    est_ned = ECEF_to_NED(np.array([xE, yE, zE]), self.latR_base, self.longR_base, self.alt_base)
+    xE, yE, zE = LLA_to_ECEF(msg.lat, msg.lon, msg.alt)
+    GNSS_ned = ECEF_to_NED(np.array([xE, yE, zE]), self.latR_base, self.longR_base, self.alt_base)
+    meas_v_eb_n = np.asarray(msg.vel, dtype=float)
+
+    # Compute correction step for errors
+    if self.prop is not None:
+      self.P = self.prop.propagate()
+    self.P, K = correction_step(self.P, self.H, self.R)
+    if self.prop is not None:
+      self.prop.reset(self.P)
+    delta_x = innovation(K, est_ned, GNSS_ned, self.v_eb_n, meas_v_eb_n)
+
+    # Update INS solution with estimated errors
+    self.latR, self.longR, self.alt, self.v_eb_n, self.C_b_n, self.IMU_bias = correct_NED_errors(
+      delta_x, self.C_b_n, self.IMU_bias, old_latR, self.latR, self.longR,
+      self.alt, msg.alt, self.v_eb_n, meas_v_eb_n[2])
+    self.__update_ned()
+
+    self.n_gnss += 1
+    return Nav_state('gnss', self.row(), tm.perf_counter() - now)
+
+  def __step(self, tor_i) -> None:
+    # INS mechanization and covariance prediction over tor_i with the held
+    # IMU sample
+    self.__close_state()
+
+    meas_f_ib_b = self.accel + self.IMU_bias[0]
+    meas_omega_ib_b = self.gyro + self.IMU_bias[1]
+
+    C_b_n, v_eb_n, latR, longR, alt = INS_Equations_NED(tor_i, self.latR, self.longR, self.alt, self.v_eb_n, self.C_b_n, meas_omega_ib_b, meas_f_ib_b, self.heading*DTOR)
+
+    if self.prop is None:
+      A, F, Q, H, R = Get_dem_EKF_matrices(self.KF_param, tor_i, self.latR, self.alt,
+                                           self.v_eb_n, self.C_b_n, meas_f_ib_b)
+      self.P = prediction_step(F, self.P, Q)
+    else:
+      self.prop.add_sample(tor_i, self.latR, self.alt, self.v_eb_n, self.C_b_n, meas_f_ib_b)
+
+    self.prev_latR = self.latR
+    self.time += tor_i
+    self.C_b_n, self.v_eb_n, self.latR, self.longR, self.alt = C_b_n, v_eb_n, latR, longR, alt
+    self.__update_ned()
+    self.pending = True
+
+  def __update_ned(self) -> None:
+    xE, yE, zE = LLA_to_ECEF(self.latR, self.longR, self.alt)
+    self.ned = LLA_to_NED(self.latR_base, self.longR_base, self.alt_base, np.array([xE, yE, zE]), self.ECEF_ref)[:, 0]
+
+  def __close_state(self) -> None:
+    # The current state is final once the next step starts: update the track
+    # heading from it, as run_LC_EKF does after the GNSS correction
+    if not self.pending:
+      return
+    if self.n_imu + self.n_gnss > 0:
+      P_n = self.ned[0:2]
+      while len(self.track) > 0 and ma.dist(self.track[0], P_n) > self.heading_range:
+        self.track_last = self.track.popleft()
+      NorthD = self.track_last[0] - P_n[0]
+      EastD = self.track_last[1] - P_n[1]
+      self.heading = (ma.atan2(-EastD, -NorthD) + np.pi)*RTOD
+    self.track.append(self.ned[0:2].copy())
+    if len(self.track) > self.max_track:
+      self.track_last = self.track.popleft()
+    self.pending = False
+
+
+def merge_messages(imu_iter, gnss_iter):
+
+  # Merge two time-ordered message iterators
+  #
+  # INPUTS:
+  #   imu_iter    Iterator of IMU_msg
+  #   gnss_iter   Iterator of GNSS_msg
+  #
+  # OUTPUTS
+  #   Generator of IMU_msg/GNSS_msg by time, IMU first on equal times
+
+  imu = ((m.time, 0, i, m) for i, m in enumerate(imu_iter))
+  gnss = ((m.time, 1, i, m) for i, m in enumerate(gnss_iter))
+  for _, _, _, msg in heapq.merge(imu, gnss):
+    yield msg
+
+
+def run_stream(imu_iter, gnss_iter, KF_param, init_rpy, cov_decimation = 0):
+
+  # Fuse IMU and GNSS message iterators
+  #
+  # INPUTS:
+  #   imu_iter        Iterator of IMU_msg (time ordered)
+  #   gnss_iter       Iterator of GNSS_msg (time ordered), the first fix
+  #                   initializes the solution
+  #   KF_param        Kalman Filter parameters (data_packet)
+  #   init_rpy        Initial roll, pitch, yaw (rad)
+  #   cov_decimation  As in run_LC_EKF
+  #
+  # OUTPUTS
+  #   Generator of Nav_state, one per IMU sample and per GNSS fix
+
+  gnss_iter = iter(gnss_iter)
+  first = next(gnss_iter, None)
+  if first is None:
+    return
+  ekf = LC_EKF_stream(KF_param, first, init_rpy, cov_decimation)
+  for msg in merge_messages(imu_iter, gnss_iter):
+    state = ekf.gnss(msg) if isinstance(msg, GNSS_msg) else ekf.imu(msg)
+    if state is not None:
+      yield state
+
+
+async def run_stream_async(imu_queue, gnss_queue, KF_param, init_rpy,
+                           cov_decimation = 0):
+
+  # Fuse IMU and GNSS messages from two asyncio queues
+  #
+  # INPUTS:
+  #   imu_queue       asyncio.Queue of IMU_msg, None ends the stream
+  #   gnss_queue      asyncio.Queue of GNSS_msg, None ends the stream
+  #   KF_param, init_rpy, cov_decimation as in run_stream
+  #
+  # OUTPUTS
+  #   Async generator of Nav_state
+  #
+  # Messages are taken in time order, so the head of both queues must be
+  # known before one is processed: a stalled source delays the other.
+
+  first = await gnss_queue.get()
+  if first is None:
+    return
+  ekf = LC_EKF_stream(KF_param, first, init_rpy, cov_decimation)
+  imu = await imu_queue.get()
+  gnss = await gnss_queue.get()
+  while imu is not None or gnss is not None:
+    if gnss is None or (imu is not None and imu.time <= gnss.time):
+      state = ekf.imu(imu)
+      imu = await imu_queue.get()
+    else:
+      state = ekf.gnss(gnss)
+      gnss = await gnss_queue.get()
+    if state is not None:
+      yield state
+
+
+def profile_messages(in_profile_data, no_epochs, GNSS_epoch_interval = 0.2):
+
+  # Split an in_profile_data array into IMU and GNSS message lists
+  #
+  # INPUTS:
+  #   in_profile_data     Synchronized GNSS/IMU input array
+  #   no_epochs           Number of valid rows in in_profile_data
+  #   GNSS_epoch_interval GNSS rows are taken with the same rule as run_LC_EKF
+  #
+  # OUTPUTS
+  #   imu_msgs, gnss_msgs
+
+  imu_msgs = []
+  gnss_msgs = []
+  time_last_GNSS = in_profile_data[0][0]
+  for k in range(no_epochs):
+    row = in_profile_data[k]
+    imu_msgs.append(IMU_msg(row[0], row[7:10], row[10:13]))
+    if k == 0 or (row[0] - time_last_GNSS) >= GNSS_epoch_interval:
+      if k > 0:
+        time_last_GNSS = row[0]
+      gnss_msgs.append(GNSS_msg(row[0], row[1], row[2], row[3], row[4:7]))
+  return imu_msgs, gnss_msgs
+
+
+def test():
+  import asyncio
+  from Modules.ins_ekf import data_packet
+  from Modules.lc_ins_gnss import run_LC_EKF
+
+  n = 4000
+  ts = np.arange(n)/200.0
+  ip = np.zeros((n, 16))
+  ip[:, 0] = 467000 + ts
+  ip[:, 1] = 0.9 + 10.0*ts/6.4e6
+  ip[:, 2] = 0.3
+  ip[:, 3] = 100.0
+  ip[:, 4] = 10.0
+  ip[:, 7] = 0.001
+  ip[:, 12] = -9.8
+  KF_param = data_packet((0.5, 0.05, np.zeros(3), 0.05, np.zeros(3), 0.002))
+
+  # Same schedule as the batch filter: same rows
+  ref = run_LC_EKF(ip, n, KF_param, cov_decimation=40)
+  imu_msgs, gnss_msgs = profile_messages(ip, n)
+  rows = {}
+  for s in run_stream(imu_msgs, gnss_msgs, KF_param, ip[0, 13:16], cov_decimation=40):
+    rows[s.row[0]] = s.row
+  out = np.array([rows[t] for t in ip[1:, 0]])
+  d = np.abs(out - ref[1:]).max()
+  print(f'stream vs run_LC_EKF: max difference {d:.1e}')
+  assert d < 1e-6
+
+  # 3 Hz GNSS with stamps between IMU samples, fed through asyncio queues
+  gnss_t = ip[0, 0] + np.arange(0.0, ts[-1], 1/3.0) + np.where(np.arange(0.0, ts[-1], 1/3.0) > 0, 0.0013, 0.0)
+  gnss_msgs = [GNSS_msg(t, 0.9 + 10.0*(t - ip[0, 0])/6.4e6, 0.3, 100.0, np.array([10.0, 0.0, 0.0])) for t in gnss_t]
+
+  async def replay():
+    imu_q = asyncio.Queue(maxsize=64)
+    gnss_q = asyncio.Queue(maxsize=8)
+
+    async def feed(q, msgs):
+      for m in msgs:
+        await q.put(m)
+      await q.put(None)
+
+    tasks = [asyncio.create_task(feed(imu_q, imu_msgs)), asyncio.create_task(feed(gnss_q, gnss_msgs))]
+    states = [s async for s in run_stream_async(imu_q, gnss_q, KF_param, ip[0, 13:16])]
+    await asyncio.gather(*tasks)
+    return states
+
+  states = asyncio.run(replay())
+  upd = [s for s in states if s.source == 'gnss']
+  lat = np.array([s.latency for s in states])
+  print(f'{len(upd)} GNSS updates at their own stamps, latency per message: '
+        f'median {np.median(lat)*1e6:.0f} us, max {lat.max()*1e6:.0f} us')
+  assert np.allclose([s.row[0] for s in upd], gnss_t[1:])
+  assert abs(states[-1].row[10] - 10.0*ts[-1]) < 1.0
+
+  # A duplicate fix (no step in between) is a second correction at the
+  # same time
+  stream = LC_EKF_stream(KF_param, gnss_msgs[0], ip[0, 13:16])
+  first = stream.gnss(gnss_msgs[0])
+  second = stream.gnss(gnss_msgs[0])
+  assert second.row[0] == first.row[0] and np.all(np.isfinite(second.row))
+
+
+if __name__ == '__main__':
+  test()
@@ -0,0 +1,329 @@
+###############################################################################
+# File:  ekf_tuning.py
+#
+# Description:
+# Parameter sweeps of the loosely coupled filter (lc_ins_gnss.run_LC_EKF),
+# in place of editing the data_packet values of 5_LC_INS_GNSS.ipynb and
+# re-running by hand.
+#
+# A configuration is a dict of data_packet attributes (TUNABLE) and run
+# options (RUN_OPTIONS), e.g.
+#
+#   {'accel_markov_bias_sigma': 0.001, 'gyro_TC_bias': 600.0,
+#    'init_att_unc': 5*DTOR, 'GNSS_epoch_interval': 0.5}
+#
+# grid_search() and random_search() build the list of configurations.
+# EKF_sweep runs the forward filter once per configuration in a process
+# pool. The input profile (and the reference) are saved once as .npy files
+# and memory-mapped read-only by the workers, not pickled per task. Runs are
+# scored by:
+#
+#   'nis'        innovation consistency: |log(mean NIS / 6)|, 0 when the
+#                normalized innovations squared of the 6 GNSS measurements
+#                average their 6 degrees of freedom (NIS_store)
+#   'reference'  3D position RMSE (m) against a reference trajectory
+#                [time, lat (deg), lon (deg), alt (m)]
+#
+# and returned as a table ranked by score (write_table() to csv).
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import copy
+import itertools
+import os
+import shutil
+import tempfile
+import time
+from csv import writer
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import chi2
+
+from Modules.lc_ins_gnss import run_LC_EKF
+from Modules.d_print import Info
+
+# data_packet attributes and run_LC_EKF options a configuration can set
+TUNABLE = ('GNSS_NED_pos_sigma', 'GNSS_NED_vel_sigma', 'init_att_unc',
+           'accel_markov_bias_sigma', 'accel_TC_bias', 'accel_meas_sigma',
+           'gyro_markov_bias_sigma', 'gyro_TC_bias', 'gyro_meas_sigma')
+RUN_OPTIONS = ('GNSS_epoch_interval', 'cov_decimation', 'mech_decimation')
+
+# GNSS measurement size (NED position and velocity)
+NIS_DOF = 6
+
+EARTH_RADIUS = 6371000.0
+
+
+class NIS_store:
+  """
+    Normalized innovation squared of every GNSS update, filled by
+    run_LC_EKF(..., innovations=store)
+  """
+  def __init__(self):
+    self.rows = []
+    self.nis = []
+
+  def __len__(self):
+    return len(self.nis)
+
+  def add(self, row: int, delta_y, S) -> None:
+    self.rows.append(int(row))
+    self.nis.append(float(delta_y@np.linalg.solve(S, delta_y)))
+
+  def summary(self, dof: int = NIS_DOF, confidence: float = 0.95) -> dict:
+    """
+      Mean NIS and share of the updates within the two-sided chi-square
+      bounds
+    """
+    nis = np.array(self.nis)
+    if len(nis) == 0:
+      return {'nis_mean': np.nan, 'nis_in_bounds': np.nan}
+    lo, hi = chi2.ppf([(1 - confidence)/2, (1 + confidence)/2], dof)
+    return {'nis_mean': float(nis.mean()), 'nis_in_bounds': float(np.mean((nis >= lo) & (nis <= hi)))}
+
+
+def grid_search(space: dict) -> list:
+  """
+    Every combination of the values of space {name: [values]}
+  """
+  names = list(space.keys())
+  return [dict(zip(names, values)) for values in itertools.product(*[space[n] for n in names])]
+
+
+def random_search(space: dict, n: int, seed: int = 0) -> list:
+  """
+    n random configurations. space values: [values] (uniform choice),
+    (low, high) (uniform) or (low, high, 'log') (log-uniform)
+  """
+  rng = np.random.default_rng(seed)
+  configs = []
+  for _ in range(n):
+    config = {}
+    for name, dom in space.items():
+      if isinstance(dom, list):
+        config[name] = dom[rng.integers(len(dom))]
+      elif len(dom) == 3 and dom[2] == 'log':
+        config[name] = float(np.exp(rng.uniform(np.log(dom[0]), np.log(dom[1]))))
+      else:
+        config[name] = float(rng.uniform(dom[0], dom[1]))
+    configs.append(config)
+  return configs
+
+
+def configure(KF_param, config: dict, run_options: dict = {}):
+
+  # Filter parameters and run options of a configuration
+  #
+  # INPUTS:
+  #   KF_param      Base data_packet (not modified)
+  #   config        {name: value} of TUNABLE and RUN_OPTIONS names
+  #   run_options   Base run_LC_EKF options
+  #
+  # OUTPUTS
+  #   param         Copy of KF_param with the configuration values
+  #   options       run_LC_EKF keyword arguments
+
+  param = copy.deepcopy(KF_param)
+  options = dict(run_options)
+  for name, value in config.items():
+    if name in RUN_OPTIONS:
+      options[name] = value
+    elif name in TUNABLE:
+      setattr(param, name, value)
+    else:
+      raise ValueError(f'Unknown parameter "{name}", expected one of {TUNABLE + RUN_OPTIONS}')
+  return param, options
+
+
+def reference_errors(out_profile_data, reference) -> dict:
+
+  # Position errors of a solution against a reference trajectory
+  #
+  # INPUTS:
+  #   out_profile_data  run_LC_EKF output (lat, lon in deg in columns 7, 8)
+  #   reference         [time, lat (deg), lon (deg), alt (m)], increasing time
+  #
+  # OUTPUTS
+  #   RMSE (m) horizontal, vertical and 3D over the common time span
+
+  t = out_profile_data[:, 0]
+  m = (t >= reference[0, 0]) & (t <= reference[-1, 0])
+  if not np.any(m):
+    return {'rmse_h': np.nan, 'rmse_v': np.nan, 'rmse_3d': np.nan}
+  ref = [np.interp(t[m], reference[:, 0], reference[:, i]) for i in (1, 2, 3)]
+  dN = np.radians(out_profile_data[m, 7] - ref[0])*EARTH_RADIUS
+  dE = np.radians(out_profile_data[m, 8] - ref[1])*EARTH_RADIUS*np.cos(np.radians(ref[0]))
+  dU = out_profile_data[m, 9] - ref[2]
+  h2 = np.mean(dN**2 + dE**2)
+  v2 = np.mean(dU**2)
+  return {'rmse_h': float(np.sqrt(h2)), 'rmse_v': float(np.sqrt(v2)), 'rmse_3d': float(np.sqrt(h2 + v2))}
+
+
+# Inputs of the worker processes, memory-mapped once per process
+_inputs = {}
+
+
+def _load_inputs(profile_file: str, reference_file: str) -> None:
+  _inputs['profile'] = np.load(profile_file, mmap_mode='r')
+  _inputs['reference'] = np.load(reference_file, mmap_mode='r') if reference_file != '' else None
+
+
+def _run_config(task) -> dict:
+  # One filter run in a worker: scores of the configuration
+  k, config, KF_param, run_options = task
+  row = {'run': k, 'config': config, 'seconds': 0.0, 'message': ''}
+  now = time.perf_counter()
+  try:
+    param, options = configure(KF_param, config, run_options)
+    profile = _inputs['profile']
+    store = NIS_store()
+    out = run_LC_EKF(profile, len(profile), param, innovations=store, **options)
+    row.update(store.summary())
+    row['updates'] = len(store)
+    if _inputs['reference'] is not None:
+      row.update(reference_errors(out, _inputs['reference']))
+  except Exception as ex:
+    row['message'] = f'{type(ex).__name__}: {ex}'
+  row['seconds'] = time.perf_counter() - now
+  return row
+
+
+class EKF_sweep:
+  def __init__(self, in_profile_data, no_epochs, KF_param,
+               reference = None,
+               score: str = 'nis',
+               run_options: dict = {},
+               max_workers: int = 0,
+               work_dir: str = ''):
+    # INPUTS:
+    #   in_profile_data   run_LC_EKF input array, no_epochs valid rows
+    #   KF_param          Base data_packet of all runs
+    #   reference         Optional [time, lat (deg), lon (deg), alt (m)]
+    #   score             'nis' or 'reference' (needs reference)
+    #   run_options       Base run_LC_EKF options (e.g. cov_decimation=40)
+    #   max_workers       Processes (default: CPU count)
+    #   work_dir          Folder of the memory-mapped inputs (default: temporary)
+    if score not in ('nis', 'reference'):
+      raise ValueError(f'Unknown score "{score}", use "nis" or "reference"')
+    if score == 'reference' and reference is None:
+      raise ValueError('score="reference" needs a reference trajectory')
+    self.in_profile_data = in_profile_data
+    self.no_epochs = no_epochs
+    self.KF_param = KF_param
+    self.reference = reference
+    self.score = score
+    self.run_options = dict(run_options)
+    self.max_workers = max_workers if max_workers > 0 else (os.cpu_count() or 1)
+    self.work_dir = work_dir
+
+  def run(self, configs: list) -> list:
+    """
+      Run every configuration, return the rows ranked by score (best first,
+      failed runs last)
+    """
+    own_dir = self.work_dir == ''
+    folder = tempfile.mkdtemp(prefix='ekf_sweep_') if own_dir else self.work_dir
+    try:
+      profile_file = os.path.join(folder, 'in_profile.npy')
+      np.save(profile_file, np.ascontiguousarray(self.in_profile_data[:self.no_epochs], dtype=float))
+      reference_file = ''
+      if self.reference is not None:
+        reference_file = os.path.join(folder, 'reference.npy')
+        np.save(reference_file, np.asarray(self.reference, dtype=float))
+
+      now = time.perf_counter()
+      tasks = [(k, config, self.KF_param, self.run_options) for k, config in enumerate(configs)]
+      with ProcessPoolExecutor(max_workers=min(self.max_workers, max(len(tasks), 1)),
+                               initializer=_load_inputs, initargs=(profile_file, reference_file)) as pool:
+        rows = list(pool.map(_run_config, tasks))
+    finally:
+      if own_dir:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    for row in rows:
+      if row['message'] != '':
+        row['score'] = np.inf
+      elif self.score == 'nis':
+        row['score'] = abs(np.log(row['nis_mean']/NIS_DOF)) if row['nis_mean'] > 0 else np.inf
+      else:
+        row['score'] = row['rmse_3d']
+    rows.sort(key=lambda r: (not np.isfinite(r['score']), r['score']))
+    for rank, row in enumerate(rows):
+      row['rank'] = rank + 1
+    Info(f'{len(rows)} runs in {time.perf_counter() - now:.2f}s '
+         f'({sum(r["seconds"] for r in rows):.2f}s of filter), best {self.score} score {rows[0]["score"]:.4g}'
+         if len(rows) > 0 else 'No configuration to run')
+    return rows
+
+
+def write_table(rows: list, fn: str) -> None:
+  """
+    Ranked table to csv: rank, score, parameters, metrics
+  """
+  params = []
+  for row in rows:
+    params += [p for p in row['config'] if p not in params]
+  metrics = [m for m in ('nis_mean', 'nis_in_bounds', 'updates', 'rmse_h', 'rmse_v', 'rmse_3d')
+             if any(m in row for row in rows)]
+  with open(fn, 'w', newline='') as csvfile:
+    wr = writer(csvfile)
+    wr.writerow(['rank', 'score'] + params + metrics + ['seconds', 'message'])
+    for row in rows:
+      wr.writerow([row['rank'], row['score']] + [row['config'].get(p, '') for p in params]
+                  + [row.get(m, '') for m in metrics] + [f'{row["seconds"]:.3f}', row['message']])
+
+
+def test():
+  from Modules.ins_ekf import data_packet
+
+  # 20 s straight flight north at 10 m/s, 200 Hz IMU, GNSS with 0.5 m / 0.05 m/s noise
+  rng = np.random.default_rng(3)
+  n = 4000
+  ts = np.arange(n)/200.0
+  R = 6.4e6
+  lat = 0.9 + 10.0*ts/R
+  ip = np.zeros((n, 16))
+  ip[:, 0] = 467000 + ts
+  ip[:, 1] = lat + rng.normal(0, 0.5, n)/R
+  ip[:, 2] = 0.3 + rng.normal(0, 0.5, n)/(R*np.cos(0.9))
+  ip[:, 3] = 100.0 + rng.normal(0, 0.5, n)
+  ip[:, 4:7] = [10.0, 0.0, 0.0] + rng.normal(0, 0.05, (n, 3))
+  ip[:, 7:10] = rng.normal(0, 1e-4, (n, 3))
+  ip[:, 10:13] = [0.0, 0.0, -9.8] + rng.normal(0, 0.02, (n, 3))
+  reference = np.column_stack([ip[:, 0], np.degrees(lat), np.full(n, np.degrees(0.3)), np.full(n, 100.0)])
+  KF_param = data_packet((0.5, 0.05, np.zeros(3), 0.05, np.zeros(3), 0.002))
+
+  configs = grid_search({'GNSS_NED_pos_sigma': [0.05, 0.5, 5.0], 'GNSS_NED_vel_sigma': [0.05, 0.5]})
+  assert len(configs) == 6 and configs[1] == {'GNSS_NED_pos_sigma': 0.05, 'GNSS_NED_vel_sigma': 0.5}
+  configs += random_search({'accel_markov_bias_sigma': (1e-4, 1e-2, 'log'), 'gyro_TC_bias': (100.0, 1000.0),
+                            'GNSS_epoch_interval': [0.2, 1.0]}, 2)
+  configs.append({'no_such_param': 1.0})
+
+  sweep = EKF_sweep(ip, n, KF_param, reference=reference, run_options={'cov_decimation': 40}, max_workers=2)
+  rows = sweep.run(configs)
+  print('rank  score   NIS  in95%  RMSE3D  config')
+  for r in rows:
+    print(f'{r["rank"]:4d} {r["score"]:6.3f} {r.get("nis_mean", np.nan):6.2f} {r.get("nis_in_bounds", np.nan):5.2f} '
+          f'{r.get("rmse_3d", np.nan):6.2f}  {r["config"]} {r["message"]}')
+  # In the grid the true noise levels are the most consistent, the bad name fails last
+  best = [r for r in rows if r['run'] < 6][0]
+  assert best['config'] == {'GNSS_NED_pos_sigma': 0.5, 'GNSS_NED_vel_sigma': 0.05}
+  assert rows[-1]['message'].startswith('ValueError') and not np.isfinite(rows[-1]['score'])
+
+  # Same run in the process: same NIS
+  store = NIS_store()
+  param, options = configure(KF_param, best['config'], {'cov_decimation': 40})
+  run_LC_EKF(ip, n, param, innovations=store, **options)
+  assert np.isclose(store.summary()['nis_mean'], best['nis_mean'])
+
+  by_rmse = EKF_sweep(ip, n, KF_param, reference=reference, score='reference',
+                      run_options={'cov_decimation': 40}, max_workers=2).run(configs[:6])
+  fn = os.path.join(tempfile.mkdtemp(), 'sweep.csv')
+  write_table(by_rmse, fn)
+  with open(fn) as fh:
+    print(fh.read())
+
+
+if __name__ == '__main__':
+  test()
@@ -0,0 +1,330 @@
+###############################################################################
+# File:  ephemeris_index.py
+#
+# Description:
+# Choice of the broadcast ephemeris of one satellite for arrays of epochs,
+# in place of xarray's sel(time=..., method='nearest') on the records of a
+# navigation file (which can take a record whose toe is after the epoch and
+# does not look at the health or the fit interval).
+#
+# The index is built once per satellite when the file is loaded:
+#
+#   toe         (n,) datetime64[ms] time of ephemeris (GPS week + Toe)
+#   toc         (n,) datetime64[s]  time of clock (record time)
+#   fit_end     (n,) end of validity, toe + fit interval / 2
+#   fit_start   (n,) start of validity, toe - fit interval / 2
+#   healthy     (n,) SV health == 0
+#   iode        (n,) issue of data
+#
+# Only the healthy records are searched, sorted by toe (ties: the record
+# read last). For each epoch t, select() takes the latest record with
+# toe <= t and keeps it if t is within its fit interval (one searchsorted
+# for the whole array). Epochs before the first toe get no record unless
+# allow_future is set. Then they get the first record whose fit interval
+# has started. Epochs without a record have index -1, and their IODE is
+# NaN.
+#
+# Epochs and toc/toe are compared as given, on GPS time. UTC times (of a
+# position file) are converted first with utc_to_gps(): GPS time is ahead
+# of UTC by the leap seconds inserted since 1980 (18 s since 2017), which
+# is about 70 m of satellite motion.
+#
+# positions() propagates each chosen record to its own epoch, with
+# tk = t - toe (IS-GPS-200 user algorithm, kepler_ecef()), and not to the
+# record time.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+from collections import namedtuple
+
+# GPS time origin and default fit interval (hours, when the field is 0 or blank)
+GPS_EPOCH = np.datetime64('1980-01-06T00:00:00', 'ms')
+DEFAULT_FIT_HOURS = 4.0
+
+# UTC dates from which GPS - UTC is one more second (leap seconds)
+LEAP_SECONDS = np.array(['1981-07-01', '1982-07-01', '1983-07-01', '1985-07-01', '1988-01-01',
+                         '1990-01-01', '1991-01-01', '1992-07-01', '1993-07-01', '1994-07-01',
+                         '1996-01-01', '1997-07-01', '1999-01-01', '2006-01-01', '2009-01-01',
+                         '2012-07-01', '2015-07-01', '2017-01-01'], dtype='datetime64[ms]')
+
+# GPS constants of the broadcast orbit (IS-GPS-200)
+GM = 3.986005e14                # m^3/s^2
+OMEGA_E = 7.2921151467e-5       # rad/s
+
+# Columns of the GPS record values of rinex_nav_merge.Nav_table
+NAV_TABLE_COLUMNS = {'IODE': 3, 'Crs': 4, 'DeltaN': 5, 'M0': 6, 'Cuc': 7, 'Eccentricity': 8,
+                     'Cus': 9, 'sqrtA': 10, 'Toe': 11, 'Cic': 12, 'Omega0': 13, 'Cis': 14,
+                     'Io': 15, 'Crc': 16, 'omega': 17, 'OmegaDot': 18, 'IDOT': 19,
+                     'GPSWeek': 21, 'health': 24, 'IODC': 26, 'FitIntvl': 28}
+
+# Orbit parameters of a record (georinex variable names)
+KEPLER_FIELDS = ('sqrtA', 'Eccentricity', 'M0', 'DeltaN', 'omega', 'Omega0', 'OmegaDot',
+                 'Io', 'IDOT', 'Cuc', 'Cus', 'Crc', 'Crs', 'Cic', 'Cis', 'Toe')
+
+# index (into the records given to the index, -1 if none), toe and IODE
+# of the chosen record for each epoch
+Ephemeris_choice = namedtuple('Ephemeris_choice', ['index', 'toe', 'iode'])
+
+
+def utc_to_gps(times) -> np.ndarray:
+  # GPS times (datetime64[ms]) of UTC times: plus the leap seconds to date
+  times = np.asarray(times, dtype='datetime64[ms]')
+  leap = np.searchsorted(LEAP_SECONDS, times, side='right')
+  return times + leap.astype('timedelta64[s]')
+
+
+def kepler_ecef(orbit: dict, tk):
+
+  # Satellite ECEF positions from broadcast orbit parameters
+  #
+  # INPUTS:
+  #   orbit       {KEPLER_FIELDS name: (n,) values} of the records
+  #   tk          (n,) time from toe of each position (sec)
+  #
+  # OUTPUTS
+  #   (3, n) x, y, z (m)
+
+  tk = np.asarray(tk, dtype=float)
+  A = orbit['sqrtA']**2
+  e = orbit['Eccentricity']
+  M = orbit['M0'] + (np.sqrt(GM/A**3) + orbit['DeltaN'])*tk
+
+  # Kepler's equation by Newton iterations
+  E = np.array(M, dtype=float)
+  for _ in range(10):
+    dE = (E - e*np.sin(E) - M)/(1.0 - e*np.cos(E))
+    E = E - dE
+    if np.all(np.abs(np.nan_to_num(dE)) < 1e-13):
+      break
+
+  nu = np.arctan2(np.sqrt(1.0 - e**2)*np.sin(E), np.cos(E) - e)
+  phi = nu + orbit['omega']
+  s2, c2 = np.sin(2*phi), np.cos(2*phi)
+  u = phi + orbit['Cus']*s2 + orbit['Cuc']*c2
+  r = A*(1.0 - e*np.cos(E)) + orbit['Crs']*s2 + orbit['Crc']*c2
+  i = orbit['Io'] + orbit['IDOT']*tk + orbit['Cis']*s2 + orbit['Cic']*c2
+  Omega = orbit['Omega0'] + (orbit['OmegaDot'] - OMEGA_E)*tk - OMEGA_E*orbit['Toe']
+
+  x, y = r*np.cos(u), r*np.sin(u)
+  return np.array([x*np.cos(Omega) - y*np.cos(i)*np.sin(Omega),
+                   x*np.sin(Omega) + y*np.cos(i)*np.cos(Omega),
+                   y*np.sin(i)])
+
+
+class Ephemeris_index:
+  def __init__(self, toc, toe_sow, week, health, iode, fit_hours, allow_future: bool = False,
+               orbit: dict = None):
+    # INPUTS:
+    #   toc         (n,) record times (datetime64)
+    #   toe_sow     (n,) Toe, seconds of GPS week (NaN: use toc)
+    #   week        (n,) GPS week of Toe (NaN: week of toc)
+    #   health      (n,) SV health (NaN counts as healthy)
+    #   iode        (n,) IODE
+    #   fit_hours   (n,) fit interval, hours (0 or NaN: 4 hours)
+    #   allow_future  epochs before the first toe take the first record
+    #                 whose fit interval has started
+    #   orbit       {KEPLER_FIELDS name: (n,) values} for positions()
+    self.toc = np.asarray(toc).astype('datetime64[s]')
+    n = len(self.toc)
+    toe_sow = np.asarray(toe_sow, dtype=float).reshape(n)
+    week = np.asarray(week, dtype=float).reshape(n)
+    self.allow_future = allow_future
+
+    # toe from week and seconds, the week of toc when it is missing
+    toc_ms = self.toc.astype('datetime64[ms]')
+    toc_week = np.floor((toc_ms - GPS_EPOCH)/np.timedelta64(604800, 's'))
+    week = np.where(np.isfinite(week), week, toc_week)
+    toe_ms = np.round((week*604800.0 + np.nan_to_num(toe_sow))*1e3).astype('int64')
+    self.toe = np.where(np.isfinite(toe_sow), GPS_EPOCH + toe_ms.astype('timedelta64[ms]'), toc_ms)
+
+    fit = np.asarray(fit_hours, dtype=float).reshape(n)
+    fit = np.where(np.isfinite(fit) & (fit > 0), fit, DEFAULT_FIT_HOURS)
+    half = np.round(fit*1800e3).astype('int64').astype('timedelta64[ms]')
+    self.fit_start = self.toe - half
+    self.fit_end = self.toe + half
+    health = np.asarray(health, dtype=float).reshape(n)
+    self.healthy = ~(np.isfinite(health) & (health != 0))
+    self.iode = np.asarray(iode, dtype=float).reshape(n)
+    self.orbit = None if orbit is None else {k: np.asarray(orbit[k], dtype=float).reshape(n) for k in KEPLER_FIELDS}
+
+    # Healthy records by toe, the last one read wins on equal toe
+    rows = np.flatnonzero(self.healthy)
+    self.order = rows[np.lexsort((rows, self.toe[rows]))]
+    self.sorted_toe = self.toe[self.order]
+
+  @classmethod
+  def from_dataset(cls, nav, **kwargs) -> 'Ephemeris_index':
+    """
+      Index of the records of one satellite of a georinex navigation Dataset
+      (nav.sel(sv=prn)), in the order of its time coordinate
+    """
+    n = nav['time'].size
+
+    def var(name):
+      return nav[name].values if name in nav else np.full(n, np.nan)
+    return cls(nav['time'].values, var('Toe'), var('GPSWeek'), var('health'), var('IODE'),
+               var('FitIntvl'), orbit={k: var(k) for k in KEPLER_FIELDS}, **kwargs)
+
+  @classmethod
+  def from_nav_table(cls, table, sv: str, **kwargs) -> 'Ephemeris_index':
+    """
+      Index of the records of satellite sv of a rinex_nav_merge.Nav_table;
+      index values refer to the rows of table with table.sv == sv, in order
+    """
+    rows = table.values[table.sv == sv]
+    col = NAV_TABLE_COLUMNS
+    return cls(table.toc[table.sv == sv], rows[:, col['Toe']], rows[:, col['GPSWeek']],
+               rows[:, col['health']], rows[:, col['IODE']], rows[:, col['FitIntvl']],
+               orbit={k: rows[:, col[k]] for k in KEPLER_FIELDS}, **kwargs)
+
+  def __len__(self) -> int:
+    return len(self.toc)
+
+  def select(self, times) -> Ephemeris_choice:
+    """
+      Record of each epoch (datetime64, datetime or ISO string array):
+      latest healthy record with toe <= t whose fit interval contains t
+    """
+    t = np.asarray(times, dtype='datetime64[ms]')
+    k = np.searchsorted(self.sorted_toe, t, side='right') - 1
+    index = np.full(t.shape, -1)
+    if len(self.order) == 0:
+      return Ephemeris_choice(index, np.full(t.shape, np.datetime64('NaT', 'ms')), np.full(t.shape, np.nan))
+
+    before = k >= 0
+    rec = self.order[np.clip(k, 0, None)]
+    ok = before & (t <= self.fit_end[rec])
+    index[ok] = rec[ok]
+
+    if self.allow_future:
+      # Before the first toe: the first record if its fit interval has started
+      first = self.order[0]
+      early = ~before & (t >= self.fit_start[first])
+      index[early] = first
+
+    found = index >= 0
+    toe = np.where(found, self.toe[np.clip(index, 0, None)], np.datetime64('NaT', 'ms'))
+    iode = np.where(found, self.iode[np.clip(index, 0, None)], np.nan)
+    return Ephemeris_choice(index, toe, iode)
+
+  def positions(self, times, choice: Ephemeris_choice = None):
+    """
+      (3, n) ECEF positions at the epochs, each chosen record propagated
+      to its epoch (tk = t - toe); NaN where no record is valid
+    """
+    if self.orbit is None:
+      raise ValueError('No orbit parameters in this Ephemeris_index')
+    t = np.asarray(times, dtype='datetime64[ms]')
+    if choice is None:
+      choice = self.select(t)
+    found = choice.index >= 0
+    xyz = np.full((3,) + t.shape, np.nan)
+    if np.any(found):
+      rec = choice.index[found]
+      tk = (t[found] - self.toe[rec])/np.timedelta64(1, 's')
+      xyz[:, found] = kepler_ecef({k: v[rec] for k, v in self.orbit.items()}, tk)
+    return xyz
+
+
+def indexes_from_nav_table(table, system: str = 'G', **kwargs) -> dict:
+  """
+    Ephemeris_index of every satellite of a system in a Nav_table
+  """
+  return {sv: Ephemeris_index.from_nav_table(table, sv, **kwargs)
+          for sv in sorted(set(table.sv)) if sv.startswith(system)}
+
+
+def test():
+  import time
+  from Modules.rinex_nav_merge import Nav_table, MAX_VALUES
+
+  # Records every 2 hours (toe = toc), one re-broadcast with a new IODE,
+  # one unhealthy and one with a 6 hour fit interval
+  t0 = np.datetime64('2021-12-03T00:00:00', 's')
+  week, sow0 = 2186, 5*86400.0                     # Friday 2021-12-03
+  toc = t0 + np.array([0, 2, 4, 4, 6, 8, 12], dtype='timedelta64[h]').astype('timedelta64[s]')
+  iode = np.array([10, 11, 12, 13, 14, 15, 16], dtype=float)
+  health = np.array([0, 0, 0, 0, 1, 0, 0], dtype=float)
+  fit = np.array([4, 4, 4, 4, 4, 6, 0], dtype=float)
+  toe = sow0 + (toc - t0).astype(float)
+  assert GPS_EPOCH + np.timedelta64(int(week*604800 + sow0), 's') == t0
+
+  idx = Ephemeris_index(toc, toe, np.full(7, week), health, iode, fit)
+  h = np.timedelta64(3600, 's')
+  times = t0 + np.array([-1, 0, 1.5, 3, 5, 6.5, 7.5, 10.9, 11.5, 12, 15], dtype=float)*3600*np.timedelta64(1, 's')
+  choice = idx.select(times)
+  # -1 h: before the first toe | 1.5 h: 0 h record | 5 h: re-broadcast of
+  # 4 h (IODE 13) | 6.5 h: 6 h record unhealthy, 4 h record expired |
+  # 7.5 h: 8 h record in the future | 10.9 h: 8 h record (6 h fit) |
+  # 11.5 h: expired | 15 h: 12 h record expired (default 4 h fit)
+  assert list(choice.index) == [-1, 0, 0, 1, 3, -1, -1, 5, -1, 6, -1]
+  assert np.isnan(choice.iode[0]) and choice.iode[4] == 13 and choice.toe[7] == t0 + 8*h
+  assert np.all(choice.toe[choice.index >= 0] <= times[choice.index >= 0])
+
+  # The old choice (nearest toc) takes future and unhealthy records
+  nearest = np.argmin(np.abs(times[:, None] - toc[None, :]), axis=1)
+  assert nearest[6] == 5 and toc[5] > times[6] and health[nearest[5]] == 1
+
+  # allow_future: the first record from its fit start
+  early = Ephemeris_index(toc, toe, np.full(7, week), health, iode, fit, allow_future=True)
+  assert early.select(times[:1]).index[0] == 0
+  assert early.select([t0 - 3*h]).index[0] == -1
+
+  # From a Nav_table: GPS columns
+  values = np.full((7, MAX_VALUES), np.nan)
+  for name, v in (('IODE', iode), ('Toe', toe), ('GPSWeek', np.full(7, week)), ('health', health), ('FitIntvl', fit)):
+    values[:, NAV_TABLE_COLUMNS[name]] = v
+  table = Nav_table(np.array(['G05']*7 + ['R01'], dtype='U3'), np.append(toc, t0),
+                    np.vstack([values, np.full((1, MAX_VALUES), np.nan)]))
+  by_sv = indexes_from_nav_table(table)
+  assert list(by_sv) == ['G05'] and np.array_equal(by_sv['G05'].select(times).index, choice.index)
+
+  # Positions: a record propagated to toe + 30 min, against a reference from
+  # the perifocal position (Kepler's equation by bisection) rotated by
+  # omega, i and the node longitude at t (no harmonic terms)
+  from scipy.optimize import brentq
+  orbit = {k: np.zeros(7) for k in KEPLER_FIELDS}
+  orbit.update(sqrtA=np.full(7, 5153.65), Eccentricity=np.full(7, 0.012), M0=np.full(7, 0.7),
+               DeltaN=np.full(7, 4.5e-9), omega=np.full(7, 0.9), Omega0=np.full(7, -1.2),
+               OmegaDot=np.full(7, -8e-9), Io=np.full(7, 0.96), Toe=toe)
+  sat = Ephemeris_index(toc, toe, np.full(7, week), health, iode, fit, orbit=orbit)
+  t = t0 + 2*h + np.timedelta64(1800, 's')
+  xyz = sat.positions([t])[:, 0]
+
+  A, ecc, tk = 5153.65**2, 0.012, 1800.0
+  M = 0.7 + (np.sqrt(GM/A**3) + 4.5e-9)*tk
+  E = brentq(lambda E: E - ecc*np.sin(E) - M, M - 1, M + 1, xtol=1e-15)
+  nu = np.arctan2(np.sqrt(1 - ecc**2)*np.sin(E), np.cos(E) - ecc)
+  p = A*(1 - ecc*np.cos(E))*np.array([np.cos(nu), np.sin(nu), 0.0])
+
+  def R3(x):
+    return np.array([[np.cos(x), -np.sin(x), 0], [np.sin(x), np.cos(x), 0], [0, 0, 1]])
+
+  def R1(x):
+    return np.array([[1, 0, 0], [0, np.cos(x), -np.sin(x)], [0, np.sin(x), np.cos(x)]])
+  node = -1.2 + (-8e-9 - OMEGA_E)*tk - OMEGA_E*toe[1]
+  ref = R3(node)@R1(0.96)@R3(0.9)@p
+  assert np.linalg.norm(xyz - ref) < 1e-3, np.linalg.norm(xyz - ref)
+
+  # Not the position at the record epoch (about 7000 km away), NaN without
+  # a record
+  assert np.linalg.norm(xyz - sat.positions([t0 + 2*h])[:, 0]) > 5e6
+  assert np.all(np.isnan(sat.positions([t0 - h])))
+
+  # UTC to GPS time: 18 s since 2017, 17 s in 2016
+  utc = np.array(['2021-12-03T08:00:00', '2016-12-31T23:59:59', '2017-01-01T00:00:00'], dtype='datetime64[ms]')
+  assert list((utc_to_gps(utc) - utc).astype(int)) == [18000, 17000, 18000]
+  assert np.allclose(sat.positions(utc_to_gps([t - np.timedelta64(18, 's')]))[:, 0], xyz)
+
+  # One day at 10 Hz
+  day = t0 + np.arange(864000)*np.timedelta64(100, 'ms')
+  now = time.perf_counter()
+  choice = idx.select(day)
+  print(f'{len(day)} epochs: {time.perf_counter() - now:.3f}s, '
+        f'{np.count_nonzero(choice.index >= 0)} with an ephemeris, IODEs {sorted(set(choice.iode[choice.index >= 0].astype(int).tolist()))}')
+
+
+if __name__ == '__main__':
+  test()
@@ -0,0 +1,430 @@
+###############################################################################
+# File:  flight_archive.py
+#
+# Description:
+# Indexed archive of processed flights: trajectories and per-epoch quality
+# values (DOP, ns, sigmas, fusion covariance) of many flights in one folder,
+# so that a query like "epochs with GDOP > 4 inside this polygon last month"
+# does not parse every *_gdop.csv and out_profile_data export again.
+#
+# Layout (same raw column files as imu_cache, one partition per flight):
+#
+#   <root>/catalog.json          flights, columns and row group statistics
+#   <root>/<flight>/<name>.f8    raw little-endian float64 column, (rows,)
+#                                or (rows, width)
+#
+# Rows are sorted by time and cut in row groups of `row_group_size` rows.
+# The catalog keeps, per row group, the row range, the time range, the
+# lat/lon bounding box and the min/max of every scalar column, plus the
+# totals of each flight. query() first selects flights and row groups from
+# the catalog only, then maps the column files (np.memmap) and reads the
+# rows of the selected groups. Time, bbox, polygon and value ranges are then
+# applied exactly to these rows.
+#
+# Required columns are 'time' (sec, any scale as long as queries use the
+# same), 'lat' and 'lon' (deg).
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import csv
+import json
+import os
+import shutil
+import Modules.common as c
+
+
+ARCHIVE_VERSION = 1
+ROW_GROUP_SIZE = 65536
+REQUIRED = ('time', 'lat', 'lon')
+
+# Column names of out_profile_data (lc_ins_gnss)
+PROFILE_COLUMNS = ['time', 'roll', 'pitch', 'yaw', 'vN', 'vE', 'vD', 'lat', 'lon', 'alt',
+                   'N', 'E', 'D', 'ba_x', 'ba_y', 'ba_z', 'bg_x', 'bg_y', 'bg_z']
+
+
+class Flight_archive:
+  def __init__(self, root: str):
+    self.root = root
+    self.catalog_file = os.path.join(root, 'catalog.json')
+    self.catalog = {'version': ARCHIVE_VERSION, 'flights': {}}
+    if not os.path.exists(root):
+      os.makedirs(root)
+    if os.path.exists(self.catalog_file):
+      with open(self.catalog_file) as fh:
+        self.catalog = json.load(fh)
+      if self.catalog.get('version') != ARCHIVE_VERSION:
+        raise ValueError(f'{self.catalog_file}: archive version {self.catalog.get("version")} '
+                         f'instead of {ARCHIVE_VERSION}')
+
+  def flights(self) -> list:
+    """
+      Names of the archived flights
+    """
+    return sorted(self.catalog['flights'].keys())
+
+  def info(self, flight: str) -> dict:
+    """
+      Catalog entry of a flight: rows, columns {name: width}, time range,
+      bbox and row groups
+    """
+    return self.catalog['flights'][flight]
+
+  def write(self, flight: str, columns: dict, row_group_size: int = ROW_GROUP_SIZE,
+            source: str = '') -> dict:
+    """
+      Write (or replace) a flight. columns maps names to arrays of the same
+      length, 2-D arrays are stored with their width. Returns the catalog
+      entry.
+    """
+    for name in REQUIRED:
+      if name not in columns:
+        raise ValueError(f'Flight "{flight}" has no "{name}" column')
+    if os.sep in flight or flight in ('', '.', '..'):
+      raise ValueError(f'Invalid flight name "{flight}"')
+
+    arrays = {name: np.asarray(v, dtype=float) for name, v in columns.items()}
+    n = len(arrays['time'])
+    for name, v in arrays.items():
+      if len(v) != n or v.ndim > 2:
+        raise ValueError(f'Column "{name}" has shape {v.shape}, expected ({n},) or ({n}, k)')
+    order = np.argsort(arrays['time'], kind='stable')
+    if np.any(order != np.arange(n)):
+      arrays = {name: v[order] for name, v in arrays.items()}
+
+    # Column files, written next to the old ones then swapped
+    folder = os.path.join(self.root, flight)
+    tmp = folder + '.part'
+    if os.path.exists(tmp):
+      shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for name, v in arrays.items():
+      with open(os.path.join(tmp, name + '.f8'), 'wb') as fh:
+        fh.write(np.ascontiguousarray(v, dtype='<f8').tobytes())
+    if os.path.exists(folder):
+      shutil.rmtree(folder)
+    os.replace(tmp, folder)
+
+    scalars = [name for name, v in arrays.items() if v.ndim == 1 and name not in REQUIRED]
+    groups = []
+    for start in range(0, n, row_group_size):
+      stop = min(start + row_group_size, n)
+      groups.append(_group_stats(arrays, start, stop, scalars))
+    entry = {'rows': n,
+             'columns': {name: (1 if v.ndim == 1 else v.shape[1]) for name, v in arrays.items()},
+             'source': source,
+             'row_group_size': row_group_size,
+             'row_groups': groups}
+    entry.update(_totals(groups))
+    self.catalog['flights'][flight] = entry
+    self.__save()
+    return entry
+
+  def remove(self, flight: str) -> None:
+    """
+      Remove a flight from the archive
+    """
+    if flight in self.catalog['flights']:
+      del self.catalog['flights'][flight]
+      self.__save()
+    folder = os.path.join(self.root, flight)
+    if os.path.exists(folder):
+      shutil.rmtree(folder)
+
+  def column(self, flight: str, name: str) -> np.ndarray:
+    """
+      Read-only memory map of a whole column
+    """
+    entry = self.catalog['flights'][flight]
+    width = entry['columns'][name]
+    shape = (entry['rows'],) if width == 1 else (entry['rows'], width)
+    if entry['rows'] == 0:
+      return np.zeros(shape)
+    return np.memmap(os.path.join(self.root, flight, name + '.f8'), dtype='<f8', mode='r', shape=shape)
+
+  def plan(self, t0: float = -np.inf, t1: float = np.inf, bbox = None,
+           ranges: dict = None, flights: list = None) -> dict:
+    """
+      Row groups that may hold rows of the query, from the catalog only:
+      {flight: [row group, ...]}. bbox is (lat_min, lon_min, lat_max,
+      lon_max), ranges maps scalar columns to (min, max).
+    """
+    ranges = ranges or {}
+    out = {}
+    for name in (flights if flights is not None else self.flights()):
+      entry = self.catalog['flights'][name]
+      if any(col not in entry['columns'] for col in ranges):
+        continue
+      if entry['rows'] == 0 or not _overlaps(entry, t0, t1, bbox, {}):
+        continue
+      groups = [g for g in entry['row_groups'] if _overlaps(g, t0, t1, bbox, ranges)]
+      if len(groups) > 0:
+        out[name] = groups
+    return out
+
+  def query(self, t0: float = -np.inf, t1: float = np.inf, bbox = None, polygon = None,
+            ranges: dict = None, columns: list = None, flights: list = None) -> tuple:
+
+    # Rows of all flights inside a time window, area and value ranges
+    #
+    # INPUTS:
+    #   t0, t1      Time window [t0, t1] (sec)
+    #   bbox        (lat_min, lon_min, lat_max, lon_max) (deg) or None
+    #   polygon     Vertices [(lat, lon), ...] (deg) or None; its bbox is
+    #               used for the row group selection
+    #   ranges      {column: (min, max)} on scalar columns, e.g.
+    #               {'GDOP': (4, np.inf)}
+    #   columns     Columns to return (all the common ones if None)
+    #   flights     Flights to search (all if None)
+    #
+    # OUTPUTS
+    #   data        {column: array} of the matching rows, with 'flight'
+    #               (flight names) and 'row' (row in the flight)
+    #   stats       {'groups_read', 'groups_total', 'rows_read', 'rows'}
+
+    ranges = ranges or {}
+    if polygon is not None:
+      polygon = np.asarray(polygon, dtype=float)
+      pb = (polygon[:, 0].min(), polygon[:, 1].min(), polygon[:, 0].max(), polygon[:, 1].max())
+      bbox = pb if bbox is None else (max(bbox[0], pb[0]), max(bbox[1], pb[1]),
+                                      min(bbox[2], pb[2]), min(bbox[3], pb[3]))
+    selected = self.plan(t0, t1, bbox, ranges, flights)
+
+    if columns is None:
+      common = None
+      for name in selected:
+        cols = list(self.catalog['flights'][name]['columns'])
+        common = cols if common is None else [k for k in common if k in cols]
+      columns = common if common is not None else list(REQUIRED)
+    filters = list(dict.fromkeys(list(REQUIRED) + list(ranges)))
+    read = list(dict.fromkeys(filters + list(columns)))
+
+    parts = {k: [] for k in columns}
+    names, rows = [], []
+    n_read = 0
+    for name, groups in selected.items():
+      maps = {k: self.column(name, k) for k in read}
+      for g in groups:
+        s = slice(g['start'], g['stop'])
+        n_read += g['stop'] - g['start']
+        lat, lon, tm = maps['lat'][s], maps['lon'][s], maps['time'][s]
+        mask = (tm >= t0) & (tm <= t1)
+        if bbox is not None:
+          mask &= (lat >= bbox[0]) & (lat <= bbox[2]) & (lon >= bbox[1]) & (lon <= bbox[3])
+        for k, (lo, hi) in ranges.items():
+          v = maps[k][s]
+          mask &= (v >= lo) & (v <= hi)
+        if polygon is not None and np.any(mask):
+          idx = np.flatnonzero(mask)
+          mask[idx] = point_in_polygon(lat[idx], lon[idx], polygon)
+        idx = np.flatnonzero(mask)
+        if len(idx) == 0:
+          continue
+        for k in columns:
+          parts[k].append(np.array(maps[k][s][idx]))
+        names.append(np.full(len(idx), name))
+        rows.append(g['start'] + idx)
+
+    data = {}
+    for k in columns:
+      data[k] = np.concatenate(parts[k]) if len(parts[k]) > 0 else np.zeros(0)
+    data['flight'] = np.concatenate(names) if len(names) > 0 else np.zeros(0, dtype=str)
+    data['row'] = np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=int)
+    stats = {'groups_read': sum(len(g) for g in selected.values()),
+             'groups_total': sum(len(e['row_groups']) for e in self.catalog['flights'].values()),
+             'rows_read': n_read,
+             'rows': len(data['row'])}
+    return data, stats
+
+  def __save(self):
+    tmp = self.catalog_file + '.part'
+    with open(tmp, 'w') as fh:
+      json.dump(self.catalog, fh)
+    os.replace(tmp, self.catalog_file)
+
+
+def _group_stats(arrays: dict, start: int, stop: int, scalars: list) -> dict:
+  lat, lon, tm = (arrays[k][start:stop] for k in ('lat', 'lon', 'time'))
+  stats = {}
+  for k in scalars:
+    v = arrays[k][start:stop]
+    v = v[np.isfinite(v)]
+    stats[k] = [float(v.min()), float(v.max())] if len(v) > 0 else None
+  return {'start': start, 'stop': stop,
+          't_min': float(tm[0]), 't_max': float(tm[-1]),
+          'bbox': [float(np.nanmin(lat)), float(np.nanmin(lon)),
+                   float(np.nanmax(lat)), float(np.nanmax(lon))],
+          'stats': stats}
+
+
+def _totals(groups: list) -> dict:
+  if len(groups) == 0:
+    return {'t_min': None, 't_max': None, 'bbox': None}
+  b = np.array([g['bbox'] for g in groups])
+  return {'t_min': groups[0]['t_min'], 't_max': groups[-1]['t_max'],
+          'bbox': [float(b[:, 0].min()), float(b[:, 1].min()), float(b[:, 2].max()), float(b[:, 3].max())]}
+
+
+def _overlaps(g: dict, t0: float, t1: float, bbox, ranges: dict) -> bool:
+  # True if a row group (or flight) may hold rows of the query
+  if g['t_max'] < t0 or g['t_min'] > t1:
+    return False
+  if bbox is not None:
+    b = g['bbox']
+    if b[2] < bbox[0] or b[0] > bbox[2] or b[3] < bbox[1] or b[1] > bbox[3]:
+      return False
+  for k, (lo, hi) in ranges.items():
+    mm = g['stats'].get(k)
+    if mm is None or mm[1] < lo or mm[0] > hi:
+      return False
+  return True
+
+
+def point_in_polygon(lat, lon, polygon) -> np.ndarray:
+
+  # Even-odd rule point in polygon test, vectorized over the points
+  #
+  # INPUTS:
+  #   lat, lon    Points (deg), shape (n,)
+  #   polygon     Vertices [(lat, lon), ...] (deg), closed implicitly
+  #
+  # OUTPUTS
+  #   inside      Boolean array (n,)
+
+  lat = np.asarray(lat, dtype=float)
+  lon = np.asarray(lon, dtype=float)
+  poly = np.asarray(polygon, dtype=float)
+  inside = np.zeros(len(lat), dtype=bool)
+  for (y0, x0), (y1, x1) in zip(poly, np.roll(poly, -1, axis=0)):
+    cross = (y0 > lat) != (y1 > lat)
+    if not np.any(cross):
+      continue
+    x = x0 + (lat[cross] - y0)*(x1 - x0)/(y1 - y0)
+    inside[cross] ^= lon[cross] < x
+  return inside
+
+
+def columns_from_out_profile(out_profile_data, time_offset: float = 0.0,
+                             sigma = None, sigma_names: list = None) -> dict:
+
+  # Archive columns of a fused solution
+  #
+  # INPUTS:
+  #   out_profile_data    lc_ins_gnss output (n, 19)
+  #   time_offset         Added to the time column (e.g. GPS week start)
+  #   sigma               Standard deviations from the fusion covariance,
+  #                       (n, k), or None
+  #   sigma_names         Names of the sigma columns (sigma_0 ... if None)
+  #
+  # OUTPUTS
+  #   {column: array}
+
+  out = np.asarray(out_profile_data, dtype=float)
+  cols = {name: out[:, i] for i, name in enumerate(PROFILE_COLUMNS)}
+  cols['time'] = cols['time'] + time_offset
+  if sigma is not None:
+    sigma = np.asarray(sigma, dtype=float).reshape(len(out), -1)
+    names = sigma_names or [f'sigma_{i}' for i in range(sigma.shape[1])]
+    for i, name in enumerate(names):
+      cols[name] = sigma[:, i]
+  return cols
+
+
+def columns_from_gdop_csv(fn: str, time_chn: str = c.CHN_TMS) -> dict:
+
+  # Archive columns of a Calc_manager output (*_gdop.csv)
+  #
+  # INPUTS:
+  #   fn          CSV file with the position channels and calc outputs
+  #   time_chn    Channel used as 'time' (sec)
+  #
+  # OUTPUTS
+  #   {column: array}; numeric columns only, Latitude/Longitude/Height
+  #   renamed lat/lon/alt
+
+  rename = {time_chn: 'time', c.CHN_LAT: 'lat', c.CHN_LON: 'lon', c.CHN_ALT: 'alt'}
+  with open(fn, 'r', newline='') as fh:
+    reader = csv.reader(fh)
+    titles = [t.strip() for t in next(reader)]
+    rows = [r for r in reader if len(r) == len(titles)]
+
+  cols = {}
+  for j, title in enumerate(titles):
+    try:
+      cols[rename.get(title, title)] = np.array([float(r[j]) for r in rows])
+    except ValueError:
+      pass
+  return cols
+
+
+def test():
+  import tempfile
+  import time
+
+  # 30 daily flights of 1 h at 10 Hz over three areas
+  rng = np.random.default_rng(3)
+  tmp = tempfile.mkdtemp()
+  try:
+    arc = Flight_archive(tmp)
+    day = 86400.0
+    areas = [(60.39, 5.32), (58.97, 5.73), (63.43, 10.39)]
+    for k in range(30):
+      n = 36000
+      t = 1.6e9 + k*day + np.arange(n)/10.0
+      lat0, lon0 = areas[k % 3]
+      lat = lat0 + 0.02*np.sin(t/600.0) + rng.normal(0, 1e-6, n)
+      lon = lon0 + 0.04*np.cos(t/900.0)
+      gdop = 1.5 + 3.0*(np.sin(t/300.0 + k) > 0.9) + rng.random(n)*0.2
+      arc.write(f'flight_{k:02d}', {'time': t, 'lat': lat, 'lon': lon, 'alt': 500 + 0*t,
+                                    'GDOP': gdop, 'ns': np.round(10 - gdop),
+                                    'sigma_pos': rng.random((n, 3))}, row_group_size=4096)
+
+    # Reopened from the catalog
+    arc = Flight_archive(tmp)
+    assert len(arc.flights()) == 30 and arc.info('flight_04')['columns']['sigma_pos'] == 3
+
+    # Epochs with GDOP > 4 inside a polygon in a 10 day window
+    poly = [(60.37, 5.30), (60.41, 5.30), (60.41, 5.36), (60.37, 5.34)]
+    t0, t1 = 1.6e9 + 9*day, 1.6e9 + 19*day
+    now = time.perf_counter()
+    data, stats = arc.query(t0, t1, polygon=poly, ranges={'GDOP': (4.0, np.inf)})
+    dt = time.perf_counter() - now
+
+    # Same result from a full scan
+    expect = 0
+    for name in arc.flights():
+      tm, la, lo, g = (np.asarray(arc.column(name, k)) for k in ('time', 'lat', 'lon', 'GDOP'))
+      m = (tm >= t0) & (tm <= t1) & (g >= 4.0)
+      m[m] = point_in_polygon(la[m], lo[m], poly)
+      expect += np.count_nonzero(m)
+    assert stats['rows'] == expect > 0
+    assert np.all(data['GDOP'] >= 4.0) and np.all((data['time'] >= t0) & (data['time'] <= t1))
+    assert data['sigma_pos'].shape == (expect, 3) and set(data['flight']) <= {f'flight_{k:02d}' for k in (9, 12, 15, 18)}
+    assert stats['groups_read'] < stats['groups_total']/20
+    print(f'{stats["rows"]} rows from {stats["groups_read"]} of {stats["groups_total"]} row groups '
+          f'({stats["rows_read"]} rows read) in {dt*1e3:.1f} ms')
+
+    # Fused solution and gdop CSV exporters
+    prof = np.zeros((100, 19))
+    prof[:, 0] = np.arange(100)*0.2
+    prof[:, 7], prof[:, 8] = 60.0, 5.0
+    cols = columns_from_out_profile(prof, time_offset=1.7e9, sigma=np.ones((100, 2)), sigma_names=['sN', 'sE'])
+    arc.write('fused', cols)
+    fn = os.path.join(tmp, 'x_gdop.csv')
+    with open(fn, 'w', newline='') as fh:
+      wr = csv.writer(fh)
+      wr.writerow([c.CHN_TMS, c.CHN_LAT, c.CHN_LON, c.CHN_ALT, c.CHN_UTC, 'GDOP'])
+      for i in range(50):
+        wr.writerow([i, 61.0, 6.0, 100.0, f'2021-12-03 08:00:{i:02d}', 2.0])
+    arc.write('csv', columns_from_gdop_csv(fn), source=fn)
+    data, stats = arc.query(bbox=(59.9, 4.9, 61.1, 6.1), flights=['fused', 'csv'], columns=['time', 'alt'])
+    assert stats['rows'] == 150 and stats['groups_read'] == 2
+    arc.remove('csv')
+    assert 'csv' not in Flight_archive(tmp).flights()
+  finally:
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  test()
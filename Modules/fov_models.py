@@ -1,9 +1,9 @@
 #Modified by Bourriz mohamed 2023
 from typing import List, Mapping, Tuple
-from pyproj import Transformer
 import numpy as np
 import datetime as dt
 import Modules.common as c
+from Modules.sat_block import Sat_block
 
 class FOV_model:
   def __init__(self):
@@ -21,11 +21,18 @@ class FOV_model:
     """
     raise Exception('SubClass.required_vars() not defined')
 
-  def get_sats(self, pos_data, sats_data) -> Mapping[str, Mapping[str, Tuple[float, float, float]]]:
+  def produces(self) -> List[str]:
     """
-      Return a container with the positions of all
+      Intermediates (calcs.INTERMEDIATES keys) stored in the cache by
+      get_sats, so the Calcs do not compute them again
+    """
+    return []
+
+  def get_sats(self, pos_data, sats_data, cache: dict = None) -> Sat_block:
+    """
+      Return a Sat_block with one epoch per row of pos_data and the
       visible satellites at every given time.\n
-      The heirarchy is: {'time': {'prn': (x,y,z) } }
+      block[time] gives the old heirarchy: {'time': {'prn': (x,y,z) } }
     """
     raise Exception('SubClass.get_sats() not defined')
 
@@ -47,48 +54,44 @@ class FOV_view_match(FOV_model):
     """
     return [c.CHN_LAT, c.CHN_LON, c.CHN_ALT, c.CHN_UTC, c.CHN_SAT]
 
-  def get_sats(self, pos_pos, sats_pos) -> Mapping[str, Mapping[str, Tuple[float, float, float]]]:
+  def produces(self) -> List[str]:
+    return ['rx_ecef']
+
+  def get_sats(self, pos_pos, sats_pos, cache: dict = None) -> Sat_block:
     """
       Calculate the satellites in view, given the measured amount of
       visible satellites, at every time and place.
     """
-    # Sats pos is ordered like:  times{} -> prn{} = (x,y,z)
-
-    # initialize output map
-    sats_LOS = {}
-    for t in pos_pos[c.CHN_UTC]:
-      sats_LOS[t] = {}
-
-    # Calculate best visible sats
-    for i in range(len(pos_pos[c.CHN_UTC])):
-      t   = pos_pos[c.CHN_UTC][i] # Timestamps from pos_data
-      n_s = int(pos_pos[c.CHN_SAT][i]) # n. of visible sats at 't'
-
-      lat = pos_pos[c.CHN_LAT][i]
-      lon = pos_pos[c.CHN_LON][i]
-      alt = pos_pos[c.CHN_ALT][i]
-
-      u = np.array(c.lla2ecef(lat, lon, alt))
-      u = u/np.linalg.norm(u)
-
-      dots = {}
-      # Calculate dot prod to all sats
-      for sat in sats_pos[t]:
-        p_s = np.array(sats_pos[t][sat])
-        p_s = p_s/np.linalg.norm(p_s)
-        product=np.dot(u,p_s)
-        dots[product] = sat        
-        
-      # Order in terms of largest abs value
-      ordered = sorted(dots.keys(), key=np.abs, reverse=True)
-
-      # Set the n_s most visible satellites as the ones in FOV
-      for j in range(n_s):
-        dot = ordered[j]
-        sat = dots[dot]
-        sats_LOS[t][sat] = sats_pos[t][sat]
-        # for verification
-        # print(sats_LOS) 
-    
-    # sats_LOS is ordered like:  times{} -> prn{} = (x,y,z)
-    return sats_LOS
\ No newline at end of file
+    # sats_pos is a Sat_block (or the old times{} -> prn{} = (x,y,z) dict)
+
+    # Receiver ECEF positions of all rows at once, shared with the Calcs
+    cache = {} if cache is None else cache
+    if 'rx_ecef' not in cache:
+      lat = np.asarray(pos_pos[c.CHN_LAT], dtype=float)
+      lon = np.asarray(pos_pos[c.CHN_LON], dtype=float)
+      alt = np.asarray(pos_pos[c.CHN_ALT], dtype=float)
+      cache['rx_ecef'] = np.stack(c.lla2ecef(lat, lon, alt), axis=-1).reshape(-1, 3)
+
+    # Epochs of the sampled rows (a view of the block when in order)
+    if not isinstance(sats_pos, Sat_block):
+      sats_pos = Sat_block.from_dict(sats_pos)
+    idx = sats_pos.index_of(list(pos_pos[c.CHN_UTC]))
+    if np.any(idx < 0):
+      raise KeyError(f'No satellite positions at {pos_pos[c.CHN_UTC][int(np.argmax(idx < 0))]}')
+    rows = sats_pos.take(idx)
+
+    # Dot products of the receiver and satellite directions, all rows at once
+    u = cache['rx_ecef']/np.linalg.norm(cache['rx_ecef'], axis=1, keepdims=True)
+    p_s = rows.pos/np.linalg.norm(rows.pos, axis=-1, keepdims=True)
+    dots = np.abs(np.einsum('ij,isj->is', u, p_s))
+    dots = np.where(rows.visible & np.isfinite(dots), dots, -1.0)
+
+    # Set the n_s most visible satellites (largest abs value) as the ones in FOV
+    n_s = np.asarray(pos_pos[c.CHN_SAT], dtype=float).astype(int)
+    order = np.argsort(-dots, axis=1, kind='stable')
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.arange(order.shape[1])[None, :], axis=1)
+    in_fov = (rank < n_s[:, None]) & (dots >= 0)
+
+    # sats_LOS: same epochs and positions, block[t][prn] = (x,y,z)
+    return rows.with_visible(in_fov)
\ No newline at end of file
@@ -0,0 +1,367 @@
+###############################################################################
+# File:  fusion_bench.py
+#
+# Description:
+# Speed and accuracy regression benchmark of the loosely coupled fusion
+# (lc_ins_gnss.run_LC_EKF: INS_Equations_NED, Get_dem_EKF_matrices, the
+# correction step, ...) on synthetic flights with a known truth.
+#
+# Flights are generated deterministically (fixed seeds) from kinematic
+# profiles of speed, heading rate and vertical speed:
+#
+#   straight   constant speed and heading
+#   survey     photogrammetry lines joined by 180 deg coordinated turns
+#   climb      climbs and descents on a slow turn
+#
+# The truth (200 Hz) gives the IMU through the same navigation equations
+# as the mechanization (WGS84 gravity, earth and transport rates,
+# coordinated bank), with constant biases and white noise added. The
+# heading aiding of lc_ins_gnss takes the track + 180 deg as yaw, so the
+# IMU is mounted as the pipeline expects: x axis aft, y to the left (the
+# truth attitude is the one of this frame). GNSS fixes at 5 Hz get white
+# position and velocity noise and are held between fixes, as in
+# in_profile_data.
+#
+# Each case (flight x filter variant of VARIANTS) records epochs/s, the
+# peak memory of the run (tracemalloc, in a second run) and the RMSE of
+# position, velocity and attitude after `settle` seconds. The results are
+# kept as JSON, and compare() lists the regressions against a baseline
+# beyond THRESHOLDS:
+#
+#   results = run_bench()
+#   write_json(results, 'bench.json')
+#   failures = compare(results, read_json('baseline.json'))
+#
+# or: python -m Modules.cli bench --baseline baseline.json
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import datetime as dt
+import json
+import platform
+import time
+import tracemalloc
+from collections import namedtuple
+
+from Modules.ins_nav import a, f, e, mu, omega_ie, RTOD, DTOR
+from Modules.ins_ekf import data_packet
+from Modules.lc_ins_gnss import run_LC_EKF
+from Modules.d_print import Info
+
+IMU_RATE = 200.0
+GNSS_RATE = 5.0
+
+# Sensor errors of the generated flights (1 sigma)
+NOISE = {'gnss_pos': 0.5,          # m
+         'gnss_vel': 0.05,         # m/s
+         'accel_bias': 0.02,       # m/s^2
+         'accel_noise': 0.05,      # m/s^2 per sample
+         'gyro_bias': 0.01*DTOR,   # rad/s
+         'gyro_noise': 0.002}      # rad/s per sample
+
+# Filter variants: run_LC_EKF options
+VARIANTS = {'full': {},
+            'block40': {'cov_decimation': 40},
+            'preint4': {'cov_decimation': 10, 'mech_decimation': 4}}
+
+SCENARIOS = ('straight', 'survey', 'climb')
+
+# Allowed regressions against a baseline: relative slowdown, relative
+# memory growth, relative RMSE growth above an absolute tolerance
+THRESHOLDS = {'speed': 0.25, 'memory': 0.25, 'rmse': 0.10, 'rmse_abs': 1e-3}
+
+# name, run_LC_EKF input, truth [time, lat, lon (rad), alt, vN, vE, vD,
+# roll, pitch, yaw (rad)] of every IMU row, filter parameters
+Synthetic_flight = namedtuple('Synthetic_flight', ['name', 'in_profile_data', 'truth', 'KF_param'])
+
+
+def _smooth_steps(t, edges, values, ramp):
+  # Piecewise constant profile with raised cosine transitions of `ramp` sec
+  out = np.full(t.shape, float(values[0]))
+  for edge, v0, v1 in zip(edges, values[:-1], values[1:]):
+    s = np.clip((t - edge)/ramp + 0.5, 0.0, 1.0)
+    out += (v1 - v0)*0.5*(1.0 - np.cos(np.pi*s))
+  return out
+
+
+def _profile(name: str, t):
+  # Speed (m/s), heading rate (rad/s), down velocity (m/s) of a scenario
+  duration = t[-1]
+  if name == 'straight':
+    return np.full(t.shape, 40.0), np.zeros(t.shape), np.zeros(t.shape)
+  if name == 'survey':
+    # 60 s lines, 30 s turns at 6 deg/s, alternating direction
+    edges, rates = [], [0.0]
+    for k, start in enumerate(np.arange(20.0, duration, 90.0)):
+      edges += [start, start + 30.0]
+      rates += [(1 if k % 2 == 0 else -1)*6.0*DTOR, 0.0]
+    return np.full(t.shape, 40.0), _smooth_steps(t, edges, rates, 3.0), np.zeros(t.shape)
+  if name == 'climb':
+    edges = list(np.arange(15.0, duration, 30.0))
+    climbs = [0.0] + [(-3.0 if k % 2 == 0 else 3.0) for k in range(len(edges))]
+    return (_smooth_steps(t, edges, [35.0] + [35.0 + 5*(k % 2) for k in range(len(edges))], 5.0),
+            np.full(t.shape, 1.0*DTOR), _smooth_steps(t, edges, climbs, 5.0))
+  raise ValueError(f'Unknown scenario "{name}", expected one of {SCENARIOS}')
+
+
+def _radii(lat):
+  RN = a*(1.0 - e**2)/(1.0 - e**2*np.sin(lat)**2)**1.5
+  RE = a/np.sqrt(1.0 - e**2*np.sin(lat)**2)
+  return RN, RE
+
+
+def _gravity(lat, alt):
+  # Down gravity of INS_Equations_NED (WGS84 with altitude factor)
+  g0 = 9.7803253359/np.sqrt(1 - f*(2.0 - f)*np.sin(lat)**2)*(1.0 + 0.0019311853*np.sin(lat)**2)
+  ch = 1.0 - 2.0*(1.0 + f + (a**3*(1 - f)*omega_ie**2)/mu)*(alt/a) + 3.0*(alt/a)**2
+  return ch*g0
+
+
+def _dcm(roll, pitch, yaw):
+  # Body to NED rotation of every sample (n, 3, 3), as Euler_to_CTM
+  cr, sr, cp, sp, cy, sy = np.cos(roll), np.sin(roll), np.cos(pitch), np.sin(pitch), np.cos(yaw), np.sin(yaw)
+  return np.stack([np.stack([cp*cy, -cr*sy + sr*sp*cy, sr*sy + cr*sp*cy], axis=-1),
+                   np.stack([cp*sy, cr*cy + sr*sp*sy, -sr*cy + cr*sp*sy], axis=-1),
+                   np.stack([-sp, sr*cp, cr*cp], axis=-1)], axis=-2)
+
+
+def _cumtrapz(y, dt):
+  return np.concatenate([np.zeros((1,) + y.shape[1:]), np.cumsum(0.5*(y[1:] + y[:-1])*dt, axis=0)])
+
+
+def synthetic_flight(name: str, duration: float = 120.0, seed: int = 0,
+                     start=(60.39*DTOR, 5.32*DTOR, 500.0), noise: dict = NOISE) -> Synthetic_flight:
+
+  # Deterministic synthetic flight
+  #
+  # INPUTS:
+  #   name        Scenario (SCENARIOS)
+  #   duration    Length (sec)
+  #   seed        Seed of the sensor noise
+  #   start       Initial lat, lon (rad), alt (m)
+  #   noise       Sensor errors (NOISE)
+  #
+  # OUTPUTS
+  #   Synthetic_flight with in_profile_data at IMU_RATE, GNSS at GNSS_RATE
+
+  ts = 1.0/IMU_RATE
+  n = int(round(duration*IMU_RATE)) + 1
+  t = np.arange(n)*ts
+  speed, yaw_rate, vD = _profile(name, t)
+
+  # Truth: velocity from the profile, position integrated on the ellipsoid
+  yaw = 30.0*DTOR + _cumtrapz(yaw_rate, ts)
+  v_n = np.stack([speed*np.cos(yaw), speed*np.sin(yaw), vD], axis=-1)
+  lat = np.empty(n)
+  lon = np.empty(n)
+  alt = start[2] - _cumtrapz(vD, ts)
+  lat[0], lon[0] = start[0], start[1]
+  for k in range(1, n):
+    RN, RE = _radii(lat[k - 1])
+    lat[k] = lat[k - 1] + ts*0.5*(v_n[k - 1, 0] + v_n[k, 0])/(RN + alt[k - 1])
+    lon[k] = lon[k - 1] + ts*0.5*(v_n[k - 1, 1] + v_n[k, 1])/((RE + alt[k - 1])*np.cos(lat[k - 1]))
+
+  # Coordinated bank and flight path pitch, in the IMU frame (x aft, y left)
+  g = _gravity(lat, alt)
+  roll = -np.arctan(speed*yaw_rate/g)
+  pitch = -np.arctan2(-vD, speed)
+  yaw = yaw + np.pi
+  C = _dcm(roll, pitch, yaw)
+
+  # Specific force and angular rate through the navigation equations
+  RN, RE = _radii(lat)
+  w_ie = omega_ie*np.stack([np.cos(lat), np.zeros(n), -np.sin(lat)], axis=-1)
+  w_en = np.stack([v_n[:, 1]/(RE + alt), -v_n[:, 0]/(RN + alt), -v_n[:, 1]*np.tan(lat)/(RE + alt)], axis=-1)
+  g_n = np.stack([np.zeros(n), np.zeros(n), g], axis=-1)
+  f_n = np.gradient(v_n, ts, axis=0) - g_n + np.cross(2.0*w_ie + w_en, v_n)
+  f_b = np.einsum('nji,nj->ni', C, f_n)
+
+  droll, dpitch, dyaw = np.gradient(roll, ts), np.gradient(pitch, ts), np.gradient(yaw, ts)
+  w_nb = np.stack([droll - np.sin(pitch)*dyaw,
+                   np.cos(roll)*dpitch + np.sin(roll)*np.cos(pitch)*dyaw,
+                   -np.sin(roll)*dpitch + np.cos(roll)*np.cos(pitch)*dyaw], axis=-1)
+  w_ib = w_nb + np.einsum('nji,nj->ni', C, w_ie + w_en)
+
+  # Sensors
+  rng = np.random.default_rng(seed)
+  accel = f_b + rng.normal(0, noise['accel_bias'], 3) + rng.normal(0, noise['accel_noise'], (n, 3))
+  gyro = w_ib + rng.normal(0, noise['gyro_bias'], 3) + rng.normal(0, noise['gyro_noise'], (n, 3))
+
+  step = int(round(IMU_RATE/GNSS_RATE))
+  fix = np.arange(0, n, step)
+  held = np.repeat(fix, step)[:n]
+  gnss_lla = np.stack([lat[fix] + rng.normal(0, noise['gnss_pos'], len(fix))/(RN[fix] + alt[fix]),
+                       lon[fix] + rng.normal(0, noise['gnss_pos'], len(fix))/((RE[fix] + alt[fix])*np.cos(lat[fix])),
+                       alt[fix] + rng.normal(0, noise['gnss_pos'], len(fix))], axis=-1)
+  gnss_vel = v_n[fix] + rng.normal(0, noise['gnss_vel'], (len(fix), 3))
+
+  ip = np.zeros((n, 16))
+  ip[:, 0] = 467000.0 + t
+  ip[:, 1:4] = gnss_lla[held//step]
+  ip[:, 4:7] = gnss_vel[held//step]
+  ip[:, 7:10] = gyro
+  ip[:, 10:13] = accel
+  ip[:, 13:16] = np.stack([roll, pitch, yaw], axis=-1)
+
+  truth = np.column_stack([ip[:, 0], lat, lon, alt, v_n, roll, pitch, yaw])
+  KF_param = data_packet((noise['gnss_pos'], noise['gnss_vel'], np.zeros(3), noise['accel_noise'],
+                          np.zeros(3), noise['gyro_noise']))
+  return Synthetic_flight(name, ip, truth, KF_param)
+
+
+def accuracy(out_profile_data, truth, settle: float = 10.0) -> dict:
+
+  # RMSE of a fused solution against the truth
+  #
+  # INPUTS:
+  #   out_profile_data  run_LC_EKF output
+  #   truth             Synthetic_flight.truth
+  #   settle            Seconds skipped at the start (convergence)
+  #
+  # OUTPUTS
+  #   RMSE: pos_h, pos_v (m), vel (m/s, 3D), roll, pitch, yaw (deg)
+
+  k = np.searchsorted(truth[:, 0], out_profile_data[:, 0])
+  m = (k < len(truth)) & (out_profile_data[:, 0] >= truth[0, 0] + settle)
+  out, ref = out_profile_data[m], truth[k[m]]
+  RN, RE = _radii(ref[:, 1])
+  dN = (out[:, 7]*DTOR - ref[:, 1])*(RN + ref[:, 3])
+  dE = (out[:, 8]*DTOR - ref[:, 2])*(RE + ref[:, 3])*np.cos(ref[:, 1])
+  att = out[:, 1:4] - ref[:, 7:10]*RTOD
+  att = (att + 180.0) % 360.0 - 180.0
+
+  def rms(x):
+    return float(np.sqrt(np.mean(x**2)))
+  return {'pos_h': rms(np.hypot(dN, dE)), 'pos_v': rms(out[:, 9] - ref[:, 3]),
+          'vel': rms(np.linalg.norm(out[:, 4:7] - ref[:, 4:7], axis=1)),
+          'roll': rms(att[:, 0]), 'pitch': rms(att[:, 1]), 'yaw': rms(att[:, 2])}
+
+
+def run_case(flight: Synthetic_flight, options: dict, memory: bool = True, settle: float = 10.0) -> dict:
+  """
+    One filter run of a flight: speed, peak memory and accuracy
+  """
+  n = len(flight.in_profile_data)
+  # Update at every fix: half an IMU period below the GNSS period
+  interval = 1.0/GNSS_RATE - 0.5/IMU_RATE
+
+  now = time.perf_counter()
+  out = run_LC_EKF(flight.in_profile_data, n, flight.KF_param, interval, **options)
+  seconds = time.perf_counter() - now
+
+  peak = float('nan')
+  if memory:
+    tracemalloc.start()
+    run_LC_EKF(flight.in_profile_data, n, flight.KF_param, interval, **options)
+    peak = tracemalloc.get_traced_memory()[1]/1e6
+    tracemalloc.stop()
+  return {'epochs': n, 'seconds': seconds, 'epochs_per_s': n/seconds, 'peak_mb': peak,
+          'rmse': accuracy(out, flight.truth, settle)}
+
+
+def run_bench(scenarios=SCENARIOS, variants: dict = VARIANTS, duration: float = 120.0,
+              seed: int = 0, memory: bool = True) -> dict:
+  """
+    All cases 'scenario/variant', with the versions they ran on
+  """
+  import scipy
+  results = {'meta': {'date': dt.datetime.now(dt.timezone.utc).isoformat(timespec='seconds'),
+                      'python': platform.python_version(), 'numpy': np.__version__,
+                      'scipy': scipy.__version__, 'machine': platform.platform(),
+                      'duration': duration, 'seed': seed},
+             'cases': {}}
+  for name in scenarios:
+    flight = synthetic_flight(name, duration, seed)
+    for variant, options in variants.items():
+      case = run_case(flight, options, memory)
+      results['cases'][f'{name}/{variant}'] = case
+      r = case['rmse']
+      Info(f'{name + "/" + variant:18} {case["epochs_per_s"]:8.0f} epochs/s {case["peak_mb"]:7.1f} MB  '
+            f'pos {r["pos_h"]:.2f}/{r["pos_v"]:.2f} m  vel {r["vel"]:.3f} m/s  '
+            f'att {r["roll"]:.2f}/{r["pitch"]:.2f}/{r["yaw"]:.2f} deg')
+  return results
+
+
+def compare(results: dict, baseline: dict, thresholds: dict = THRESHOLDS) -> list:
+  """
+    Regressions of results against baseline (list of messages, empty if
+    none). Cases missing from either side are not compared.
+  """
+  failures = []
+  for case, base in baseline['cases'].items():
+    if case not in results['cases']:
+      continue
+    cur = results['cases'][case]
+    if cur['epochs_per_s'] < base['epochs_per_s']*(1.0 - thresholds['speed']):
+      failures.append(f'{case}: {cur["epochs_per_s"]:.0f} epochs/s, baseline {base["epochs_per_s"]:.0f}')
+    if np.isfinite(cur['peak_mb']) and np.isfinite(base['peak_mb']) \
+       and cur['peak_mb'] > base['peak_mb']*(1.0 + thresholds['memory']):
+      failures.append(f'{case}: peak {cur["peak_mb"]:.1f} MB, baseline {base["peak_mb"]:.1f} MB')
+    for name, value in cur['rmse'].items():
+      ref = base['rmse'].get(name, np.inf)
+      if value > ref*(1.0 + thresholds['rmse']) + thresholds['rmse_abs']:
+        failures.append(f'{case}: {name} RMSE {value:.4f}, baseline {ref:.4f}')
+  return failures
+
+
+def write_json(results: dict, fn: str) -> None:
+  with open(fn, 'w') as fh:
+    json.dump(results, fh, indent=2, allow_nan=True)
+
+
+def read_json(fn: str) -> dict:
+  with open(fn, 'r') as fh:
+    return json.load(fh)
+
+
+def test():
+  import os
+  import tempfile
+  import shutil
+
+  # Deterministic flights, IMU consistent with the truth
+  a1 = synthetic_flight('survey', 40.0)
+  a2 = synthetic_flight('survey', 40.0)
+  assert np.array_equal(a1.in_profile_data, a2.in_profile_data)
+  assert not np.array_equal(synthetic_flight('survey', 40.0, seed=1).in_profile_data, a1.in_profile_data)
+  from Modules.ins_nav import Euler_to_CTM
+  r = a1.truth[1000]
+  assert np.allclose(_dcm(*r[7:10]), Euler_to_CTM(r[7:10]))
+  assert len(a1.in_profile_data) == 40*200 + 1 and np.max(np.abs(a1.truth[:, 7]))*RTOD > 5.0
+
+  # Noise-free straight flight: the mechanization alone follows the truth
+  quiet = {k: 0.0 for k in NOISE}
+  flight = synthetic_flight('straight', 20.0, noise=quiet)
+  from Modules.ins_nav import INS_Equations_NED, Euler_to_CTM
+  ip, truth = flight.in_profile_data, flight.truth
+  lat, lon, alt, v, C = truth[0, 1], truth[0, 2], truth[0, 3], truth[0, 4:7].copy(), Euler_to_CTM(truth[0, 7:10])
+  for k in range(1, len(ip)):
+    C, v, lat, lon, alt = INS_Equations_NED(1/IMU_RATE, lat, lon, alt, v, C, ip[k, 7:10], ip[k, 10:13], truth[k - 1, 9])
+  RN, RE = _radii(lat)
+  drift = np.hypot((lat - truth[-1, 1])*RN, (lon - truth[-1, 2])*RE*np.cos(lat))
+  print(f'Noise-free mechanization over 20 s: {drift:.3f} m horizontal drift')
+  assert drift < 1.0
+
+  # Short benchmark, compare with itself and with a better baseline
+  results = run_bench(scenarios=('survey', 'climb'), variants={'block40': VARIANTS['block40']}, duration=30.0)
+  for case in results['cases'].values():
+    assert case['rmse']['pos_h'] < 2.0 and case['peak_mb'] > 0
+  tmp = tempfile.mkdtemp()
+  try:
+    fn = os.path.join(tmp, 'bench.json')
+    write_json(results, fn)
+    baseline = read_json(fn)
+  finally:
+    shutil.rmtree(tmp)
+  assert compare(results, baseline) == []
+  baseline['cases']['survey/block40']['epochs_per_s'] *= 2
+  baseline['cases']['climb/block40']['rmse']['pos_h'] /= 2
+  failures = compare(results, baseline)
+  print('\n'.join(failures))
+  assert len(failures) == 2
+
+
+if __name__ == '__main__':
+  test()
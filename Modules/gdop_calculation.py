@@ -30,7 +30,6 @@ import reader_pos_data as ddr
 import reader_rinex as rr
 import d_print as p
 import common as c
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 
 
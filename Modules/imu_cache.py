@@ -0,0 +1,275 @@
+###############################################################################
+# File:  imu_cache.py
+#
+# Description:
+# Binary columnar cache of the IMU log (IMU_Data.csv). The CSV is parsed once,
+# in chunks, with the mounting rotation applied, and written as one raw
+# little-endian float64 file per quantity:
+#
+#   time.f8    (n,)    IMU time (sec)
+#   gyro.f8    (n, 3)  meas_omega_ib_b after mounting_g (rad/s)
+#   accel.f8   (n, 3)  meas_f_ib_b after mounting (m/s^2)
+#   rpy.f8     (n, 3)  roll/pitch/heading after mounting (rad)
+#   meta.json          row count, mountings, source size/mtime and the
+#                      initial bias estimate of get_all_INS_GNSS_data
+#
+# Loading maps the files read-only (np.memmap), so nothing is copied or
+# parsed; window() slices a time interval with a binary search on the time
+# column and only touches the pages of that interval.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import json
+import os
+import math as ma
+
+
+# IMU mounting of 5_LC_INS_GNSS.ipynb (accel/attitude, gyro)
+MOUNTING = np.array([[-1, 0, 0], [0, -1, 0], [0, 0, 1]])
+MOUNTING_G = np.array([[1, 0, 0], [0, -1, 0], [0, 0, -1]])
+
+CACHE_VERSION = 1
+COLUMNS = {'time': 1, 'gyro': 3, 'accel': 3, 'rpy': 3}
+
+
+class IMU_cache_writer:
+  def __init__(self, cache_dir: str, start_time: float = 467000):
+    self.cache_dir = cache_dir
+    self.start_time = start_time
+    self.rows = 0
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    self.files = {name: open(os.path.join(cache_dir, name + '.f8'), 'wb') for name in COLUMNS}
+
+    # Running sums of the bias estimate (samples before start_time)
+    self.n_bias = 0
+    self.acc_sum = np.zeros(3)
+    self.gyro_sum = np.zeros(3)
+    self.acc_sigma = 0.0
+    self.gyro_sigma = 0.0
+
+  def append(self, time, gyro, accel, rpy_deg) -> None:
+    """
+      Append a chunk of raw IMU samples (body axes before mounting,
+      attitude in degrees).
+    """
+    time = np.asarray(time, dtype='<f8')
+    gyro = np.asarray(gyro, dtype=float)@MOUNTING_G
+    accel = np.asarray(accel, dtype=float)@MOUNTING
+    rpy = (np.asarray(rpy_deg, dtype=float)*np.pi/180.0)@MOUNTING.T
+
+    self.__accumulate_bias(time, gyro, accel)
+    for name, col in (('time', time), ('gyro', gyro), ('accel', accel), ('rpy', rpy)):
+      self.files[name].write(np.ascontiguousarray(col, dtype='<f8').tobytes())
+    self.rows += len(time)
+
+  def close(self, source: str = '') -> dict:
+    """
+      Finish the files and write meta.json. Returns the metadata.
+    """
+    for fh in self.files.values():
+      fh.close()
+
+    n = max(self.n_bias, 1)
+    meta = {'version': CACHE_VERSION,
+            'rows': self.rows,
+            'mounting': MOUNTING.tolist(),
+            'mounting_g': MOUNTING_G.tolist(),
+            'start_time': self.start_time,
+            'bias_samples': self.n_bias,
+            'init_accel_bias': (self.acc_sum/n).tolist(),
+            'init_accel_sigma': self.acc_sigma/n,
+            'init_gyro_bias': (self.gyro_sum/n).tolist(),
+            'init_gyro_sigma': self.gyro_sigma/n}
+    if source != '':
+      st = os.stat(source)
+      meta['source'] = os.path.abspath(source)
+      meta['source_size'] = st.st_size
+      meta['source_mtime'] = st.st_mtime
+    with open(os.path.join(self.cache_dir, 'meta.json'), 'w') as fh:
+      json.dump(meta, fh, indent=1)
+    return meta
+
+  def __accumulate_bias(self, time, gyro, accel) -> None:
+    # Same estimate as the loop of get_all_INS_GNSS_data: the running sum,
+    # not the running mean, enters the sigma term
+    if self.rows > self.n_bias:
+      return                  # start_time already reached
+    m = int(np.searchsorted(time, self.start_time, side='left'))
+    if m == 0:
+      return
+    acc_cs = self.acc_sum + np.cumsum(accel[:m], axis=0)
+    gyro_cs = self.gyro_sum + np.cumsum(gyro[:m], axis=0)
+    self.acc_sigma += float(np.sum(np.linalg.norm(accel[:m] - acc_cs, axis=1)/3))
+    self.gyro_sigma += float(np.sum(np.linalg.norm(gyro[:m] - gyro_cs, axis=1)/3))
+    self.acc_sum = acc_cs[-1]
+    self.gyro_sum = gyro_cs[-1]
+    self.n_bias += m
+
+
+class IMU_cache:
+  def __init__(self, cache_dir: str):
+    self.cache_dir = cache_dir
+    with open(os.path.join(cache_dir, 'meta.json')) as fh:
+      self.meta = json.load(fh)
+
+    n = self.meta['rows']
+    for name, width in COLUMNS.items():
+      fn = os.path.join(cache_dir, name + '.f8')
+      shape = (n,) if width == 1 else (n, width)
+      col = np.memmap(fn, dtype='<f8', mode='r', shape=shape) if n > 0 else np.zeros(shape)
+      setattr(self, name, col)
+
+  def __len__(self):
+    return self.meta['rows']
+
+  def init_params(self):
+    """
+      (init_accel_bias, accel sigma, init_gyro_bias, gyro sigma) estimated
+      from the samples before start_time.
+    """
+    m = self.meta
+    return (np.array(m['init_accel_bias']), m['init_accel_sigma'],
+            np.array(m['init_gyro_bias']), m['init_gyro_sigma'])
+
+  def index(self, t: float, side: str = 'left') -> int:
+    """
+      Row of the first sample at or after t (binary search on the time
+      column).
+    """
+    return int(np.searchsorted(self.time, t, side=side))
+
+  def window(self, t0: float = -ma.inf, t1: float = ma.inf):
+    """
+      Zero-copy views (time, gyro, accel, rpy) of the samples t0 <= t <= t1.
+    """
+    i0 = self.index(t0, 'left')
+    i1 = self.index(t1, 'right')
+    return self.time[i0:i1], self.gyro[i0:i1], self.accel[i0:i1], self.rpy[i0:i1]
+
+
+def is_fresh(cache_dir: str, csv_file: str, start_time: float) -> bool:
+
+  # Check that a cache exists and was built from the current CSV
+  #
+  # INPUTS:
+  #   cache_dir   Cache folder
+  #   csv_file    IMU CSV file
+  #   start_time  Start time the bias estimate must refer to
+  #
+  # OUTPUTS
+  #   True if the cache can be used as is
+
+  fn = os.path.join(cache_dir, 'meta.json')
+  if not os.path.exists(fn):
+    return False
+  with open(fn) as fh:
+    meta = json.load(fh)
+  st = os.stat(csv_file)
+  return (meta.get('version') == CACHE_VERSION
+          and meta.get('source_size') == st.st_size
+          and meta.get('source_mtime') == st.st_mtime
+          and meta.get('start_time') == start_time)
+
+
+def build_imu_cache(csv_file: str, cache_dir: str, start_time: float = 467000,
+                    chunksize: int = 200000) -> IMU_cache:
+
+  # Convert an IMU CSV log (columns Time, Xang..Zang, Xacc..Zacc, roll,
+  # pitch, heading; ';' separated) into the columnar cache
+  #
+  # INPUTS:
+  #   csv_file    IMU_Data.csv
+  #   cache_dir   Output folder
+  #   start_time  First time of the fusion, samples before it give the
+  #               initial bias estimate
+  #   chunksize   CSV rows parsed at once
+  #
+  # OUTPUTS
+  #   IMU_cache of the new files
+
+  import pandas as pd   # only needed to build, not to load
+
+  writer = IMU_cache_writer(cache_dir, start_time)
+  cols = ['Time', 'Xang', 'Yang', 'Zang', 'Xacc', 'Yacc', 'Zacc', 'roll', 'pitch', 'heading']
+  for chunk in pd.read_csv(csv_file, sep=';', usecols=cols, chunksize=chunksize):
+    writer.append(chunk['Time'].to_numpy(),
+                  chunk[['Xang', 'Yang', 'Zang']].to_numpy(),
+                  chunk[['Xacc', 'Yacc', 'Zacc']].to_numpy(),
+                  chunk[['roll', 'pitch', 'heading']].to_numpy())
+  writer.close(csv_file)
+  return IMU_cache(cache_dir)
+
+
+def get_IMU_cache(folder: str, csv_name: str = 'IMU_Data.csv',
+                  start_time: float = 467000) -> IMU_cache:
+
+  # Open the cache of folder/csv_name, building it when missing or stale
+  #
+  # INPUTS:
+  #   folder      Folder of the IMU CSV
+  #   csv_name    IMU CSV file name
+  #   start_time  See build_imu_cache
+  #
+  # OUTPUTS
+  #   IMU_cache
+
+  csv_file = os.path.join(folder, csv_name)
+  cache_dir = os.path.join(folder, os.path.splitext(csv_name)[0] + '.imucache')
+  if is_fresh(cache_dir, csv_file, start_time):
+    return IMU_cache(cache_dir)
+  return build_imu_cache(csv_file, cache_dir, start_time)
+
+
+def test():
+  import tempfile
+  import shutil
+
+  rng = np.random.default_rng(1)
+  n = 50000
+  time = 466990 + np.arange(n)/200.0
+  gyro = rng.normal(0.01, 0.001, (n, 3))
+  accel = rng.normal([0.1, -0.2, 9.8], 0.05, (n, 3))
+  rpy_deg = rng.normal(0.0, 5.0, (n, 3))
+
+  tmp = tempfile.mkdtemp()
+  try:
+    # Written in uneven chunks, as the CSV reader would
+    writer = IMU_cache_writer(os.path.join(tmp, 'imu'), start_time=467000)
+    for i0 in range(0, n, 7001):
+      writer.append(time[i0:i0+7001], gyro[i0:i0+7001], accel[i0:i0+7001], rpy_deg[i0:i0+7001])
+    writer.close()
+    cache = IMU_cache(os.path.join(tmp, 'imu'))
+
+    assert np.array_equal(cache.gyro, gyro@MOUNTING_G)
+    assert np.array_equal(cache.accel, accel@MOUNTING)
+    assert np.allclose(cache.rpy, (MOUNTING@(rpy_deg*np.pi/180.0).T).T)
+
+    # Bias estimate against the loop of get_all_INS_GNSS_data
+    f = accel@MOUNTING
+    w = gyro@MOUNTING_G
+    acc_b, acc_s, gyro_b, gyro_s = np.zeros(3), 0.0, np.zeros(3), 0.0
+    i = 0
+    while time[i] < 467000:
+      acc_b += f[i]
+      acc_s += ma.sqrt((f[i] - acc_b)@(f[i] - acc_b).T)/3
+      gyro_b += w[i]
+      gyro_s += ma.sqrt((w[i] - gyro_b)@(w[i] - gyro_b).T)/3
+      i += 1
+    est = cache.init_params()
+    assert np.allclose(est[0], acc_b/i) and np.isclose(est[1], acc_s/i)
+    assert np.allclose(est[2], gyro_b/i) and np.isclose(est[3], gyro_s/i)
+
+    # Time window is a view on the mapped file
+    t, g, acc, rpy = cache.window(467100.0, 467101.0)
+    assert len(t) == 201 and t[0] == 467100.0 and isinstance(g, np.memmap)
+    print(f'{len(cache)} samples cached, bias from {cache.meta["bias_samples"]} samples, '
+          f'window of {len(t)} samples')
+  finally:
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  test()
@@ -0,0 +1,253 @@
+###############################################################################
+# File:  imu_preintegration.py
+#
+# Description:
+# Compresses groups of N high-rate IMU samples into delta-angle and
+# delta-velocity increments with coning and sculling compensation (Savage
+# recursive form), and a DCM mechanization that consumes those increments.
+# Used by run_LC_EKF(mech_decimation=N) to run the navigation equations at
+# 1/N of the IMU rate.
+#
+# Within an interval of samples i = 1..N (dtheta_i = w_i*dt_i, dv_i = f_i*dt_i):
+#   alpha_i = sum dtheta,   nu_i = sum dv
+#   coning  = 1/2 sum (alpha_(i-1) + dtheta_(i-1)/6) x dtheta_i
+#   sculling= 1/2 sum (alpha_(i-1) + dtheta_(i-1)/6) x dv_i
+#                   + (nu_(i-1) + dv_(i-1)/6) x dtheta_i
+#   d_theta = alpha_N + coning
+#   d_v     = nu_N + 1/2 alpha_N x nu_N + sculling
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+from Modules.ins_nav import a, f, e, mu, omega_ie, CTM_to_Euler, Euler_to_CTM
+
+
+def preintegrate(time, omega_ib_b, f_ib_b, n: int):
+
+  # Pre-integrate IMU samples in groups of n
+  #
+  # INPUTS:
+  #   time        IMU sample times (sec), shape (k,)
+  #   omega_ib_b  Body angular rates (rad/sec), shape (k, 3)
+  #   f_ib_b      Body specific force (m/sec^2), shape (k, 3)
+  #   n           Samples per increment
+  #
+  # OUTPUTS
+  #   rows        Index of the last sample of each interval (rows[0] = 0)
+  #   d_theta     Compensated delta-angles (rad), shape (len(rows), 3)
+  #   d_v         Compensated delta-velocities (m/sec), shape (len(rows), 3)
+  #
+  # Sample i integrates over (time[i-1], time[i]], so the first interval
+  # starts at sample 0. Trailing samples that do not fill an interval are
+  # dropped. Row 0 of d_theta/d_v is zero.
+
+  time = np.asarray(time, dtype=float)
+  omega_ib_b = np.asarray(omega_ib_b, dtype=float)
+  f_ib_b = np.asarray(f_ib_b, dtype=float)
+  n = max(int(n), 1)
+
+  m = (len(time) - 1)//n
+  rows = np.arange(m + 1)*n
+
+  dt = np.diff(time[:m*n + 1])[:, None]
+  dth = (omega_ib_b[1:m*n + 1]*dt).reshape(m, n, 3)
+  dvl = (f_ib_b[1:m*n + 1]*dt).reshape(m, n, 3)
+
+  # Running sums up to the previous sample, and the previous sample itself
+  alpha = np.cumsum(dth, axis=1)
+  nu = np.cumsum(dvl, axis=1)
+  alpha_prev = np.zeros_like(alpha)
+  alpha_prev[:, 1:] = alpha[:, :-1]
+  nu_prev = np.zeros_like(nu)
+  nu_prev[:, 1:] = nu[:, :-1]
+  dth_prev = np.zeros_like(dth)
+  dth_prev[:, 1:] = dth[:, :-1]
+  dv_prev = np.zeros_like(dvl)
+  dv_prev[:, 1:] = dvl[:, :-1]
+
+  a_term = alpha_prev + dth_prev/6.0
+  coning = 0.5*np.cross(a_term, dth).sum(axis=1)
+  sculling = 0.5*(np.cross(a_term, dvl) + np.cross(nu_prev + dv_prev/6.0, dth)).sum(axis=1)
+
+  alpha_n = alpha[:, -1]
+  nu_n = nu[:, -1]
+
+  d_theta = np.zeros((m + 1, 3))
+  d_v = np.zeros((m + 1, 3))
+  d_theta[1:] = alpha_n + coning
+  d_v[1:] = nu_n + 0.5*np.cross(alpha_n, nu_n) + sculling
+  return rows, d_theta, d_v
+
+
+def rot_vec_to_CTM(phi):
+
+  # Rodrigues formula, rotation vector to DCM
+  #
+  # INPUTS:
+  #   phi     Rotation vector (rad)
+  #
+  # OUTPUTS
+  #   C       3 by 3 rotation matrix exp(skew(phi))
+
+  phi = np.asarray(phi, dtype=float)
+  ang2 = phi@phi
+  S = np.array([[0.0, -phi[2], phi[1]],
+                [phi[2], 0.0, -phi[0]],
+                [-phi[1], phi[0], 0.0]])
+  if ang2 < 1e-16:
+    return np.identity(3) + S + 0.5*S@S
+  ang = np.sqrt(ang2)
+  return np.identity(3) + np.sin(ang)/ang*S + (1.0 - np.cos(ang))/ang2*S@S
+
+
+def INS_Equations_NED_DCM(tor_i, old_latR, old_longR, old_alt, old_v_eb_n,
+                          old_C_b_n, d_theta_ib_b, d_v_ib_b, meas_heading_n,
+                          n_samples: int = 1):
+
+  # INS update Equations from k-1 to k using pre-integrated increments
+  #
+  # INPUTS:
+  #   tor_i               Length of the increment interval (sec)
+  #   old_latR            Previous estimate Latitude (rad)
+  #   old_longR           Previous estimate Longtiude (rad)
+  #   old_alt             Previous estimate altitude (m)
+  #   old_v_eb_n          Previous estimate velocity (m/sec)
+  #   old_C_b_n           Previous estimate DCM Matrix
+  #   d_theta_ib_b        Delta-angle over the interval (rad)
+  #   d_v_ib_b            Delta-velocity over the interval (m/sec)
+  #   meas_heading_n      Track heading used for yaw blending (rad)
+  #   n_samples           IMU samples in the interval (yaw blending)
+  #
+  # OUTPUTS
+  #   new_C_b_n       INS estimate DCM Matrix
+  #   new_v_eb_n      INS estimate velocity (m/sec)
+  #   new_latR        INS estimate Latitude (rad)
+  #   new_longR       INS estimate Longtiude (rad)
+  #   new_alt         INS estimate altitude (m)
+  #
+  # Same forces as INS_Equations_NED (WGS84 gravity, Coriolis 2*w_ie + w_en,
+  # frozen vertical channel) and the same yaw blending with the track
+  # heading, applied as n_samples per-sample blends. It differs in:
+  #   - gravity, Earth rate and transport rate evaluated once per interval
+  #   - attitude from the rotation vector of the increment (DCM), not by
+  #     integrating Euler angle rates
+  #   - trapezoidal position update (the interval is n_samples longer)
+
+  old_v_eb_n = np.asarray(old_v_eb_n, dtype=float)
+  sin_lat = np.sin(old_latR)
+
+  # Gravity accel in NED frame
+  g0 = 9.7803253359/np.sqrt(1-f*(2.0-f)*sin_lat**2.0)*(1.0 + 0.0019311853*sin_lat**2.0)
+  ch = 1.0-2.0*(1.0+f+(a**3.0*(1-f)*omega_ie**2.0)/(mu))*(old_alt/a)+3.0*(old_alt/a)**2.0
+  g_n = np.array([0.0, 0.0, ch*g0])
+
+  # Earth rotation and transport rate
+  omega_ie_n = omega_ie*np.array([np.cos(old_latR), 0.0, -sin_lat])
+  RN = a*(1.0-e**2)/(1.0-e**2.0*sin_lat**2.0)**1.5
+  RE = a/np.sqrt(1.0-e**2.0*sin_lat**2.0)
+  omega_en_n = np.array([old_v_eb_n[1]/(RE+old_alt),
+                         -old_v_eb_n[0]/(RN+old_alt),
+                         -old_v_eb_n[1]*np.tan(old_latR)/(RE+old_alt)])
+
+  # Attitude Update: body increment, then navigation frame rotation
+  zeta = (omega_ie_n + omega_en_n)*tor_i
+  new_C_b_n = rot_vec_to_CTM(-zeta)@old_C_b_n@rot_vec_to_CTM(d_theta_ib_b)
+  eulk = CTM_to_Euler(new_C_b_n)
+  Vertival_Vel = (old_v_eb_n[0]**2+old_v_eb_n[1]**2)/10
+  Vertival_Vel = 1 if Vertival_Vel < 1 else 200
+  # The per-sample blend keeps 1/Vertival_Vel of the yaw: n_samples of them
+  # keep (1/Vertival_Vel)**n_samples
+  keep = (1/Vertival_Vel)**n_samples
+  eulk[2] = meas_heading_n + keep*((eulk[2] - meas_heading_n + np.pi) % (2*np.pi) - np.pi)
+  new_C_b_n = Euler_to_CTM(eulk)
+
+  # Velocity Update
+  d_v_ib_n = old_C_b_n@d_v_ib_b   # increments are resolved in the body frame at k-1
+  dum3 = 2.0*omega_ie_n+omega_en_n
+  new_v_eb_n = old_v_eb_n + d_v_ib_n + (g_n - np.cross(dum3, old_v_eb_n))*tor_i
+  new_v_eb_n[2] = old_v_eb_n[2] # do not update upward velocity through transformation
+
+  # Position Update (trapezoidal in the horizontal plane)
+  v_mid = 0.5*(old_v_eb_n + new_v_eb_n)
+  new_latR = old_latR + tor_i*v_mid[0]/(RN+old_alt)
+  new_longR = old_longR + tor_i*v_mid[1]/((RE+old_alt)*np.cos(old_latR))
+  new_alt = old_alt
+  return new_C_b_n, new_v_eb_n, new_latR, new_longR, new_alt
+
+
+def test():
+  import time
+  from Modules.ins_ekf import data_packet
+  from Modules.lc_ins_gnss import run_LC_EKF
+
+  # Coning motion sampled as 200 Hz delta-angles, reference attitude from
+  # composing 100 sub-steps per sample
+  beta, W, hz, sub = 0.05, 2*np.pi*5.0, 200, 100
+  t_fine = np.arange(hz*sub + 1)/(hz*sub)
+  w_fine = np.stack([-2*W*np.sin(beta/2)**2*np.ones_like(t_fine),
+                     -W*np.sin(beta)*np.sin(W*t_fine),
+                     W*np.sin(beta)*np.cos(W*t_fine)], axis=1)
+  C_ref = np.identity(3)
+  for i in range(1, len(t_fine)):
+    C_ref = C_ref@rot_vec_to_CTM(0.5*(w_fine[i-1] + w_fine[i])/(hz*sub))
+  t = t_fine[::sub]
+  w = np.zeros((len(t), 3))
+  w[1:] = np.stack([w_fine[(i-1)*sub:i*sub + 1].mean(axis=0) for i in range(1, len(t))])
+
+  for n in (4, 8):
+    rows, d_theta, d_v = preintegrate(t, w, np.zeros_like(w), n)
+    C_cmp = np.identity(3)
+    C_raw = np.identity(3)
+    alpha = (w[1:]/hz).reshape(-1, n, 3).sum(axis=1)
+    for k in range(1, len(rows)):
+      C_cmp = C_cmp@rot_vec_to_CTM(d_theta[k])
+      C_raw = C_raw@rot_vec_to_CTM(alpha[k-1])
+    err = lambda C: np.arccos(np.clip((np.trace(C_ref.T@C) - 1)/2, -1, 1))
+    print(f'coning, N={n}: attitude error {err(C_cmp):.2e} rad compensated, {err(C_raw):.2e} rad without')
+    assert err(C_cmp) < err(C_raw)
+
+  # Fusion against the exact filter (mechanization and full covariance
+  # prediction at every sample): a straight and level profile, and the
+  # survey flight of fusion_bench (turns at 6 deg/s, banked)
+  from Modules.fusion_bench import synthetic_flight, accuracy, GNSS_RATE, IMU_RATE
+  n = 6000
+  ip = np.zeros((n, 16))
+  ts = np.arange(n)/200.0
+  ip[:, 0] = 467000 + ts
+  ip[:, 1] = 0.9 + 10.0*ts/a
+  ip[:, 2] = 0.3
+  ip[:, 3] = 100.0
+  ip[:, 4] = 10.0
+  ip[:, 12] = -9.8
+  KF_param = data_packet((0.05, 0.02, np.zeros(3), 0.05, np.zeros(3), 0.002))
+  survey = synthetic_flight('survey', 40.0)
+  interval = 1.0/GNSS_RATE - 0.5/IMU_RATE
+  cases = [('level', ip, KF_param, 0.2, 0.05, 0.01), ('survey', survey.in_profile_data, survey.KF_param, interval, 0.15, 0.05)]
+
+  for name, data, param, gnss_interval, max_ned, max_vel in cases:
+    n = len(data)
+    exact = run_LC_EKF(data, n, param, gnss_interval, cov_decimation=0)
+    # Speed against the same block covariance at every sample (user-026)
+    now = time.perf_counter()
+    run_LC_EKF(data, n, param, gnss_interval, cov_decimation=40)
+    t_ref = time.perf_counter() - now
+    for N in (4, 8):
+      now = time.perf_counter()
+      out = run_LC_EKF(data, n, param, gnss_interval, cov_decimation=40, mech_decimation=N)
+      t_N = time.perf_counter() - now
+      ref = exact[::N][:len(out)]
+      d_ned = np.abs(out[:, 10:13] - ref[:, 10:13]).max()
+      d_vel = np.abs(out[:, 4:7] - ref[:, 4:7]).max()
+      print(f'{name}, mech_decimation {N}: {t_ref/t_N:.1f}x faster than cov_decimation=40 alone, '
+            f'max NED difference {d_ned:.3f} m, velocity {d_vel:.4f} m/s')
+      assert d_ned < max_ned and d_vel < max_vel
+      if name == 'survey':
+        acc, acc_exact = accuracy(out, survey.truth), accuracy(exact, survey.truth)
+        print(f'  against truth: horizontal {acc["pos_h"]:.3f} m, velocity {acc["vel"]:.4f} m/s, '
+              f'yaw {acc["yaw"]:.2f} deg (exact filter {acc_exact["pos_h"]:.3f} m, {acc_exact["vel"]:.4f} m/s, {acc_exact["yaw"]:.2f} deg)')
+        assert acc['pos_h'] < 1.1*acc_exact['pos_h'] and acc['vel'] < 1.1*acc_exact['vel']
+
+
+if __name__ == '__main__':
+  test()
@@ -0,0 +1,137 @@
+###############################################################################
+# File:  ins_gnss_data.py
+#
+# Description:
+# Readers of 5_LC_INS_GNSS.ipynb that build the synchronized in_profile_data
+# array from the RTKLIB .pos solution and the IMU log. The IMU log is read
+# through imu_cache, so the CSV is only parsed on the first run and later
+# runs map the time window they need.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import pandas as pd
+import os
+from Modules.ins_nav import a, f, mu, omega_ie, DTOR
+from Modules.imu_cache import get_IMU_cache
+
+
+def get_PPK_GNSS_data(pos_file: str):
+
+  # Read a RTKLIB .pos solution (lat/lon in degrees, velocity output on)
+  #
+  # INPUTS:
+  #   pos_file    .pos file
+  #
+  # OUTPUTS
+  #   gps_data    DataFrame with time, position, velocity and their sigmas
+  #
+  # col 1: Time, col 2-4: lat, lon, height, col 5-7: sdn, sde, sdu
+  # col 15-17: vn, ve, vd, col 18-20: sdvn, sdve, sdvu
+
+  Table_data = pd.read_table(pos_file, sep=r'\s+', header=None, comment='%')
+  gps_data = Table_data.iloc[:, [1, 2, 3, 4, 5, 6, 7, 15, 16, 17, 18, 19, 20]]
+  gps_data.columns = ['time (sec)', 'Lat (rad)', 'Long (rad)', 'Alt (m)', 'sdn(m)', 'sde(m)', 'sdu(m)', 'v_N (m/s)', 'v_E (m/s)', 'v_D (m/s)', 'sdvn', 'sdve', 'sdvu']
+  return gps_data
+
+
+def get_INS_GNSS_streams(folder: str, pos_file: str,
+                         start_time: float = 467000,
+                         end_time: float = 469440,
+                         imu_file: str = 'IMU_Data.csv'):
+
+  # GNSS and IMU data of the fused interval at their own rates
+  #
+  # INPUTS:
+  #   folder      Folder of pos_file and imu_file
+  #   pos_file    RTKLIB .pos file name
+  #   start_time  First fused epoch, IMU samples before it give the bias
+  #               estimate (sec of week)
+  #   end_time    Last fused epoch (sec of week)
+  #   imu_file    IMU CSV file name, cached next to it on first use
+  #
+  # OUTPUTS
+  #   imu         (time, gyro, accel, rpy), accel with the gravity term of
+  #               in_profile_data, rpy in rad
+  #   gnss        (time, lla, vel), lat/lon in rad, from start_time on
+  #   InitP       Parameters of ins_ekf.data_packet
+
+  GNSS_LLA_VEL_data = get_PPK_GNSS_data(os.path.join(folder, pos_file))
+  imu = get_IMU_cache(folder, imu_file, start_time)
+
+  meas_GNSS_time = GNSS_LLA_VEL_data['time (sec)'].to_numpy()
+  meas_GNSS_pos_lla = GNSS_LLA_VEL_data[['Lat (rad)', 'Long (rad)', 'Alt (m)']].to_numpy()
+  meas_GNSS_vel_ned = GNSS_LLA_VEL_data[['v_N (m/s)', 'v_E (m/s)', 'v_D (m/s)']].to_numpy()
+
+  # Initial parameters (bias from the cache, sigmas from the first fixes)
+  acc_bias, acc_sigma, gyro_bias, gyro_sigma = imu.init_params()
+  row0 = GNSS_LLA_VEL_data.iloc[0]
+  GNSS_POS_Sigma = np.sqrt(GNSS_LLA_VEL_data.iloc[1]['sdn(m)']**2 + row0['sde(m)']**2 + row0['sdu(m)']**2)
+  GNSS_VEL_Sigma = np.sqrt(row0['sdvn']**2 + row0['sdve']**2 + row0['sdvu']**2)
+  InitP = (GNSS_POS_Sigma, GNSS_VEL_Sigma, acc_bias, acc_sigma, gyro_bias, gyro_sigma)
+
+  # Gravity at the first fix (the .pos latitude is in degrees)
+  lat0 = meas_GNSS_pos_lla[0, 0]*DTOR
+  alt0 = meas_GNSS_pos_lla[0, 2]
+  g0 = 9.7803253359/np.sqrt(1-f*(2.0-f)*(np.sin(lat0))**2.0)*(1.0 + 0.0019311853*(np.sin(lat0))**2.0)
+  ch = 1.0-2.0*(1.0+f+(a**3.0*(1-f)*omega_ie**2.0)/(mu))*(alt0/a)+3.0*(alt0/a)**2.0
+
+  # IMU samples of the fused interval only (mapped, not read)
+  time_series, gyro, accel, rpy = imu.window(start_time, end_time)
+
+  # Gravity in the body frame from the logged attitude: C_b_n.T@[0, 0, g]
+  phi = rpy[:, 0]
+  theta = rpy[:, 1]
+  g_f_b = ch*g0*np.stack([-np.sin(theta), np.sin(phi)*np.cos(theta), np.cos(phi)*np.cos(theta)], axis=1)
+
+  g0_row = int(np.searchsorted(meas_GNSS_time, start_time, side='left'))
+  lla = meas_GNSS_pos_lla[g0_row:].copy()
+  lla[:, 0:2] *= DTOR
+  gnss = (meas_GNSS_time[g0_row:], lla, meas_GNSS_vel_ned[g0_row:])
+  return (time_series, gyro, accel + g_f_b, rpy), gnss, InitP
+
+
+def get_all_INS_GNSS_data(folder: str, pos_file: str,
+                          start_time: float = 467000,
+                          end_time: float = 469440,
+                          imu_file: str = 'IMU_Data.csv'):
+
+  # Synchronize GNSS and IMU data into in_profile_data
+  #
+  # INPUTS:
+  #   see get_INS_GNSS_streams
+  #
+  # OUTPUTS
+  #   index           Number of valid rows in in_profile_data
+  #   in_profile_data [time, lat, lon, alt, vN, vE, vD, gyro(3), accel(3), rpy(3)]
+  #   InitP           Parameters of ins_ekf.data_packet
+  #
+  # The GNSS fix is repeated on the IMU rows. time_alignment.align_streams
+  # with lc_ins_gnss.run_LC_EKF_aligned avoids this copy.
+
+  (time_series, gyro, accel, rpy), (meas_GNSS_time, lla, vel), InitP = \
+    get_INS_GNSS_streams(folder, pos_file, start_time, end_time, imu_file)
+  GNSS_Data_count = len(meas_GNSS_time)
+
+  # GNSS row of each IMU row: advances by at most one per IMU sample while
+  # behind the IMU time
+  n = len(time_series)
+  gnss_rows = np.zeros(n, dtype=int)
+  GNSS_Time_index = 0
+  index = 0
+  while GNSS_Time_index < GNSS_Data_count and index < n:
+    gnss_rows[index] = GNSS_Time_index
+    if meas_GNSS_time[GNSS_Time_index] < time_series[index]:
+      GNSS_Time_index += 1
+    index += 1
+
+  in_profile_data = np.zeros((index, 16))
+  g = gnss_rows[:index]
+  in_profile_data[:, 0] = time_series[:index]
+  in_profile_data[:, 1:4] = lla[g]
+  in_profile_data[:, 4:7] = vel[g]
+  in_profile_data[:, 7:10] = gyro[:index]
+  in_profile_data[:, 10:13] = accel[:index]
+  in_profile_data[:, 13:16] = rpy[:index]
+  return index, in_profile_data, InitP
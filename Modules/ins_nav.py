@@ -0,0 +1,319 @@
+###############################################################################
+# File:  ins_nav.py
+#
+# Description:
+# Attitude representations, reference frame transformations and the INS
+# mechanization equations in the NED frame, as used by 5_LC_INS_GNSS.ipynb.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import math as ma
+
+
+RTOD = 180.0 / np.pi
+DTOR = np.pi / 180.0
+
+# WGS84 constants
+a = 6378137.0                # Earth's radius (m)
+f = 1.0/298.257223563        # Wgs84 Earth flatenning factor
+e = np.sqrt(f*(2.0-f))       # Eccentricity
+mu = 3.986005E14             # m^3/s^2    mass of earth
+omega_ie = 7.2921151467E-05  # Earth ROT rate (rad/s)
+
+
+#Skew Matrix
+
+def skew(a):
+
+  # Skew semetric matrix
+  #
+  # INPUTS:
+  #   a       3 by 1 vector of numbers
+  #
+  # OUTPUTS
+  #   A       3 by 3 skew matrix
+
+  A = np.array([[0.0, -a[2], a[1]],
+                [a[2], 0.0, -a[0]],
+                [-a[1], a[0], 0.0]], dtype=object)
+  return A
+
+#Attitude representation and tranformation from Euler angles to DCM and vice-versa
+
+def RPY(eul):
+
+  # Euler angle Diff EQ
+  #
+  # INPUTS:
+  #   eul     3 by 1 set of Euler angles (phi, theta, psi) (rad)
+  #
+  # OUTPUTS
+  #   A       3 by 3 matrix for Euler angle integration
+
+  sin_phi = np.sin(eul[0])
+  cos_phi = np.cos(eul[0])
+  sin_theta = np.sin(eul[1])
+  cos_theta = np.cos(eul[1])
+
+  A = np.array([[1.0, sin_phi*sin_theta, cos_phi*sin_theta],
+                [0.0, cos_phi*cos_theta, -sin_phi*cos_theta],
+                [0.0, sin_phi, cos_phi]])
+  A = 1.0/cos_theta*A
+  return A
+
+
+def CTM_to_Euler(C):
+
+  # Compute Euler angles from transform matrix
+  #
+  # INPUTS:
+  #   C     3 by 3 matrix C_b_n
+  #
+  # OUTPUTS
+  #   Euler    Euler angle vector (phi, theta, psi) (rad)
+
+  C = np.array(C, dtype=float).T  # copy: the caller's matrix is not changed
+  # Rounding can leave C[0,2] just outside [-1, 1] near +-90 deg pitch
+  sin_theta = float(np.clip(C[0, 2], -1.0, 1.0))
+  phi = float(ma.atan2(C[1, 2], C[2, 2]))
+  theta = float(-ma.asin(sin_theta))
+  psi = float(ma.atan2(C[0, 1], C[0, 0]))
+  Euler = np.array([phi, theta, psi])
+  return Euler
+
+
+def Euler_to_CTM(eul):
+
+  # Create Coordinate transform matrix
+  #
+  # INPUTS:
+  #   eul     Euler angle vector (phi, theta, psi) (rad)
+  #
+  # OUTPUTS
+  #   C.T     Body to Nav Rotation Matrix (no transpose is opposite)
+
+  sin_phi = float(np.sin(eul[0]))
+  cos_phi = float(np.cos(eul[0]))
+  sin_theta = float(np.sin(eul[1]))
+  cos_theta = float(np.cos(eul[1]))
+  sin_psi = float(np.sin(eul[2]))
+  cos_psi = float(np.cos(eul[2]))
+
+  C = np.zeros((3, 3))
+  C[0, 0] = cos_theta * cos_psi
+  C[0, 1] = cos_theta * sin_psi
+  C[0, 2] = -sin_theta
+  C[1, 0] = -cos_phi * sin_psi + sin_phi * sin_theta * cos_psi
+  C[1, 1] = cos_phi * cos_psi + sin_phi * sin_theta * sin_psi
+  C[1, 2] = sin_phi * cos_theta
+  C[2, 0] = sin_phi * sin_psi + cos_phi * sin_theta * cos_psi
+  C[2, 1] = -sin_phi * cos_psi + cos_phi * sin_theta * sin_psi
+  C[2, 2] = cos_phi * cos_theta
+  return C.T  # body to NED
+
+#Tranformation between the reference frames
+
+def LLA_to_NED(lat, long, alt, x_ECEF, x_ref):
+
+  # LLA to NED using reference
+  #
+  # INPUTS:
+  #   lat     Lattitude (rad)
+  #   long    Longitude (rad)
+  #   alt     altitude (m)
+  #   x_ECEF  Position of interest in ECEF frame (m)
+  #   x_ref   Reference ECEF position for NED (m)
+  #
+  # OUTPUTS
+  #   x_NED   Position in NED frame based on x_ref
+
+  R_NED_to_ECEF = np.array([[-np.sin(lat)*np.cos(long),
+                             -np.sin(long),
+                             -np.cos(lat)*np.cos(long)],
+                            [-np.sin(lat)*np.sin(long),
+                             np.cos(long),
+                             -np.cos(lat)*np.sin(long)],
+                            [np.cos(lat),
+                             0.0,
+                             -np.sin(lat)]])
+  x_ECEF = np.ravel(x_ECEF)
+  x_ref = np.ravel(x_ref)
+  residual = np.array([[float(x_ECEF[0])-float(x_ref[0])],
+                       [float(x_ECEF[1])-float(x_ref[1])],
+                       [float(x_ECEF[2])-float(x_ref[2])]])
+  x_NED = np.matmul(R_NED_to_ECEF.T, residual)
+  return(x_NED)
+
+
+def ECEF_to_LLA(r_eb_e):
+
+  # ECEF to LLA frame
+  #
+  # INPUTS:
+  #   r_eb_e  ECEF frame coordinate (m)
+  #
+  # OUTPUTS
+  #   lat     Lattitude (rad)
+  #   long    Longitude (rad)
+  #   alt     altitude (m)
+
+  R0 = a
+  e = np.sqrt(f*(2.0-f))
+  R_P = R0*(1.0-f)
+  long = ma.atan2(r_eb_e[1], r_eb_e[0])
+  p = np.sqrt(r_eb_e[0]**2+r_eb_e[1]**2)
+  E = np.sqrt(R0**2-R_P**2)
+  F = 54.0*(R_P*r_eb_e[2])**2
+  G = p**2+(1.0-e**2)*r_eb_e[2]**2-(e*E)**2
+  c = e**4*F*p**2/(G**3)
+  s = (1.0+c+np.sqrt(c**2+2*c))**(1.0/3.0)
+  P = (F/(3*G**2))/((s+1.0/s+1.0)**2)
+  Q = np.sqrt(1.0+2.0*e**4*P)
+  k1 = (-P*e**2*p)/(1.0+Q)
+  k2 = 0.5*R0**2*(1.0+1.0/Q)
+  k3 = -P*(1.0-e**2)*(r_eb_e[2]**2)/(Q*(1.0+Q))
+  k4 = -0.5*P*p**2
+  k5 = p-e**2*(k1+np.sqrt(k2+k3+k4))
+  U = np.sqrt(k5**2+r_eb_e[2]**2)
+  V = np.sqrt(k5**2+(1.0-e**2)*r_eb_e[2]**2)
+  alt = U*(1.0-R_P**2/(R0*V))
+  z0 = (R_P**2*r_eb_e[2])/(R0*V)
+  ep = R0*e/R_P
+  lat = ma.atan((r_eb_e[2]+z0*ep**2)/p)
+  return lat, long, alt
+
+
+def LLA_to_ECEF(lat, long, alt):
+
+  # LLA to ECEF frame
+  #
+  # INPUTS:
+  #   lat     Lattitude (rad)
+  #   long    Longitude (rad)
+  #   alt     altitude (m)
+  #
+  # OUTPUTS
+  #   x   ECEF x position (m)
+  #   y   ECEF y position (m)
+  #   z   ECEF z position (m)
+
+  # calculate transverse radius of curvature (2.105)
+  R_E = a / np.sqrt(1.0-(e*np.sin(lat))**2)
+  # Convert position using (2.112)
+  cos_lat = np.cos(lat)
+  sin_lat = np.sin(lat)
+  cos_long = np.cos(long)
+  sin_long = np.sin(long)
+  r_eb_e = np.array([[(R_E + alt) * cos_lat * cos_long],
+                     [(R_E + alt) * cos_lat * sin_long],
+                     [((1.0 - e**2) * R_E + alt) * sin_lat]])   #convert llh to x/y/z ECEF fram
+  x = r_eb_e[0]
+  y = r_eb_e[1]
+  z = r_eb_e[2]
+  return x, y, z
+
+
+def ECEF_to_NED(x_ecef, latR, longR, alt):
+
+  # ECEF to NED frame (Using differnt method)
+  #
+  # INPUTS:
+  #   x_ecef  ECEF position of interest (m)
+  #   lat     Lattitude (rad)
+  #   long    Longitude (rad)
+  #   alt     altitude (m)
+  #
+  # OUTPUTS
+  #   NED     NED position based on LLA coordinates (m)
+
+  x, y, z = LLA_to_ECEF(latR, longR, alt)
+  ref_e = np.array([x, y, z])
+  delta_E = np.zeros((3, 1))
+  delta_E[0] = x_ecef[0] - ref_e[0]
+  delta_E[1] = x_ecef[1] - ref_e[1]
+  delta_E[2] = x_ecef[2] - ref_e[2]
+  ENU = np.zeros((3, 1))
+  ENU[0] = -np.sin(longR)*delta_E[0] + np.cos(longR)*delta_E[1]
+  ENU[1] = -np.sin(latR)*np.cos(longR)*delta_E[0] - np.sin(latR)*np.sin(longR)*delta_E[1] + np.cos(latR)*delta_E[2]
+  ENU[2] = -np.cos(latR)*np.cos(longR)*delta_E[0] + np.cos(latR)*np.sin(longR)*delta_E[1] + np.sin(latR)*delta_E[2]
+  C = np.zeros((3, 3))
+  C[0, 1] = 1.0   # ENU to NED Rotation Matrix
+  C[1, 0] = 1.0
+  C[2, 2] = -1.0
+  NED = C@ENU
+  return NED
+
+
+# Mechanization Equations
+
+def INS_Equations_NED(tor_i, old_latR, old_longR, old_alt, old_v_eb_n,
+                      old_C_b_n, meas_omega_ib_b, meas_f_ib_b, meas_heading_n):
+
+  # INS update Equations from k-1 to k
+  #
+  # INPUTS:
+  #   tor_i               Delta T (In this instant, INS Hz Rate) (sec)
+  #   old_latR            Previous estimate Latitude (rad)
+  #   old_longR           Previous estimate Longtiude (rad)
+  #   old_alt             Previous estimate altitude (m)
+  #   old_v_eb_n          Previous estimate velocity (m/sec)
+  #   old_C_b_n           Previous estimate DCM Matrix
+  #   meas_omega_ib_b     Previous body angular velocity (rad/sec)
+  #   meas_f_ib_b         Previous body acceleration (m/sec^2)
+  #
+  # OUTPUTS
+  #   new_C_b_n       INS estimate DCM Matrix
+  #   new_v_eb_n      INS estimate velocity (m/sec)
+  #   new_latR        INS estimate Latitude (rad)
+  #   new_longR       INS estimate Longtiude (rad)
+  #   new_alt         INS estimate altitude (m)
+
+  # Gravity accel in NED frame
+  dum1 = (1.0 + 0.0019311853*(np.sin(old_latR))**2.0)
+  g0 = 9.7803253359/np.sqrt(1-f*(2.0-f)*(np.sin(old_latR))**2.0)*dum1   #WGS84 gravity value for different lats
+  dum2 = 3.0*(old_alt/a)**2.0                                   # 3 x (altitude/radius)^2
+  ch = 1.0-2.0*(1.0+f+(a**3.0*(1-f)*omega_ie**2.0)/(mu))*(old_alt/a)+dum2 # altitude factor
+  g_n = np.array([0.0, 0.0, ch*g0])
+
+  # Earth rotation rate expressed in navigation frame
+  omega_ie_n = omega_ie*np.array([np.cos(old_latR), 0.0, -np.sin(old_latR)]) # Earth rotation rate for the lats
+
+  # Transport Rate
+  RN = a*(1.0-e**2)/(1.0-e**2.0*(np.sin(old_latR))**2.0)**1.5
+  RE = a/np.sqrt(1.0-e**2.0*(np.sin(old_latR))**2.0)
+  dum4 = float(old_v_eb_n[1]/(RE+old_alt))
+  dum5 = float(-old_v_eb_n[0]/(RN+old_alt))
+  dum6 = float(-old_v_eb_n[1]*np.tan(old_latR)/(RE+old_alt))
+  omega_en_n = np.array([dum4, dum5, dum6])
+
+  # Attitude Update
+  omega_in_b = old_C_b_n.T@(omega_ie_n + omega_en_n)  #Earth rotation and transport rate to be converted to body axis
+  meas_omega_nb_b = meas_omega_ib_b - omega_in_b      #Remove these errors from measurement
+  eulk_1 = CTM_to_Euler(old_C_b_n)              #Convert CTM to euler angles
+  Ak_1 = RPY(eulk_1)                            #Euler angles to Diff for Integration (uses only Roll and Pitch)
+  eulk = eulk_1 + tor_i * Ak_1 @ meas_omega_nb_b      #update the measurement based on the integration of rates
+  Vertival_Vel = (old_v_eb_n[0]**2+old_v_eb_n[1]**2)/10
+  Vertival_Vel = 1 if Vertival_Vel < 1 else 200 #Vertival_Vel
+  # Blend on the wrapped difference: yaw (+-pi) and heading (0-2pi) can be 2pi apart
+  eulk[2] = meas_heading_n + (1/Vertival_Vel)*((eulk[2] - meas_heading_n + np.pi) % (2*np.pi) - np.pi)
+  new_C_b_n = Euler_to_CTM(eulk)                #Convert back the euler angles to the CTM (Cordinate transform matrix)
+
+  # Velocity Update
+  meas_f_ib_n = old_C_b_n@meas_f_ib_b
+  dum3 = 2.0*omega_ie_n+omega_en_n                 # Coriolis and transport rate terms
+  a_eb_n = meas_f_ib_n + g_n - skew(dum3)@old_v_eb_n
+  new_v_eb_n = old_v_eb_n + tor_i*a_eb_n #Velocity update
+  new_v_eb_n[2] = old_v_eb_n[2] # do not update upward velocity through transformation
+
+  # Position Update
+  old_P_lla = np.array([old_latR, old_longR, old_alt])
+  T = np.array([[1.0/(RN+old_alt), 0.0, 0.0],
+                [0.0, 1.0/((RE+old_alt)*np.cos(old_latR)), 0.0],
+                [0.0, 0.0, -1.0]])
+  new_P_lla = old_P_lla + tor_i*T@old_v_eb_n
+  new_latR = new_P_lla[0]
+  new_longR = new_P_lla[1]
+  new_alt = old_alt
+  return new_C_b_n, new_v_eb_n, new_latR, new_longR, new_alt
@@ -0,0 +1,290 @@
+###############################################################################
+# File:  lc_ins_gnss.py
+#
+# Description:
+# Loosely coupled GNSS/INS fusion loop of 5_LC_INS_GNSS.ipynb. Runs the INS
+# mechanization at the IMU rate and corrects it with the EKF at every GNSS
+# epoch. Input and output arrays keep the notebook layout:
+#
+#   in_profile_data  [time, lat, lon, alt, vN, vE, vD, gyro(3), accel(3), rpy(3)]
+#   out_profile_data [time, roll, pitch, yaw, vN, vE, vD, lat, lon, alt,
+#                     N, E, D, accel bias(3), gyro bias(3)]
+#
+# run_LC_EKF_aligned runs the same filter on native-rate IMU arrays with the
+# GNSS fixes given by time_alignment.align_streams, without the padded array.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import math as ma
+from Modules.ins_nav import (RTOD, DTOR, Euler_to_CTM, CTM_to_Euler,
+                             LLA_to_ECEF, ECEF_to_NED, LLA_to_NED,
+                             INS_Equations_NED)
+from Modules.ins_ekf import (Get_dem_EKF_matrices, Get_meas_matrices,
+                             initialize_P_EKF, prediction_step,
+                             correction_step, innovation, correct_NED_errors,
+                             Block_cov_propagator)
+from Modules.imu_preintegration import preintegrate, INS_Equations_NED_DCM
+
+
+def run_LC_EKF(in_profile_data, no_epochs, KF_param,
+               GNSS_epoch_interval = 0.2,
+               cov_decimation = 0,
+               mech_decimation = 1,
+               smoother = None,
+               innovations = None):
+
+  # Error State EKF over a motion profile
+  #
+  # INPUTS:
+  #   in_profile_data     Synchronized GNSS/IMU input array
+  #   no_epochs           Number of valid rows in in_profile_data
+  #   KF_param            Kalman Filter parameters (data_packet)
+  #   GNSS_epoch_interval Time between GNSS updates (sec)
+  #   cov_decimation      0: expm + full prediction at every IMU sample
+  #                       N: Block_cov_propagator, P propagated every N
+  #                          samples and before each GNSS update
+  #   mech_decimation     1: mechanization at every IMU sample
+  #                       N: coning/sculling pre-integrated increments of N
+  #                          samples, mechanization and output at 1/N rate
+  #   smoother            Optional rts_smoother.RTS_store that records P+ and
+  #                       delta_x at every update for rts_smooth()
+  #   innovations         Optional ekf_tuning.NIS_store that records the
+  #                       innovation and its covariance at every update
+  #
+  # OUTPUTS
+  #   out_profile_data    Fused navigation solution (no_epochs/mech_decimation, 19)
+
+  time = in_profile_data[:no_epochs, 0]
+  rows = _mech_rows(no_epochs, mech_decimation)
+
+  # GNSS update at the first output epoch GNSS_epoch_interval after the last
+  upd_k = []
+  time_last_GNSS = time[0]
+  for k in range(1, len(rows)):
+    if (time[rows[k]] - time_last_GNSS) >= GNSS_epoch_interval:
+      time_last_GNSS = time[rows[k]]
+      upd_k.append(k)
+  upd_rows = rows[upd_k]
+
+  return _fuse(time, in_profile_data[:no_epochs, 7:10], in_profile_data[:no_epochs, 10:13],
+               in_profile_data[0][1:4], in_profile_data[0][4:7], in_profile_data[0][13:16],
+               np.array(upd_k, dtype=int), in_profile_data[upd_rows, 1:4], in_profile_data[upd_rows, 4:7],
+               KF_param, cov_decimation, mech_decimation, smoother, innovations)
+
+
+def run_LC_EKF_aligned(imu_time, gyro, accel, init_rpy, alignment, KF_param,
+                       cov_decimation = 0,
+                       mech_decimation = 1,
+                       smoother = None,
+                       innovations = None):
+
+  # Error State EKF over native-rate IMU arrays and aligned GNSS fixes
+  #
+  # INPUTS:
+  #   imu_time, gyro, accel   IMU samples (sec, rad/s, m/s^2 incl. gravity
+  #                           compensation as in in_profile_data)
+  #   init_rpy                Roll, pitch, yaw at the first update (rad)
+  #   alignment               time_alignment.Alignment of the GNSS fixes
+  #   KF_param, cov_decimation, mech_decimation, smoother, innovations
+  #                           as in run_LC_EKF
+  #
+  # OUTPUTS
+  #   out_profile_data    Fused solution from the IMU sample of the first fix
+  #
+  # Every fix of the alignment is an update (see Alignment.decimate).
+
+  if len(alignment.imu_rows) == 0:
+    span = f'{imu_time[0]:.3f} to {imu_time[-1]:.3f} s' if len(imu_time) > 0 else 'empty'
+    raise ValueError(f'No GNSS fix in the IMU time range ({span}): the fixes outside it '
+                     f'were dropped by align_streams')
+  start = int(alignment.imu_rows[0])
+  time = np.asarray(imu_time[start:], dtype=float)
+  rows = _mech_rows(len(time), mech_decimation)
+
+  # Output epoch of every later fix, last fix per epoch
+  upd_k = np.searchsorted(rows, alignment.imu_rows[1:] - start, side='left')
+  keep = upd_k < len(rows)
+  keep[:-1] &= upd_k[1:] != upd_k[:-1]
+  upd_k = upd_k[keep]
+  lla = alignment.lla[1:][keep]
+  vel = alignment.vel[1:][keep]
+
+  return _fuse(time, gyro[start:], accel[start:],
+               alignment.lla[0], alignment.vel[0], np.asarray(init_rpy, dtype=float),
+               upd_k, lla, vel, KF_param, cov_decimation, mech_decimation, smoother, innovations)
+
+
+def _mech_rows(n, mech_decimation):
+  # IMU rows where the mechanization is evaluated (as preintegrate)
+  if mech_decimation > 1:
+    return np.arange((n - 1)//mech_decimation + 1)*mech_decimation
+  return np.arange(n)
+
+
+def _fuse(time, gyro, accel, init_lla, init_vel, init_rpy,
+          upd_k, upd_lla, upd_vel, KF_param,
+          cov_decimation, mech_decimation, smoother, innovations = None):
+
+  # EKF loop shared by run_LC_EKF and run_LC_EKF_aligned. upd_k are the
+  # output epochs with a GNSS update, upd_lla/upd_vel their measurements.
+
+  # Initialize true navigation solution to first reading
+  old_time = time[0]                              # current time
+  old_latR = init_lla[0]                          # lat is first GPS reading
+  old_longR = init_lla[1]                         # Long is first GPS reading
+  old_alt = init_lla[2]                           # alt is first GPS reading
+  old_eul_nb = init_rpy
+  old_C_b_n = Euler_to_CTM(old_eul_nb)            # old CTM
+  old_v_eb_n = np.array(init_vel, dtype=float)    # vel ned is first GPS reading
+
+  index = 0
+
+  # Find NED frame ECEF reference
+  latR_base = old_latR
+  longR_base = old_longR
+  alt_base = 0.0  # assume base is at zero alt?
+  xB, yB, zB = LLA_to_ECEF(latR_base, longR_base, alt_base)
+  ECEF_ref = np.array([xB, yB, zB])
+
+  # Initialize IMU bias states
+  est_IMU_bias = np.array([KF_param.init_accel_bias.T,
+                           KF_param.init_gyro_bias.T], dtype=float)
+
+  # Rows of the IMU arrays where the mechanization is evaluated
+  if mech_decimation > 1:
+    rows, d_theta, d_v = preintegrate(time, gyro, accel, mech_decimation)
+  else:
+    rows = np.arange(len(time))
+  n_out = len(rows)
+
+  # Update of each output epoch (-1: none)
+  upd_of_k = np.full(n_out, -1)
+  upd_of_k[upd_k] = np.arange(len(upd_k))
+
+  # Initialize output profile data array
+  out_profile_data = np.zeros((n_out, 19))
+  out_profile_data[0][0] = old_time
+  out_profile_data[0][1:4] = old_eul_nb.T*RTOD
+  out_profile_data[0][4:7] = old_v_eb_n.T
+  out_profile_data[0][7] = old_latR*RTOD
+  out_profile_data[0][8] = old_longR*RTOD
+  out_profile_data[0][9] = old_alt
+  out_profile_data[0][10] = 0.0  # Initial NED frame pos
+  out_profile_data[0][11] = 0.0
+  out_profile_data[0][12] = -old_alt  # - Down
+  out_profile_data[0][13:16] = est_IMU_bias[0]
+  out_profile_data[0][16:19] = est_IMU_bias[1]
+
+  new_meas_heading_n = np.zeros(n_out)
+
+  #Compute Noise Covariance Matrices
+  P = initialize_P_EKF(KF_param)
+  H, R = Get_meas_matrices(KF_param)
+  prop = (Block_cov_propagator(KF_param, P, cov_decimation) if cov_decimation > 0 else None)
+  if smoother is not None:
+    smoother.add(0, P, np.zeros(15))
+
+  for k in range(1, n_out):
+
+    # Input data (use epoch k-1 to compute epoch k)
+    epoch = rows[k]
+    epoch_time = time[epoch]
+    meas_omega_ib_b = gyro[epoch]      #measured rates (Roll/Pitch/Yaw) through gyros in body frame
+    meas_f_ib_b = accel[epoch]         #measured acceleration (X/Y/Z) through accelerometers in body frame
+
+    # Time interval of INS
+    tor_i = epoch_time - old_time
+
+    # Correct the IMU errors (biases)
+    meas_f_ib_b = meas_f_ib_b + est_IMU_bias[0]
+    meas_omega_ib_b = meas_omega_ib_b + est_IMU_bias[1]
+
+    # Update estimated INS Solution
+    if mech_decimation > 1:
+      d_theta_ib_b = d_theta[k] + est_IMU_bias[1]*tor_i
+      d_v_ib_b = d_v[k] + est_IMU_bias[0]*tor_i
+      meas_f_ib_b = d_v_ib_b/tor_i   # mean specific force for the error model
+      est_C_b_n, est_v_eb_n, est_latR, est_longR, est_alt = INS_Equations_NED_DCM(tor_i, old_latR, old_longR, old_alt, old_v_eb_n, old_C_b_n, d_theta_ib_b, d_v_ib_b, new_meas_heading_n[k-1]*DTOR, mech_decimation)
+    else:
+      est_C_b_n, est_v_eb_n, est_latR, est_longR, est_alt = INS_Equations_NED(tor_i, old_latR, old_longR, old_alt, old_v_eb_n, old_C_b_n, meas_omega_ib_b, meas_f_ib_b, new_meas_heading_n[k-1]*DTOR)
+
+    # Linearize, discretize error model and compute prediction step
+    if prop is None:
+      A, F, Q, H, R = Get_dem_EKF_matrices(KF_param, tor_i, old_latR, old_alt,
+                                           old_v_eb_n, old_C_b_n, meas_f_ib_b)
+      P = prediction_step(F, P, Q)
+    else:
+      prop.add_sample(tor_i, old_latR, old_alt, old_v_eb_n, old_C_b_n, meas_f_ib_b)
+
+    u = upd_of_k[k]
+    if u >= 0:
+      # Compute INS solution in NED frame
+      xE, yE, zE = LLA_to_ECEF(est_latR, est_longR, est_alt)
+      est_ned = ECEF_to_NED(np.array([xE, yE, zE]), latR_base, longR_base, alt_base)
+
+      # Convert CURRENT GPS measured pos to NED (for innovation)
+      new_meas_latR, new_meas_longR, new_meas_alt = upd_lla[u]
+      meas_v_eb_n = upd_vel[u]           #measured GNSS Velociteies (X/Y/Z) in navigation frame
+      new_meas_v_eb_n = upd_vel[u][2]
+
+      xE, yE, zE = LLA_to_ECEF(new_meas_latR, new_meas_longR, new_meas_alt)
+      GNSS_ned = ECEF_to_NED(np.array([xE, yE, zE]), latR_base, longR_base, alt_base)
+
+      # Compute correction step for errors
+      if prop is not None:
+        P = prop.propagate()
+      if innovations is not None:
+        delta_y = np.zeros(6)
+        delta_y[0:3] = np.ravel(est_ned) - np.ravel(GNSS_ned)
+        delta_y[3:6] = np.ravel(est_v_eb_n) - np.ravel(meas_v_eb_n)
+        innovations.add(k, delta_y, H@P@H.T + R)
+      P, K = correction_step(P, H, R)
+      if prop is not None:
+        prop.reset(P)
+
+      # Calculate Innovation
+      delta_x = innovation(K, est_ned, GNSS_ned, est_v_eb_n, meas_v_eb_n)
+
+      if smoother is not None:
+        smoother.add(k, P, delta_x)
+
+      # Update INS solution with estimated errors
+      est_latR, est_longR, est_alt, est_v_eb_n, est_C_b_n, est_IMU_bias = correct_NED_errors(delta_x, est_C_b_n, est_IMU_bias, old_latR, est_latR, est_longR, est_alt, new_meas_alt, est_v_eb_n, new_meas_v_eb_n)
+
+    # Convert LLA position solution to NED
+    xE, yE, zE = LLA_to_ECEF(est_latR, est_longR, est_alt)
+    P_n = LLA_to_NED(latR_base, longR_base, alt_base, np.array([xE, yE, zE]), ECEF_ref)
+
+    # Heading from the track over the last 10 m
+    Range = 100
+    while(Range>10 and index < k):
+      Range = ma.sqrt((out_profile_data[index][10] - P_n[0, 0])**2+(out_profile_data[index][11] - P_n[1, 0])**2)
+      if Range > 10:
+        index += 1
+    NorthD = out_profile_data[index-1][10]-P_n[0, 0]
+    EastD = out_profile_data[index-1][11]-P_n[1, 0]
+    new_meas_heading_n[k] = (ma.atan2(-EastD, -NorthD) + np.pi)*RTOD
+
+    # Record ouput data record
+    out_profile_data[k][0] = epoch_time  #Time
+    out_profile_data[k][1:4] = CTM_to_Euler(est_C_b_n).T*RTOD  #Roll Pitch Yaw
+    out_profile_data[k][3] = (out_profile_data[k][3] + 360) % 360
+    out_profile_data[k][4:7] = est_v_eb_n.T #Velocity ve vn vd
+    out_profile_data[k][7] = est_latR*RTOD #Latitude
+    out_profile_data[k][8] = est_longR*RTOD # Longitude
+    out_profile_data[k][9] = est_alt # Altitude
+    out_profile_data[k][10:13] = P_n[:, 0]
+    out_profile_data[k][13:16] = est_IMU_bias[0]
+    out_profile_data[k][16:19] = est_IMU_bias[1]
+
+    # Reset old values
+    old_time = epoch_time
+    old_C_b_n = est_C_b_n
+    old_v_eb_n = est_v_eb_n
+    old_latR = est_latR
+    old_longR = est_longR
+    old_alt = est_alt
+
+  return out_profile_data
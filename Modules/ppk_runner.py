@@ -0,0 +1,216 @@
+###############################################################################
+# File:  ppk_runner.py
+#
+# Description:
+# Batch PPK processing with RTKLIB rnx2rtkp (3_PPK.ipynb). Independent
+# rover/base jobs run in parallel, at most `max_workers` rnx2rtkp processes
+# at a time, with stdout/stderr of each run kept in a log file.
+#
+# Results are cached by content: the key of a job is the SHA-256 of its input
+# files, the configuration file, the rnx2rtkp executable (tool version) and
+# the command options. A job whose key is already in the cache is not run;
+# the cached .pos file is copied to the requested output.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import hashlib
+import shutil
+import subprocess
+import threading
+import time
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from Modules.d_print import Debug, Info
+
+
+class PPK_job:
+  def __init__(self, rover_obs: str, base_obs: str, base_nav: str,
+               rover_nav: str = '', extra: list = [], pos_out: str = ''):
+    self.rover_obs = rover_obs
+    self.base_obs = base_obs
+    self.base_nav = base_nav
+    self.rover_nav = rover_nav
+    self.extra = list(extra)      # Precise orbits/clocks (.sp3, .clk), ...
+    self.pos_out = pos_out if pos_out != '' else os.path.splitext(rover_obs)[0] + '.pos'
+
+  def inputs(self) -> list:
+    """
+      Input files in the order given to rnx2rtkp.
+    """
+    files = [self.rover_obs, self.base_obs, self.base_nav]
+    if self.rover_nav != '':
+      files.append(self.rover_nav)
+    return files + self.extra
+
+
+# job, .pos file, taken from cache, rnx2rtkp return code, log file,
+# run time (sec), parsed solution (read_pos)
+PPK_result = namedtuple('PPK_result', ['job', 'pos_file', 'cached', 'returncode',
+                                       'log_file', 'seconds', 'solution'])
+
+
+class PPK_runner:
+  def __init__(self, rnx2rtkp: str, config: str,
+               cache_dir: str = '',
+               max_workers: int = 0,
+               options: list = []):
+    self.rnx2rtkp = rnx2rtkp
+    self.config = config
+    self.options = list(options)
+    self.max_workers = max_workers if max_workers > 0 else (os.cpu_count() or 1)
+    self.cache_dir = cache_dir if cache_dir != '' else os.path.join(os.path.dirname(os.path.abspath(config)), 'ppk_cache')
+    self.__hashes = {}    # (path, size, mtime) -> sha256
+
+  def job_key(self, job: PPK_job) -> str:
+    """
+      Content hash of everything that determines the job output.
+    """
+    h = hashlib.sha256()
+    h.update(self.__file_hash(self.rnx2rtkp).encode())
+    h.update(self.__file_hash(self.config).encode())
+    h.update(' '.join(self.options).encode())
+    for fn in job.inputs():
+      h.update(self.__file_hash(fn).encode())
+    return h.hexdigest()
+
+  def run(self, jobs: list, parse: bool = True) -> list:
+    """
+      Run all jobs, at most max_workers at a time. Results are in the order
+      of `jobs`.
+    """
+    if not os.path.exists(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+      results = list(pool.map(lambda j: self.__run_job(j, parse), jobs))
+    n_cached = sum(r.cached for r in results)
+    Info(f'PPK: {len(results)} jobs, {n_cached} from cache, {len(results) - n_cached} processed')
+    return results
+
+  def __run_job(self, job: PPK_job, parse: bool) -> PPK_result:
+    now = time.perf_counter()
+    key = self.job_key(job)
+    pos_cache = os.path.join(self.cache_dir, key + '.pos')
+    log_file = os.path.join(self.cache_dir, key + '.log')
+
+    cached = os.path.exists(pos_cache)
+    returncode = 0
+    if not cached:
+      tmp_out = pos_cache + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+      cmd = [self.rnx2rtkp, '-k', self.config] + self.options + ['-o', tmp_out] + job.inputs()
+      Debug(' '.join(cmd))
+      with open(log_file, 'w') as log:
+        returncode = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT).returncode
+      if returncode == 0 and os.path.exists(tmp_out):
+        os.replace(tmp_out, pos_cache)
+      elif os.path.exists(tmp_out):
+        os.remove(tmp_out)
+
+    pos_file = ''
+    solution = None
+    if os.path.exists(pos_cache):
+      out_dir = os.path.dirname(os.path.abspath(job.pos_out))
+      if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+      shutil.copyfile(pos_cache, job.pos_out)
+      pos_file = job.pos_out
+      if parse:
+        solution = read_pos(pos_file)
+    return PPK_result(job, pos_file, cached, returncode, log_file,
+                      time.perf_counter() - now, solution)
+
+  def __file_hash(self, fn: str) -> str:
+    st = os.stat(fn)
+    memo = (os.path.abspath(fn), st.st_size, st.st_mtime_ns)
+    if memo not in self.__hashes:
+      h = hashlib.sha256()
+      with open(fn, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+          h.update(block)
+      self.__hashes[memo] = h.hexdigest()
+    return self.__hashes[memo]
+
+
+def read_pos(pos_file: str) -> np.ndarray:
+
+  # Read a rnx2rtkp solution written with GPS week/TOW time
+  #
+  # INPUTS:
+  #   pos_file    .pos file
+  #
+  # OUTPUTS
+  #   data        (n, m) array: week, TOW, lat, lon, height, Q, ns,
+  #               sdn, sde, sdu, sdne, sdeu, sdun, age, ratio[, velocities]
+
+  data = np.loadtxt(pos_file, comments='%', ndmin=2)
+  return data
+
+
+def test():
+  import sys
+  import tempfile
+
+  tmp = tempfile.mkdtemp()
+  try:
+    # Stand-in for rnx2rtkp: writes one solution line per input file and
+    # counts its calls
+    stub = os.path.join(tmp, 'rnx2rtkp_stub.py')
+    with open(stub, 'w') as fh:
+      fh.write(f'#!{sys.executable}\n'
+               'import sys, time\n'
+               'args = sys.argv[1:]\n'
+               'out = args[args.index("-o") + 1]\n'
+               'inputs = args[args.index("-o") + 2:]\n'
+               f'open({os.path.join(tmp, "calls")!r}, "a").write("x")\n'
+               'time.sleep(0.2)\n'
+               'print("processing", inputs)\n'
+               'with open(out, "w") as f:\n'
+               '  f.write("% stub solution\\n")\n'
+               '  for i, fn in enumerate(inputs):\n'
+               '    f.write(f"2186 {467000 + i} 60.0 5.0 {len(open(fn).read())} 1 9\\n")\n')
+    os.chmod(stub, 0o755)
+
+    conf = os.path.join(tmp, 'ppk.conf')
+    with open(conf, 'w') as fh:
+      fh.write('pos1-posmode =kinematic\n')
+    for name in ('base.obs', 'base.nav'):
+      with open(os.path.join(tmp, name), 'w') as fh:
+        fh.write(name)
+    jobs = []
+    for k in range(4):
+      fn = os.path.join(tmp, f'rover{k}.obs')
+      with open(fn, 'w') as fh:
+        fh.write('o'*(k + 1))
+      jobs.append(PPK_job(fn, os.path.join(tmp, 'base.obs'), os.path.join(tmp, 'base.nav'),
+                          pos_out=os.path.join(tmp, 'Position', f'rover{k}.pos')))
+
+    calls = lambda: len(open(os.path.join(tmp, 'calls')).read())
+    runner = PPK_runner(stub, conf, cache_dir=os.path.join(tmp, 'cache'), max_workers=2)
+    now = time.perf_counter()
+    res = runner.run(jobs)
+    t_run = time.perf_counter() - now
+    assert calls() == 4 and not any(r.cached for r in res)
+    assert [r.solution[0, 4] for r in res] == [1, 2, 3, 4]
+
+    # Unchanged inputs: nothing runs
+    res = PPK_runner(stub, conf, cache_dir=os.path.join(tmp, 'cache'), max_workers=2).run(jobs)
+    assert calls() == 4 and all(r.cached for r in res)
+
+    # A changed rover file and a changed config
+    with open(jobs[1].rover_obs, 'w') as fh:
+      fh.write('changed')
+    res = PPK_runner(stub, conf, cache_dir=os.path.join(tmp, 'cache'), max_workers=2).run(jobs)
+    assert calls() == 5 and [r.cached for r in res] == [True, False, True, True]
+    with open(conf, 'a') as fh:
+      fh.write('pos1-elmask =15\n')
+    res = PPK_runner(stub, conf, cache_dir=os.path.join(tmp, 'cache'), max_workers=2).run(jobs)
+    assert calls() == 9
+    print(f'4 jobs in {t_run:.2f} s with 2 workers, cached reruns skip unchanged jobs')
+  finally:
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  test()
@@ -16,10 +16,8 @@
 # %%
 import os
 import csv
-import xarray as xr
 from Modules.d_print import Debug,Info,Print
 import Modules.common as c
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 
 class Pos_data():
@@ -134,6 +132,21 @@ class Pos_data():
     return self.get_col(c.CHN_UTC)[0]
 
 
+  def peek_first_utc(self) -> str:
+    """
+      First date of the file from its first data row only, without setup,
+      so satellite data can be fetched while the file is being read
+    """
+    if not os.path.exists(self.filename):
+      raise Exception(f'"{self.filename}" does not exist. Input full dir.')
+
+    with open(self.filename, 'r') as file:
+      reader = csv.reader(file)
+      titles = [t.strip() for t in next(reader)]
+      row = next(reader)
+    return row[titles.index(c.CHN_UTC)]
+
+
   def print_titles(self):
     self.setup_check()
 
@@ -22,16 +22,15 @@ from typing import Mapping, List, Tuple
 import georinex as gr
 import datetime as dt
 import numpy as np
-import pyproj as pp
 import typing as t
-import wget as wget
 import time
 import os
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 import Modules.common as c
 import Modules.Esa_stations as s
 from Modules.d_print import Print, Debug
+from Modules.sat_block import Sat_block
+from Modules.ephemeris_index import Ephemeris_index, Ephemeris_choice, utc_to_gps
 
 # TODO: create directory if it doesn't exist
 # Directory where downloaded rinex files are stored 
@@ -50,54 +49,50 @@ class Satellite:
     self.prn = prn
     self.dates = [date]
     self.gps_data = {self.dates[0]: gps_data}
+    self.ephemeris = {self.dates[0]: Ephemeris_index.from_dataset(gps_data)}
     Print('debug0', f'Created Satellite object (PRN: {prn})')
     Print('debug0', f'data: {self.gps_data[self.dates[0]]["time"]}')
 
 
-  def get_position(self, times: t.List[dt.datetime] = []):
-    if len(times) == 0:
-      raise Exception('list of times cannot be empty.')
+  def select_ephemeris(self, times: t.List[dt.datetime]) -> Ephemeris_choice:
+    """
+      Navigation record of each time (UTC): the latest healthy one with toe
+      before the time, within its fit interval (index -1 and IODE NaN if
+      none)
+    """
     mes_date = dt.date(times[0].year, times[0].month, times[0].day)
     if mes_date not in self.dates:
       raise Exception('Data for this date doesn\'t exist')
+    return self.ephemeris[mes_date].select(utc_to_gps(times))
 
-    # Select the nearest recorded NAV message 
-    close_nav = self.gps_data[mes_date].sel(time=times, method='nearest')
 
-    Print('\\debug0', f'Satellite PRN: {self.prn}')
-    Print('\\debug0', f'NAV GPS message from times:')
-    for i in close_nav["time"].values:
-      Print('debug0', f'- {i}')
-
-    Print('\\debug0', f'Requested compute at times:')
-    for i in times:
-      Print('debug0', f'- {i}')
-
-    # Get the time of the NAV message
-    td = close_nav["time"].values.astype('datetime64[us]').astype(dt.datetime)
-
-    Print('\\debug0', f'Difference between NAV message and requested times (- before, + after NAV):')
-    for i,j in zip(times, td):
-      dif = i-j
-      if dif < dt.timedelta(days=0):
-        Print('debug0', f' -{-dif}')
-      else:
-        Print('debug0', f' +{dif}')
+  def get_position(self, times: t.List[dt.datetime] = []):
+    if len(times) == 0:
+      raise Exception('list of times cannot be empty.')
+    mes_date = dt.date(times[0].year, times[0].month, times[0].day)
+    choice = self.select_ephemeris(times)
 
-    Print('\\0debug', f'After: {close_nav}')
+    Print('\\debug0', f'Satellite PRN: {self.prn}')
+    Print('\\debug0', f'Ephemerides (toe, IODE) for the requested times:')
+    for i, toe, iode in zip(times, choice.toe, choice.iode):
+      Print('debug0', f'- {i}: {toe} {iode}')
 
-    ecef = gr.keplerian.keplerian2ecef(close_nav)
+    # Chosen records propagated to the requested times (tk = t - toe, not
+    # the record time, both GPS time), NaN where no record is valid
+    xyz = self.ephemeris[mes_date].positions(utc_to_gps(times), choice)
 
-    da = xr.DataArray(list(ecef), dims=['space', 'time'], coords=[['x','y','z'], times])
+    da = xr.DataArray(xyz, dims=['space', 'time'], coords=[['x','y','z'], times])
 
     return da
 
 
   def add_date(self, datetime: dt.datetime, gps_data: Dataset):
     if not self.has_date(datetime):
-      self.gps_data[datetime.date] = gps_data
+      self.dates.append(datetime)
+      self.gps_data[datetime] = gps_data
+      self.ephemeris[datetime] = Ephemeris_index.from_dataset(gps_data)
     else:
-       Print('debug', f'Data for {datetime.date} already exists.')
+       Print('debug', f'Data for {datetime} already exists.')
 
   def has_date(self, date: dt.date) -> bool:
     return date in self.gps_data.keys()
@@ -200,6 +195,7 @@ class Orbital_data:
     
     Print('debug0', f'get_file()')
     if not self.local_file_exists():
+      import wget     # only needed to download
       downloaded = False
       tries = 0
       while not downloaded:
@@ -260,10 +256,12 @@ class Orbital_data:
 
     Print('info\\0',f'Done. ({time.perf_counter()-now:.3f}s for {len(self.sats)} satellites)')
 
-  def get_sats_pos(self, time_list: List[dt.datetime]) -> Mapping[str, Mapping[str, Tuple[float, float, float]]]:
+  def get_sats_pos(self, time_list: List[dt.datetime]) -> Sat_block:
     """
       Input a list of times for when to compute the positions of the satellites.
       Inputs can be either ISO formatted strings or datetime objects.
+      Returns a Sat_block (epochs x satellites); block[time][prn] gives the
+      old {time: {prn: (x,y,z)}} access.
     """
     self.setup_check()
     
@@ -275,7 +273,7 @@ class Orbital_data:
       Print('\\error\\', f'[get_sats_pos] No Satellite objects in this instance (no file has been read yet)')
       return
 
-    times = time_list.copy()
+    times = list(time_list)
 
     if len(times) != 0:
       for i in range(len(times)):
@@ -285,22 +283,33 @@ class Orbital_data:
     now = time.perf_counter()
     Print('info0', f'Calculating satellite positions for "{self.utc.year}-{self.utc.month}-{self.utc.day}"...')
 
-    results = {}
-    for t in time_list:
-        results[t] = {}
-    
-    # TODO: fix output format to: time{} -> prn{} = (x,y,z)
-    for prn in list(self.sats.keys()):
+    # One (time, x/y/z) array per satellite, written to its block column
+    prns = list(self.sats.keys())
+    pos = np.full((len(times), len(prns), 3), np.nan)
+    for j, prn in enumerate(prns):
       dr = self.sats[prn].get_position(times)
-
-      for t in times:
-        results[t.isoformat(sep=' ')][prn] =  dr.sel(time=t).values
+      pos[:, j, :] = dr.transpose('time', 'space').values
 
     Print('debug\\',f'Done. ({time.perf_counter()-now:.3f}s for {len(self.sats)*len(times)} positions)')
 
-    # Output order is:  times{} -> prn{} = (x,y,z)
+    return Sat_block(times, prns, pos)
 
-    return results
+  def ephemeris_used(self, time_list: List[dt.datetime]) -> Tuple[list, np.ndarray, np.ndarray]:
+    """
+      Audit of the navigation records used by get_sats_pos for the same
+      times: satellites, toe (times x satellites, datetime64, NaT if none)
+      and IODE (times x satellites, NaN if none)
+    """
+    self.setup_check()
+    times = [dt.datetime.fromisoformat(i) if type(i) == str else i for i in time_list]
+    prns = list(self.sats.keys())
+    toe = np.full((len(times), len(prns)), np.datetime64('NaT', 'ms'))
+    iode = np.full((len(times), len(prns)), np.nan)
+    for j, prn in enumerate(prns):
+      choice = self.sats[prn].select_ephemeris(times)
+      toe[:, j] = choice.toe
+      iode[:, j] = choice.iode
+    return prns, toe, iode
 
 
 if __name__ == '__main__':
@@ -311,6 +320,7 @@ if __name__ == '__main__':
   o.setup()
   o.print_data()
   print("Results:\n",o.get_sats_pos(['2021-12-03 08:25:31', '2021-12-03 14:25:31']))
+  print("IODE:\n",o.ephemeris_used(['2021-12-03 08:25:31', '2021-12-03 14:25:31'])[2])
   # o.get_sats_pos(['2021-12-10 08:25:31', '2021-12-10 14:25:31'])
 
 
@@ -0,0 +1,338 @@
+###############################################################################
+# File:  rinex_convert.py
+#
+# Description:
+# Raw Trimble .T04 to merged RINEX conversion of 1_Convert_To_Rinex.ipynb as
+# a dependency graph of file targets:
+#
+#   seg.T04 --runpkr00--> seg.tgd --teqc +obs--> seg.obs --+--merge_obs----> first-last.obs
+#                                 \--teqc +nav--> seg.nav --+--merge_nav----> first-last.nav
+#
+# Build_graph runs every target whose inputs are built, up to `max_workers`
+# at a time, so the segments convert in parallel. A target is rebuilt only
+# when its output is missing or changed, or the content of one of its
+# inputs changed since the last build (SHA-256, looked up by size/mtime).
+# The state is kept in .build_state.json of the result folder. run()
+# returns the time spent per step.
+#
+# Actions are callables action(inputs, output); the external tools are
+# given by Tools and can be any executable (stand-in scripts in test()).
+# The observation and navigation files are merged by rinex_obs_merge and
+# rinex_nav_merge, or with teqc when Tools(native_obs=False, native_nav=False).
+#                                                                             #
+###############################################################################
+
+# %%
+import hashlib
+import json
+import glob
+import subprocess
+import threading
+import time
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from Modules.d_print import Debug, Info
+from Modules.rinex_nav_merge import merge_nav
+from Modules.rinex_obs_merge import merge_obs
+
+
+class Target:
+  def __init__(self, output: str, inputs: list, action, step: str = ''):
+    self.output = output
+    self.inputs = list(inputs)
+    self.action = action     # action(inputs, output), raises on failure
+    self.step = step
+
+
+class Build_graph:
+  def __init__(self, state_file: str, max_workers: int = 0):
+    self.state_file = state_file
+    self.max_workers = max_workers if max_workers > 0 else (os.cpu_count() or 1)
+    self.targets = {}
+    self.state = {}
+    if os.path.exists(state_file):
+      with open(state_file) as fh:
+        self.state = json.load(fh)
+    self.__hashes = {}
+    self.__lock = threading.Lock()
+
+  def add(self, target: Target) -> Target:
+    self.targets[os.path.abspath(target.output)] = target
+    return target
+
+  def is_up_to_date(self, target: Target) -> bool:
+    """
+      Output present and unchanged, and no input changed since it was built.
+    """
+    out = os.path.abspath(target.output)
+    rec = self.state.get(out)
+    if rec is None or not os.path.exists(out):
+      return False
+    if rec['output'] != self.file_hash(out):
+      return False
+    return rec['inputs'] == {os.path.abspath(fn): self.file_hash(fn) for fn in target.inputs}
+
+  def run(self) -> dict:
+    """
+      Build all out of date targets. Returns per step
+      {'built': n, 'skipped': n, 'failed': n, 'seconds': t}.
+    """
+    deps = {out: {os.path.abspath(fn) for fn in t.inputs if os.path.abspath(fn) in self.targets}
+            for out, t in self.targets.items()}
+    report = {}
+    for t in self.targets.values():
+      report.setdefault(t.step, {'built': 0, 'skipped': 0, 'failed': 0, 'seconds': 0.0})
+
+    done = set()
+    failed = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+      while len(done) + len(failed) < len(self.targets):
+        n_failed = len(failed)
+        for out, t in self.targets.items():
+          if out in done or out in failed or out in running.values():
+            continue
+          if deps[out] & failed:
+            failed.add(out)
+            report[t.step]['failed'] += 1
+          elif deps[out] <= done:
+            running[pool.submit(self.__build, t, report[t.step])] = out
+        if len(running) == 0:
+          if len(failed) == n_failed:
+            raise ValueError('Build_graph: dependency cycle between targets')
+          continue
+        finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for fut in finished:
+          out = running.pop(fut)
+          (done if fut.result() else failed).add(out)
+
+    self.__save()
+    for step, r in report.items():
+      Info(f'{step}: {r["built"]} built, {r["skipped"]} up to date, {r["failed"]} failed, {r["seconds"]:.2f} s')
+    return report
+
+  def file_hash(self, fn: str) -> str:
+    st = os.stat(fn)
+    memo = (os.path.abspath(fn), st.st_size, st.st_mtime_ns)
+    with self.__lock:
+      if memo in self.__hashes:
+        return self.__hashes[memo]
+    h = hashlib.sha256()
+    with open(fn, 'rb') as fh:
+      for block in iter(lambda: fh.read(1 << 20), b''):
+        h.update(block)
+    with self.__lock:
+      self.__hashes[memo] = h.hexdigest()
+    return h.hexdigest()
+
+  def __build(self, target: Target, report: dict) -> bool:
+    if self.is_up_to_date(target):
+      with self.__lock:
+        report['skipped'] += 1
+      return True
+
+    now = time.perf_counter()
+    try:
+      target.action(target.inputs, target.output)
+      ok = os.path.exists(target.output)
+    except Exception as ex:
+      Debug(f'{target.output}: {ex}')
+      ok = False
+    dt = time.perf_counter() - now
+    if ok:
+      rec = {'inputs': {os.path.abspath(fn): self.file_hash(fn) for fn in target.inputs},
+             'output': self.file_hash(target.output)}
+
+    with self.__lock:
+      report['seconds'] += dt
+      if ok:
+        report['built'] += 1
+        self.state[os.path.abspath(target.output)] = rec
+      else:
+        report['failed'] += 1
+    return ok
+
+  def __save(self) -> None:
+    with open(self.state_file, 'w') as fh:
+      json.dump(self.state, fh, indent=1)
+
+
+class Tools:
+  def __init__(self, runpkr: str = 'runpkr00', teqc: str = 'teqc', week: int = 2186,
+               native_obs: bool = True, native_nav: bool = True):
+    self.runpkr = runpkr
+    self.teqc = teqc
+    self.week = week
+    self.native_obs = native_obs
+    self.native_nav = native_nav
+
+  def tgd(self, inputs, output) -> None:
+    # runpkr00 writes the .tgd next to the .T04
+    t04 = inputs[0]
+    _check_call([self.runpkr, '-g', '-d', t04])
+    produced = os.path.splitext(t04)[0] + '.tgd'
+    if os.path.abspath(produced) != os.path.abspath(output):
+      os.replace(produced, output)
+
+  def obs(self, inputs, output) -> None:
+    _check_call([self.teqc, '+C2', '+L5', '+L8', '-week', str(self.week), '-tr', 'd',
+                 '+obs', output, inputs[0]])
+
+  def nav(self, inputs, output) -> None:
+    _check_call([self.teqc, '+nav', output, inputs[0]])
+
+  def merge(self, inputs, output) -> None:
+    with open(output + '.part', 'w') as fh:
+      _check_call([self.teqc, '-O.s', 'M'] + list(inputs), stdout=fh)
+    os.replace(output + '.part', output)
+
+  def merge_obs(self, inputs, output) -> None:
+    if not self.native_obs:
+      return self.merge(inputs, output)
+    merge_obs(inputs, output)
+
+  def merge_nav(self, inputs, output) -> None:
+    if not self.native_nav:
+      return self.merge(inputs, output)
+    merge_nav(inputs, output, collect=False)
+
+
+def _check_call(cmd, stdout = subprocess.DEVNULL) -> None:
+  Debug(' '.join(cmd))
+  subprocess.run(cmd, stdout=stdout, stderr=subprocess.DEVNULL, check=True)
+
+
+def conversion_graph(raw_dir: str, result_dir: str, rover_dir: str,
+                     tools: Tools = None, max_workers: int = 0) -> Build_graph:
+
+  # Targets of the T04 -> merged RINEX conversion
+  #
+  # INPUTS:
+  #   raw_dir     Folder of the .T04 segments
+  #   result_dir  Folder of the per-segment .tgd/.obs/.nav (and build state)
+  #   rover_dir   Folder of the merged first-last.obs/.nav
+  #   tools       External tools (Tools())
+  #   max_workers Parallel actions
+  #
+  # OUTPUTS
+  #   Build_graph, to be run()
+
+  tools = tools if tools is not None else Tools()
+  for folder in (result_dir, rover_dir):
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+  graph = Build_graph(os.path.join(result_dir, '.build_state.json'), max_workers)
+
+  names = sorted(os.path.splitext(os.path.basename(fn))[0] for fn in glob.glob(os.path.join(raw_dir, '*.T04')))
+  obs_files = []
+  nav_files = []
+  for name in names:
+    tgd = graph.add(Target(os.path.join(result_dir, name + '.tgd'), [os.path.join(raw_dir, name + '.T04')], tools.tgd, 'runpkr00'))
+    obs_files.append(graph.add(Target(os.path.join(result_dir, name + '.obs'), [tgd.output], tools.obs, 'teqc obs')).output)
+    nav_files.append(graph.add(Target(os.path.join(result_dir, name + '.nav'), [tgd.output], tools.nav, 'teqc nav')).output)
+
+  if len(names) > 0:
+    merged = os.path.join(rover_dir, names[0] + '-' + names[-1])
+    graph.add(Target(merged + '.obs', obs_files, tools.merge_obs, 'merge obs'))
+    graph.add(Target(merged + '.nav', nav_files, tools.merge_nav, 'merge nav'))
+  return graph
+
+
+def test():
+  import sys
+  import shutil
+  import tempfile
+  import datetime as dt
+  from Modules.rinex_obs_merge import read_obs_header, iter_obs_epochs
+  from Modules.rinex_nav_merge import read_nav_header, iter_nav_records
+
+  tmp = tempfile.mkdtemp()
+  try:
+    raw = os.path.join(tmp, 'raw')
+    os.makedirs(raw)
+    for k in range(6):
+      with open(os.path.join(raw, f'seg{k:02}.T04'), 'w') as fh:
+        fh.write(f'raw {k}\n')
+
+    # Stand-ins for runpkr00 and teqc, each call sleeps 0.1 s. teqc +obs
+    # writes one RINEX 2 epoch at 08:00:<segment> (C1 = size of its input)
+    # followed by a flag 4 comment block with blank time fields; teqc +nav
+    # one G01 record at <segment>:00:29.5 (IODE = segment, clock bias =
+    # size of its input in us)
+    obs_header = ('     2.11           OBSERVATION DATA    G (GPS)'.ljust(60) + 'RINEX VERSION / TYPE\n' +
+                  '     1    C1'.ljust(60) + '# / TYPES OF OBSERV\n' +
+                  'END OF HEADER'.rjust(73) + '\n')
+    obs_event = ' '*28 + '4  1\n' + 'EVENT: NEW SITE OCCUPATION'.ljust(60) + 'COMMENT\n'
+    nav_header = ('     2.11           N: GPS NAV DATA'.ljust(60) + 'RINEX VERSION / TYPE\n' +
+                  'END OF HEADER'.rjust(73) + '\n')
+    runpkr = os.path.join(tmp, 'runpkr_stub.py')
+    with open(runpkr, 'w') as fh:
+      fh.write(f'#!{sys.executable}\n'
+               'import sys, time\n'
+               'time.sleep(0.1)\n'
+               'src = sys.argv[-1]\n'
+               'open(src[:-4] + ".tgd", "w").write("tgd " + open(src).read())\n')
+    teqc = os.path.join(tmp, 'teqc_stub.py')
+    with open(teqc, 'w') as fh:
+      fh.write(f'#!{sys.executable}\n'
+               'import sys, time\n'
+               'time.sleep(0.1)\n'
+               'a = sys.argv[1:]\n'
+               'if "-O.s" in a:\n'
+               '  sys.stdout.write("".join(open(f).read() for f in a[2:]))\n'
+               'elif "+obs" in a:\n'
+               '  src, out = a[-1], a[a.index("+obs") + 1]\n'
+               '  epoch = " 21 12  3  8  0%11.7f  0  1G01\\n%14.3f\\n" % (int(src[-6:-4]), len(open(src).read()))\n'
+               f'  open(out, "w").write({obs_header!r} + epoch + {obs_event!r})\n'
+               'else:\n'
+               '  src, out = a[-1], a[a.index("+nav") + 1]\n'
+               '  k = int(src[-6:-4])\n'
+               '  vals = [len(open(src).read())*1e-6, 0.0, 0.0, float(k)] + [0.0]*27\n'
+               '  rec = [" 1 21 12 03 %02d 00 29.5" % k + "".join("%19.12E" % v for v in vals[0:3])]\n'
+               '  rec += ["   " + "".join("%19.12E" % v for v in vals[3 + 4*i:7 + 4*i]) for i in range(7)]\n'
+               f'  open(out, "w").write({nav_header!r} + "\\n".join(rec) + "\\n")\n')
+    for fn in (runpkr, teqc):
+      os.chmod(fn, 0o755)
+    tools = Tools(runpkr, teqc)
+
+    def build():
+      graph = conversion_graph(raw, os.path.join(tmp, 'Result'), os.path.join(tmp, 'Rover'), tools, max_workers=6)
+      now = time.perf_counter()
+      report = graph.run()
+      return report, time.perf_counter() - now
+
+    def merged_obs():
+      with open(os.path.join(tmp, 'Rover', 'seg00-seg05.obs')) as fh:
+        return list(iter_obs_epochs(fh, read_obs_header(fh)))
+
+    def merged_nav():
+      with open(os.path.join(tmp, 'Rover', 'seg00-seg05.nav')) as fh:
+        _, version, system = read_nav_header(fh)
+        return list(iter_nav_records(fh, version, system))
+
+    report, t_all = build()
+    epochs = merged_obs()
+    assert [ep.date[5] for ep in epochs] == [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
+    records = merged_nav()
+    assert [toc for _, toc, _, _ in records] == [dt.datetime(2021, 12, 3, k, 0, 29, 500000) for k in range(6)]
+    assert all(r['built'] > 0 and r['failed'] == 0 for r in report.values())
+
+    report, t_none = build()
+    assert all(r['built'] == 0 for r in report.values())
+
+    # One changed segment: its chain and the merges only; a touched but
+    # unchanged segment is not rebuilt
+    with open(os.path.join(raw, 'seg03.T04'), 'w') as fh:
+      fh.write('raw 3 changed\n')
+    os.utime(os.path.join(raw, 'seg04.T04'))
+    report, t_one = build()
+    assert [report[s]['built'] for s in ('runpkr00', 'teqc obs', 'teqc nav', 'merge obs', 'merge nav')] == [1, 1, 1, 1, 1]
+    assert merged_nav()[3][2][0] == len('tgd raw 3 changed\n')*1e-6
+    assert float(merged_obs()[3].obs['G01'][0]) == len('tgd raw 3 changed\n')
+    print(f'6 segments: full build {t_all:.2f} s, no-op {t_none:.2f} s, one changed segment {t_one:.2f} s')
+  finally:
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  test()
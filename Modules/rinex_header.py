@@ -0,0 +1,261 @@
+###############################################################################
+# File:  rinex_header.py
+#
+# Description:
+# Header-only reading of RINEX files: scan_header() stops at END OF HEADER
+# and returns the metadata (times, interval, observation types, marker,
+# receiver, antenna, approximate position), instead of reading the whole
+# observation file as download_corr does for TIME OF FIRST OBS.
+#
+# Rinex_index keeps the metadata of all RINEX files of a folder in a JSON
+# file (.rinex_index.json). update() only scans the files that are new or
+# changed (size/mtime), so selecting base stations or download dates over
+# hundreds of files needs no file reading. Files are read through
+# rinex_obs_merge.open_text: plain, .gz and Compact RINEX.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import datetime as dt
+import fnmatch
+import json
+import time
+import os
+from collections import namedtuple
+from Modules.ins_nav import ECEF_to_LLA, RTOD
+from Modules.rinex_obs_merge import open_text, read_obs_header, GPS_EPOCH
+from Modules.d_print import Info
+
+
+RINEX_PATTERNS = ('*.obs', '*.nav', '*.rnx', '*.crx', '*.rnx.gz', '*.crx.gz',
+                  '*.[0-9][0-9][oOdDnNgG]', '*.[0-9][0-9][oOdDnNgG].gz')
+
+# version, file type ('O', 'N', ...), system, marker name, receiver (type
+# and version), antenna type, approx. ECEF position (m) and lat/lon (deg)/
+# height (m) or None, observation types {system: [types]}, interval (sec),
+# first/last observation (ISO time or ''), time system, file size and mtime
+Rinex_meta = namedtuple('Rinex_meta', ['path', 'version', 'file_type', 'system', 'marker',
+                                       'receiver', 'antenna', 'approx_xyz', 'approx_lla',
+                                       'obs_types', 'interval', 'first_obs', 'last_obs',
+                                       'time_system', 'size', 'mtime_ns'])
+
+
+def _obs_time(line: str) -> str:
+  if line[0:6].strip() == '':
+    return ''
+  sec = float(line[30:43])
+  t = dt.datetime(int(line[0:6]), int(line[6:12]), int(line[12:18]), int(line[18:24]),
+                  int(line[24:30])) + dt.timedelta(seconds=sec)
+  return t.isoformat()
+
+
+def scan_header(fn: str) -> Rinex_meta:
+
+  # Metadata of a RINEX file from its header only
+  #
+  # INPUTS:
+  #   fn          RINEX observation or navigation file (.gz, .crx allowed)
+  #
+  # OUTPUTS
+  #   Rinex_meta
+
+  st = os.stat(fn)
+  with open_text(fn) as fh:
+    h = read_obs_header(fh)
+
+  file_type = system = marker = receiver = antenna = first = last = ''
+  xyz = None
+  for line in h.lines:
+    label = line[60:80].strip()
+    if label == 'RINEX VERSION / TYPE':
+      file_type = line[20]
+      system = line[40].strip()
+    elif label == 'MARKER NAME':
+      marker = line[0:60].strip()
+    elif label == 'REC # / TYPE / VERS':
+      receiver = ' '.join(line[20:60].split())
+    elif label == 'ANT # / TYPE':
+      antenna = line[20:40].strip()
+    elif label == 'APPROX POSITION XYZ':
+      xyz = tuple(float(line[14*i:14*(i + 1)]) for i in range(3))
+    elif label == 'TIME OF FIRST OBS':
+      first = _obs_time(line)
+    elif label == 'TIME OF LAST OBS':
+      last = _obs_time(line)
+
+  lla = None
+  if xyz is not None and np.linalg.norm(xyz) > 1e6:
+    lat, lon, alt = ECEF_to_LLA(np.array(xyz))
+    lla = (lat*RTOD, lon*RTOD, float(alt))
+  else:
+    xyz = None
+  return Rinex_meta(os.path.abspath(fn), h.version, file_type, system, marker, receiver, antenna,
+                    xyz, lla, h.obs_types, h.interval, first, last, h.time_system,
+                    st.st_size, st.st_mtime_ns)
+
+
+def download_dates(meta: Rinex_meta) -> tuple:
+
+  # Date values of download_corr from the first observation time
+  #
+  # OUTPUTS
+  #   date, year (str), day of year (3 digits), GPS week, GPS week and
+  #   week day (str, e.g. '21865')
+
+  t = dt.datetime.fromisoformat(meta.first_obs)
+  days = (t - GPS_EPOCH).days
+  week = days//7
+  return t.date(), str(t.year), f'{t.timetuple().tm_yday:03d}', week, f'{week}{days % 7}'
+
+
+class Rinex_index:
+  def __init__(self, folder: str, index_file: str = ''):
+    self.folder = folder
+    self.index_file = index_file if index_file != '' else os.path.join(folder, '.rinex_index.json')
+    self.entries = {}
+    if os.path.exists(self.index_file):
+      with open(self.index_file) as fh:
+        self.entries = {p: Rinex_meta(**m) for p, m in json.load(fh).items()}
+
+  def update(self, patterns = RINEX_PATTERNS, recursive: bool = False) -> list:
+    """
+      Scan the new and changed files, drop the removed ones and save the
+      index. Returns the metadata of all indexed files.
+    """
+    now = time.perf_counter()
+    found = {}
+    for root, dirs, files in os.walk(self.folder):
+      for name in files:
+        if any(fnmatch.fnmatch(name, p) for p in patterns):
+          found[os.path.abspath(os.path.join(root, name))] = True
+      if not recursive:
+        break
+
+    n_scanned = 0
+    entries = {}
+    for path in found:
+      st = os.stat(path)
+      old = self.entries.get(path)
+      if old is not None and old.size == st.st_size and old.mtime_ns == st.st_mtime_ns:
+        entries[path] = old
+        continue
+      try:
+        entries[path] = scan_header(path)
+        n_scanned += 1
+      except (ValueError, OSError, UnicodeDecodeError) as ex:
+        Info(f'{path}: not indexed ({ex})')
+
+    changed = n_scanned > 0 or entries.keys() != self.entries.keys()
+    self.entries = entries
+    if changed:
+      with open(self.index_file, 'w') as fh:
+        json.dump({p: m._asdict() for p, m in entries.items()}, fh)
+    Info(f'{self.folder}: {len(entries)} files indexed, {n_scanned} scanned in {time.perf_counter() - now:.3f} s')
+    return list(entries.values())
+
+  def select(self, file_type: str = '', marker: str = '', day: dt.date = None,
+             near = None, max_distance: float = np.inf) -> list:
+    """
+      Indexed files matching the given file type ('O', 'N'), marker name
+      prefix and observation day, sorted by distance to `near` (lat, lon
+      in deg) when given, within max_distance (m).
+    """
+    out = []
+    for m in self.entries.values():
+      if file_type != '' and m.file_type.upper() != file_type.upper():
+        continue
+      if marker != '' and not m.marker.upper().startswith(marker.upper()):
+        continue
+      if day is not None:
+        if m.first_obs == '':
+          continue
+        first = dt.datetime.fromisoformat(m.first_obs).date()
+        last = dt.datetime.fromisoformat(m.last_obs).date() if m.last_obs != '' else first
+        if not first <= day <= last:
+          continue
+      out.append(m)
+
+    if near is not None:
+      out = [m for m in out if m.approx_lla is not None]
+      dist = [_distance(near, m.approx_lla) for m in out]
+      order = np.argsort(dist, kind='stable')
+      out = [out[i] for i in order if dist[i] <= max_distance]
+    return out
+
+
+def _distance(p, q) -> float:
+  # Great circle distance (m) between (lat, lon) in deg
+  lat1, lon1, lat2, lon2 = np.radians([p[0], p[1], q[0], q[1]])
+  h = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+  return 2*6371000.0*np.arcsin(np.sqrt(h))
+
+
+def test():
+  import tempfile
+  import shutil
+  import gzip
+  from Modules.ins_nav import LLA_to_ECEF, DTOR
+
+  def header(version, marker, lla, first, n_types):
+    x, y, z = np.ravel(LLA_to_ECEF(lla[0]*DTOR, lla[1]*DTOR, lla[2]))
+    types = ['C1C', 'L1C', 'C2W', 'L2W', 'S1C', 'S2W', 'D1C', 'C5Q', 'L5Q', 'S5Q', 'D5Q', 'C1X', 'L1X', 'S1X'][:n_types]
+    lines = [f'{version:9.2f}           OBSERVATION DATA    M (MIXED)'.ljust(60) + 'RINEX VERSION / TYPE',
+             'teqc                UNAVCO              20211203 10:22:00UTCPGM / RUN BY / DATE',
+             marker.ljust(60) + 'MARKER NAME',
+             f'{"5329K":<20}{"TRIMBLE NETR9":<20}{"5.45":<20}REC # / TYPE / VERS',
+             f'{"1441":<20}{"TRM59800.00     NONE":<40}ANT # / TYPE',
+             f'{x:14.4f}{y:14.4f}{z:14.4f}'.ljust(60) + 'APPROX POSITION XYZ',
+             f'G  {len(types):3d}' + ''.join(f' {t}' for t in types[:13])]
+    lines[-1] = lines[-1].ljust(60) + 'SYS / # / OBS TYPES'
+    if len(types) > 13:
+      lines.append(('      ' + ''.join(f' {t}' for t in types[13:])).ljust(60) + 'SYS / # / OBS TYPES')
+    lines += ['    30.000'.ljust(60) + 'INTERVAL',
+              f'{first.year:6d}{first.month:6d}{first.day:6d}{first.hour:6d}{first.minute:6d}{first.second:13.7f}     GPS'.ljust(60) + 'TIME OF FIRST OBS',
+              ' '*60 + 'END OF HEADER']
+    return '\n'.join(lines) + '\n'
+
+  tmp = tempfile.mkdtemp()
+  try:
+    # 300 daily station files, the observations after the header are large
+    body = ('> 2021 12 03 00 00  0.0000000  0  1\nG01  20000000.000\n')*5000
+    t0 = dt.datetime(2021, 11, 1)
+    for k in range(300):
+      lla = (50.0 + (k % 30), -120.0 + 3*(k % 17), 100.0 + k)
+      text = header(3.04, f'ST{k % 30:02d}', lla, t0 + dt.timedelta(days=k//30), 14 if k == 0 else 5) + body
+      fn = os.path.join(tmp, f'ST{k % 30:02d}00XXX_R_2021{305 + k//30:03d}0000_01D_30S_MO.rnx')
+      if k % 3 == 0:
+        with gzip.open(fn + '.gz', 'wt') as fh:
+          fh.write(text)
+      else:
+        with open(fn, 'w') as fh:
+          fh.write(text)
+    with open(os.path.join(tmp, 'notes.txt'), 'w') as fh:
+      fh.write('not rinex')
+
+    m = scan_header(os.path.join(tmp, 'ST0000XXX_R_20213050000_01D_30S_MO.rnx.gz'))
+    assert m.marker == 'ST00' and m.receiver == 'TRIMBLE NETR9 5.45' and len(m.obs_types['G']) == 14
+    assert np.allclose(m.approx_lla, (50.0, -120.0, 100.0), atol=1e-6)
+    assert download_dates(m)[1:] == ('2021', '305', 2182, '21821')
+
+    now = time.perf_counter()
+    idx = Rinex_index(tmp)
+    assert len(idx.update()) == 300
+    t_build = time.perf_counter() - now
+
+    now = time.perf_counter()
+    idx = Rinex_index(tmp)
+    idx.update()
+    sel = idx.select(file_type='O', day=dt.date(2021, 11, 4), near=(55.2, -90.3))
+    t_query = time.perf_counter() - now
+    assert len(sel) == 30 and sel[0].marker == 'ST05'
+
+    os.utime(os.path.join(tmp, 'ST0100XXX_R_20213050000_01D_30S_MO.rnx'))
+    idx.update()
+    print(f'300 files: index built in {t_build*1e3:.0f} ms, reloaded and queried in {t_query*1e3:.0f} ms')
+  finally:
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  test()
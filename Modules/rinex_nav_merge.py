@@ -0,0 +1,298 @@
+###############################################################################
+# File:  rinex_nav_merge.py
+#
+# Description:
+# Merge of RINEX navigation files without teqc (merge_nav of
+# 1_Convert_To_Rinex.ipynb). Files are read record by record and the record
+# lines are copied to the output unchanged; an ephemeris already written is
+# skipped, identified by (SV, toc, IODE) (IODE is not defined for GLONASS and
+# SBAS, their key is (SV, toc)). Memory is one record plus the set of keys.
+#
+# The headers are read first: the first file gives the header of the merged
+# file, with the PGM / RUN BY / DATE line replaced, a comment listing the
+# number of merged files and, for RINEX 3, system 'M' when the inputs are
+# from different systems. All inputs must have the same major version and,
+# for RINEX 2, the same file type.
+#
+# merge_nav() also returns the decoded ephemerides as a Nav_table, so they
+# can be used without reading the merged file again. RINEX 2 and 3 GPS,
+# Galileo, BeiDou, QZSS, IRNSS (8 line records) and GLONASS, SBAS (4 lines)
+# are supported; .gz inputs are read directly.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import datetime as dt
+import gzip
+import os
+
+
+# Lines per record by system
+RECORD_LINES = {'G': 8, 'E': 8, 'C': 8, 'J': 8, 'I': 8, 'R': 4, 'S': 4}
+
+# RINEX 2 nav file type -> system
+V2_SYSTEMS = {'N': 'G', 'G': 'R', 'H': 'S'}
+
+# Values per record (clock line + 4 per orbit line)
+MAX_VALUES = 3 + 4*7
+
+
+class Nav_table:
+  def __init__(self, sv, toc, values):
+    self.sv = sv            # (n,) satellite ids, e.g. 'G01'
+    self.toc = toc          # (n,) datetime64[ms] time of clock
+    self.values = values    # (n, MAX_VALUES) clock and orbit values, NaN padded
+
+  def __len__(self):
+    return len(self.sv)
+
+
+def open_text(fn: str):
+  if fn.endswith('.gz'):
+    return gzip.open(fn, 'rt')
+  return open(fn, 'r')
+
+
+def read_nav_header(fh):
+
+  # Read a navigation file header
+  #
+  # INPUTS:
+  #   fh          Open text file, at the start
+  #
+  # OUTPUTS
+  #   lines       Header lines including END OF HEADER
+  #   version     RINEX version (float)
+  #   system      Satellite system of the records ('G', 'R', ... or 'M')
+
+  lines = []
+  version = 0.0
+  system = 'G'
+  for line in fh:
+    lines.append(line.rstrip('\n'))
+    label = line[60:80].strip()
+    if label == 'RINEX VERSION / TYPE':
+      version = float(line[0:9])
+      if version < 3.0:
+        system = V2_SYSTEMS.get(line[20].upper(), 'G')
+      else:
+        system = line[40].upper() if line[40].strip() != '' else 'G'
+    if label == 'END OF HEADER':
+      break
+  if version == 0.0:
+    raise ValueError('Not a RINEX navigation file (no RINEX VERSION / TYPE line)')
+  return lines, version, system
+
+
+def _float(field: str) -> float:
+  field = field.strip()
+  if field == '':
+    return np.nan
+  return float(field.replace('D', 'E').replace('d', 'e'))
+
+
+def _floats(line: str, start: int, n: int) -> list:
+  return [_float(line[start + 19*i:start + 19*(i + 1)]) for i in range(n)]
+
+
+def iter_nav_records(fh, version: float, system: str, line_no: int = 0):
+
+  # Records of a navigation file after the header
+  #
+  # INPUTS:
+  #   fh          Open text file, after read_nav_header
+  #   version     RINEX version
+  #   system      System of a RINEX 2 file
+  #   line_no     Lines already read (header), for the error messages
+  #
+  # OUTPUTS
+  #   Generator of (sv, toc, values, lines)
+
+  for line in fh:
+    line_no += 1
+    if line.strip() == '':
+      continue
+    line = line.rstrip('\n')
+    start = line_no
+    if version >= 3.0:
+      sv = line[0:3].replace(' ', '0')
+      n_lines = RECORD_LINES.get(sv[0], 8)
+      toc = dt.datetime(int(line[4:8]), int(line[9:11]), int(line[12:14]),
+                        int(line[15:17]), int(line[18:20]), int(line[21:23]))
+      values = _floats(line, 23, 3)
+      offset = 4
+    else:
+      sv = f'{system}{int(line[0:2]):02}'
+      n_lines = RECORD_LINES.get(system, 8)
+      yy = int(line[3:5])
+      toc = dt.datetime(yy + (2000 if yy < 80 else 1900), int(line[6:8]), int(line[9:11]),
+                        int(line[12:14]), int(line[15:17])) + dt.timedelta(seconds=float(line[17:22]))
+      values = _floats(line, 22, 3)
+      offset = 3
+
+    lines = [line]
+    for _ in range(n_lines - 1):
+      cont = next(fh, None)
+      if cont is None:
+        raise ValueError(f'{getattr(fh, "name", "navigation file")}: record of {sv} at line {start} '
+                         f'truncated ({len(lines)} of {n_lines} lines)')
+      line_no += 1
+      cont = cont.rstrip('\n')
+      lines.append(cont)
+      values += _floats(cont, offset, 4)
+    yield sv, toc, values, lines
+
+
+def record_key(sv: str, toc: dt.datetime, values: list):
+  # (SV, toc, IODE); IODE is the first orbit value of 8 line records
+  if RECORD_LINES.get(sv[0], 8) == 8:
+    return (sv, toc, values[3])
+  return (sv, toc, None)
+
+
+def merge_nav(nav_files: list, output: str, collect: bool = True,
+              program: str = 'rinex_nav_merge'):
+
+  # Merge navigation files into one
+  #
+  # INPUTS:
+  #   nav_files   Input files (.gz allowed)
+  #   output      Merged file
+  #   collect     Also return the decoded ephemerides
+  #   program     Name written in the PGM / RUN BY / DATE line
+  #
+  # OUTPUTS
+  #   Nav_table of the merged records (None if not collect)
+
+  # Headers only, to build the merged header
+  headers = []
+  for fn in nav_files:
+    with open_text(fn) as fh:
+      headers.append(read_nav_header(fh))
+  versions = {int(v) for _, v, _ in headers}
+  systems = {s for _, _, s in headers}
+  if len(versions) != 1:
+    raise ValueError(f'Cannot merge RINEX navigation versions {sorted(versions)}')
+  if versions == {2} and len(systems) != 1:
+    raise ValueError(f'Cannot merge RINEX 2 navigation files of systems {sorted(systems)}')
+
+  header = []
+  for line in headers[0][0]:
+    label = line[60:80].strip()
+    if label == 'RINEX VERSION / TYPE' and len(systems) > 1:
+      line = line[:40] + 'M' + line[41:]
+    if label == 'PGM / RUN BY / DATE':
+      line = f'{program:<20}{"":<20}{dt.datetime.now(dt.timezone.utc):%Y%m%d %H%M%S} UTC'[:60].ljust(60) + 'PGM / RUN BY / DATE'
+    if label == 'END OF HEADER':
+      header.append(f'MERGED FROM {len(nav_files)} FILES'.ljust(60) + 'COMMENT')
+    header.append(line)
+
+  seen = set()
+  svs, tocs, vals = [], [], []
+  tmp = output + '.part'
+  try:
+    with open(tmp, 'w') as out:
+      out.write('\n'.join(header) + '\n')
+      for fn, (header_lines, version, system) in zip(nav_files, headers):
+        with open_text(fn) as fh:
+          read_nav_header(fh)
+          for sv, toc, values, lines in iter_nav_records(fh, version, system, len(header_lines)):
+            key = record_key(sv, toc, values)
+            if key in seen:
+              continue
+            seen.add(key)
+            out.write('\n'.join(lines) + '\n')
+            if collect:
+              svs.append(sv)
+              tocs.append(toc)
+              vals.append(values + [np.nan]*(MAX_VALUES - len(values)))
+  except BaseException:
+    # No partial output left behind
+    os.remove(tmp)
+    raise
+  os.replace(tmp, output)
+
+  if not collect:
+    return None
+  return Nav_table(np.array(svs, dtype='U3'),
+                   np.array(tocs, dtype='datetime64[ms]'),
+                   np.array(vals, dtype=float).reshape(-1, MAX_VALUES))
+
+
+def test():
+  import tempfile
+  import shutil
+
+  def d19(x):
+    s = f'{x:19.12E}'.replace('E', 'D')
+    return s
+
+  def v2_record(prn, t, iode):
+    vals = [1e-5*prn, 1e-12, 0.0, iode] + [0.1*i + prn for i in range(1, 28)]
+    line = f'{prn:2d} {t:%y %m %d %H %M} {t.second + t.microsecond*1e-6:4.1f}' + ''.join(d19(v) for v in vals[0:3])
+    lines = [line]
+    for i in range(7):
+      lines.append('   ' + ''.join(d19(v) for v in vals[3 + 4*i:7 + 4*i]))
+    return lines
+
+  def v2_file(fn, records):
+    hdr = ['     2.11           N: GPS NAV DATA                         RINEX VERSION / TYPE',
+           'teqc                UNAVCO              20211203 10:22:00UTCPGM / RUN BY / DATE',
+           '                                                            END OF HEADER']
+    with open(fn, 'w') as fh:
+      fh.write('\n'.join(hdr) + '\n')
+      for prn, t, iode in records:
+        fh.write('\n'.join(v2_record(prn, t, iode)) + '\n')
+
+  tmp = tempfile.mkdtemp()
+  try:
+    t0 = dt.datetime(2021, 12, 3, 8, 0, 0)
+    h = dt.timedelta(hours=2)
+    files = []
+    for k in range(3):
+      # Consecutive segments overlap: each repeats the ephemerides of the
+      # previous one, one is re-broadcast with a new IODE
+      recs = [(prn, t0 + h*(k + j), 10*(k + j)) for j in range(2) for prn in (1, 5, 12)]
+      if k == 2:
+        recs.append((5, t0 + h*2, 99))
+        recs.append((12, t0 + h*2 + dt.timedelta(seconds=29.5), 98))
+      files.append(os.path.join(tmp, f'seg{k}.21n'))
+      v2_file(files[-1], recs)
+    with open(files[0], 'rb') as src, gzip.open(files[0] + '.gz', 'wb') as dst:
+      dst.write(src.read())
+    files[0] += '.gz'
+
+    out = os.path.join(tmp, 'merged.21n')
+    table = merge_nav(files, out)
+    assert len(table) == 4*3 + 2
+    assert table.toc[-1] == np.datetime64('2021-12-03T12:00:29.500')
+    assert list(table.sv[:3]) == ['G01', 'G05', 'G12'] and table.values[0, 3] == 0.0
+
+    # The merged file reads back to the same records
+    with open(out) as fh:
+      lines, version, system = read_nav_header(fh)
+      back = list(iter_nav_records(fh, version, system))
+    assert len(back) == len(table) and 'COMMENT' in lines[-2]
+    assert np.allclose(np.array([v for _, _, v, _ in back]), table.values)
+    assert np.all(np.array([t for _, t, _, _ in back], dtype='datetime64[ms]') == table.toc)
+
+    # A truncated last record names the file and the line of the record
+    with open(files[1]) as fh:
+      text = fh.readlines()
+    cut = os.path.join(tmp, 'cut.21n')
+    with open(cut, 'w') as fh:
+      fh.writelines(text[:-2])
+    try:
+      merge_nav([cut], out)
+      raise AssertionError('truncated record not detected')
+    except ValueError as ex:
+      assert str(ex) == f'{cut}: record of G12 at line {len(text) - 7} truncated (6 of 8 lines)', str(ex)
+    assert not os.path.exists(out + '.part')
+    print(f'{len(files)} files merged into {len(table)} ephemerides')
+  finally:
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  test()
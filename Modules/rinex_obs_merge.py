@@ -0,0 +1,453 @@
+###############################################################################
+# File:  rinex_obs_merge.py
+#
+# Description:
+# Merge of RINEX observation segments without teqc (merge_obs of
+# 1_Convert_To_Rinex.ipynb). Each file is read one epoch at a time and the
+# epochs of all files are merged by time (heapq.merge), so memory is one
+# epoch per input file whatever the segment length.
+#
+# Header reconciliation:
+#   observation types   union of the inputs (per system for RINEX 3), the
+#                       observations of each file are moved to their column
+#   INTERVAL            the decimation interval, or the largest input one
+#   TIME OF FIRST/LAST  of the merged data
+# The other header lines come from the first file; # OF SATELLITES and
+# PRN / # OF OBS are dropped. All inputs must have the same major version.
+#
+# An epoch at the time of the last written one (within `tolerance`) is a
+# duplicate and is dropped. With `interval` > 0 only the epochs on that grid
+# (GPS time) are kept. Event and cycle slip records (flags 2 to 6) are not
+# copied. Compact RINEX inputs (.crx, .crx.gz) are decoded by crx_stream.
+#                                                                             #
+###############################################################################
+
+# %%
+import datetime as dt
+import heapq
+import gzip
+import math
+import os
+from collections import namedtuple
+from Modules.d_print import Debug, Info
+
+
+GPS_EPOCH = dt.datetime(1980, 1, 6)
+
+FIELD = 16          # Observation field width (F14.3, LLI, SSI)
+
+# time (sec since GPS_EPOCH), date (y, m, d, h, min, sec), epoch flag,
+# receiver clock offset (str), obs {sv: [16 char fields in file type order]}
+Obs_epoch = namedtuple('Obs_epoch', ['time', 'date', 'flag', 'clock', 'obs'])
+
+
+class Obs_header:
+  def __init__(self, lines, version, obs_types, interval, time_system):
+    self.lines = lines              # Header lines including END OF HEADER
+    self.version = version
+    self.obs_types = obs_types      # {system: [types]}, system '' for RINEX 2
+    self.interval = interval        # 0.0 if not given
+    self.time_system = time_system
+
+  def types_of(self, sv: str) -> list:
+    return self.obs_types.get('' if self.version < 3.0 else sv[0], [])
+
+
+def open_text(fn: str):
+  if fn.endswith('.crx') or fn.endswith('.crx.gz'):
+    from Modules.crx_stream import Crx_file
+    return Crx_file(fn)
+  if fn.endswith('.gz'):
+    return gzip.open(fn, 'rt')
+  return open(fn, 'r')
+
+
+def _time(date) -> float:
+  y, m, d, h, mi, sec = date
+  return (dt.datetime(y, m, d, h, mi) - GPS_EPOCH).total_seconds() + sec
+
+
+def read_obs_header(fh) -> Obs_header:
+
+  # Read an observation file header
+  #
+  # INPUTS:
+  #   fh          Open text file, at the start
+  #
+  # OUTPUTS
+  #   Obs_header
+
+  lines = []
+  version = 0.0
+  obs_types = {}
+  interval = 0.0
+  time_system = 'GPS'
+  system = ''
+  for line in fh:
+    line = line.rstrip('\n')
+    lines.append(line)
+    label = line[60:80].strip()
+    if label == 'RINEX VERSION / TYPE':
+      version = float(line[0:9])
+    elif label == '# / TYPES OF OBSERV':
+      obs_types.setdefault('', []).extend(line[6:60].split())
+    elif label == 'SYS / # / OBS TYPES':
+      if line[0] != ' ':
+        system = line[0]
+      obs_types.setdefault(system, []).extend(line[7:60].split())
+    elif label == 'INTERVAL':
+      interval = float(line[0:10])
+    elif label == 'TIME OF FIRST OBS' and line[48:51].strip() != '':
+      time_system = line[48:51].strip()
+    elif label == 'END OF HEADER':
+      break
+  if version == 0.0:
+    raise ValueError('Not a RINEX observation file (no RINEX VERSION / TYPE line)')
+  return Obs_header(lines, version, obs_types, interval, time_system)
+
+
+def iter_obs_epochs(fh, header: Obs_header):
+
+  # Observation epochs of a file after the header
+  #
+  # INPUTS:
+  #   fh          Open text file, after read_obs_header
+  #   header      Its header
+  #
+  # OUTPUTS
+  #   Generator of Obs_epoch (flags 0 and 1)
+
+  v3 = header.version >= 3.0
+  for line in fh:
+    line = line.rstrip('\n')
+    if line.strip() == '':
+      continue
+    if v3 and line[0] != '>':
+      continue
+
+    # Epoch time as written, until parsed (events can have none)
+    date = line[2:29].strip() if v3 else line[1:26].strip()
+    try:
+      # Flag and record count first: event records (flags 2 to 5) can have
+      # blank time fields
+      flag_field, n_field = (line[31:32], line[32:35]) if v3 else (line[28:29], line[29:32])
+      flag = int(flag_field) if flag_field.strip() != '' else 0
+      n = int(n_field) if n_field.strip() != '' else 0
+      if flag > 1:
+        # Events: n header lines; cycle slips: n satellite records
+        skip = n
+        if flag == 6 and not v3:
+          skip = math.ceil(n/12) - 1 + n*math.ceil(len(header.types_of('G'))/5)
+        for _ in range(skip):
+          next(fh)
+        Debug(f'epoch flag {flag} not copied ({n} records)')
+        continue
+
+      if v3:
+        date = (int(line[2:6]), int(line[7:9]), int(line[10:12]), int(line[13:15]),
+                int(line[16:18]), float(line[18:29]))
+        clock = line[41:56].strip()
+        obs = {}
+        for _ in range(n):
+          rec = next(fh).rstrip('\n')
+          sv = rec[0:3].replace(' ', '0')
+          n_obs = len(header.types_of(sv))
+          rec = rec.ljust(3 + FIELD*n_obs)
+          obs[sv] = [rec[3 + FIELD*i:3 + FIELD*(i + 1)] for i in range(n_obs)]
+      else:
+        yy = int(line[1:3])
+        date = (yy + (2000 if yy < 80 else 1900), int(line[4:6]), int(line[7:9]), int(line[10:12]),
+                int(line[13:15]), float(line[15:26]))
+        clock = line[68:80].strip()
+        sats = line[32:68]
+        for _ in range(math.ceil(n/12) - 1):
+          sats += next(fh).rstrip('\n')[32:68]
+        svs = [sats[3*i:3*i + 3] for i in range(n)]
+        svs = [('G' if s[0] == ' ' else s[0]) + s[1:3].replace(' ', '0') for s in svs]
+        n_obs = len(header.types_of(''))
+        obs = {}
+        for sv in svs:
+          rec = ''.join([next(fh).rstrip('\n').ljust(80)[:80] for _ in range(math.ceil(n_obs/5))])
+          obs[sv] = [rec[FIELD*i:FIELD*(i + 1)] for i in range(n_obs)]
+    except StopIteration:
+      # next(fh) at the end of the file inside an epoch
+      raise ValueError(f'truncated epoch at {date}') from None
+
+    yield Obs_epoch(_time(date), date, flag, clock, obs)
+
+
+def format_epoch(epoch: Obs_epoch, version: float, obs_types: dict) -> str:
+
+  # RINEX text of an epoch; epoch.obs fields must be in obs_types order
+
+  y, m, d, h, mi, sec = epoch.date
+  svs = list(epoch.obs)
+  n = len(svs)
+  if version >= 3.0:
+    head = f'> {y:4d} {m:02d} {d:02d} {h:02d} {mi:02d}{sec:11.7f}  {epoch.flag:1d}{n:3d}'
+    if epoch.clock != '':
+      head += f'      {float(epoch.clock):15.12f}'
+    lines = [head]
+    for sv in svs:
+      lines.append((sv + ''.join(epoch.obs[sv])).rstrip())
+  else:
+    sats = ''.join(svs)
+    head = f' {y % 100:02d} {m:2d} {d:2d} {h:2d} {mi:2d}{sec:11.7f}  {epoch.flag:1d}{n:3d}{sats[0:36]}'
+    if epoch.clock != '':
+      head = head.ljust(68) + f'{float(epoch.clock):12.9f}'
+    lines = [head]
+    for i in range(36, len(sats), 36):
+      lines.append(' '*32 + sats[i:i + 36])
+    n_obs = len(obs_types[''])
+    for sv in svs:
+      fields = epoch.obs[sv]
+      for i in range(0, n_obs, 5):
+        lines.append(''.join(fields[i:i + 5]).rstrip())
+  return '\n'.join(lines) + '\n'
+
+
+def format_types(version: float, obs_types: dict) -> list:
+
+  # Observation type header lines
+
+  lines = []
+  if version >= 3.0:
+    for system, types in obs_types.items():
+      for i in range(0, max(len(types), 1), 13):
+        start = f'{system}  {len(types):3d}' if i == 0 else ' '*6
+        lines.append((start + ''.join(f' {t:3}' for t in types[i:i + 13])).ljust(60) + 'SYS / # / OBS TYPES')
+  else:
+    types = obs_types['']
+    for i in range(0, max(len(types), 1), 9):
+      start = f'{len(types):6d}' if i == 0 else ' '*6
+      lines.append((start + ''.join(f'{t:>6}' for t in types[i:i + 9])).ljust(60) + '# / TYPES OF OBSERV')
+  return lines
+
+
+def _time_line(date, time_system: str, label: str) -> str:
+  # Padded to 80 characters: written over an 80 character placeholder
+  y, m, d, h, mi, sec = date
+  return (f'{y:6d}{m:6d}{d:6d}{h:6d}{mi:6d}{sec:13.7f}     {time_system:3}'.ljust(60) + label).ljust(80)
+
+
+def merge_obs(obs_files: list, output: str, interval: float = 0.0,
+              tolerance: float = 1e-3, program: str = 'rinex_obs_merge') -> dict:
+
+  # Merge observation files by epoch
+  #
+  # INPUTS:
+  #   obs_files   Input files (.gz allowed), any order
+  #   output      Merged file
+  #   interval    Decimation interval (sec), 0 to keep all epochs
+  #   tolerance   Time tolerance of duplicates and decimation (sec)
+  #   program     Name written in the PGM / RUN BY / DATE line
+  #
+  # OUTPUTS
+  #   report      {'epochs', 'duplicates', 'decimated', 'gaps'}, gaps are
+  #               steps longer than 1.5 output intervals
+
+  headers = []
+  for fn in obs_files:
+    with open_text(fn) as fh:
+      headers.append(read_obs_header(fh))
+  versions = {int(h.version) for h in headers}
+  if len(versions) != 1:
+    raise ValueError(f'Cannot merge RINEX observation versions {sorted(versions)}')
+
+  # Union of the observation types, and the column of every input type
+  merged_types = {}
+  for h in headers:
+    for system, types in h.obs_types.items():
+      dst = merged_types.setdefault(system, [])
+      dst.extend(t for t in types if t not in dst)
+  columns = [{s: [merged_types[s].index(t) for t in types] for s, types in h.obs_types.items()}
+             for h in headers]
+
+  out_interval = interval if interval > 0 else max(h.interval for h in headers)
+  version = headers[0].version
+  header = []
+  for line in headers[0].lines:
+    label = line[60:80].strip()
+    if label in ('# / TYPES OF OBSERV', 'SYS / # / OBS TYPES', 'INTERVAL', 'TIME OF FIRST OBS',
+                 'TIME OF LAST OBS', '# OF SATELLITES', 'PRN / # OF OBS', 'END OF HEADER'):
+      continue
+    if label == 'PGM / RUN BY / DATE':
+      line = f'{program:<20}{"":<20}{dt.datetime.now(dt.timezone.utc):%Y%m%d %H%M%S} UTC'[:60].ljust(60) + label
+    header.append(line)
+  header += format_types(version, merged_types)
+  if out_interval > 0:
+    header.append(f'{out_interval:10.3f}'.ljust(60) + 'INTERVAL')
+  header.append(f'MERGED FROM {len(obs_files)} FILES'.ljust(60) + 'COMMENT')
+
+  def epochs(k):
+    with open_text(obs_files[k]) as fh:
+      read_obs_header(fh)
+      for ep in iter_obs_epochs(fh, headers[k]):
+        yield k, ep
+
+  report = {'epochs': 0, 'duplicates': 0, 'decimated': 0, 'gaps': 0}
+  first = None
+  last = None
+  tmp = output + '.part'
+  try:
+    with open(tmp, 'w', newline='\n') as out:
+      out.write('\n'.join(header) + '\n')
+      # TIME OF FIRST/LAST OBS are fixed width: written when known
+      times_at = out.tell()
+      out.write((' '*80 + '\n')*2 + 'END OF HEADER'.rjust(73) + '\n')
+
+      streams = [epochs(k) for k in range(len(obs_files))]
+      for k, ep in heapq.merge(*streams, key=lambda x: x[1].time):
+        if last is not None and ep.time - last.time < tolerance:
+          report['duplicates'] += 1
+          continue
+        if interval > 0:
+          r = ep.time/interval
+          if abs(r - round(r))*interval > tolerance:
+            report['decimated'] += 1
+            continue
+        if last is not None and out_interval > 0 and ep.time - last.time > 1.5*out_interval:
+          report['gaps'] += 1
+
+        obs = {}
+        for sv, fields in ep.obs.items():
+          system = '' if version < 3.0 else sv[0]
+          row = [' '*FIELD]*len(merged_types[system])
+          for col, f in zip(columns[k][system], fields):
+            row[col] = f
+          obs[sv] = row
+        out.write(format_epoch(ep._replace(obs=obs), version, merged_types))
+        report['epochs'] += 1
+        first = ep if first is None else first
+        last = ep
+
+      if first is not None:
+        end = out.tell()
+        out.seek(times_at)
+        out.write(_time_line(first.date, headers[0].time_system, 'TIME OF FIRST OBS') + '\n' +
+                  _time_line(last.date, headers[0].time_system, 'TIME OF LAST OBS') + '\n')
+        out.seek(end)
+      else:
+        # No epochs: the header without the placeholders
+        out.seek(times_at)
+        out.truncate()
+        out.write('END OF HEADER'.rjust(73) + '\n')
+  except BaseException:
+    # No partial output left behind
+    os.remove(tmp)
+    raise
+  os.replace(tmp, output)
+  Info(f'{output}: {report["epochs"]} epochs, {report["duplicates"]} duplicates, '
+       f'{report["decimated"]} decimated, {report["gaps"]} gaps')
+  return report
+
+
+def test():
+  import tempfile
+  import shutil
+  import time
+
+  def fixture(fn, version, types, t0, n, rate, svs):
+    # Synthetic segment written with format_epoch; value = sat + type + time
+    systems = {'' if version < 3.0 else sv[0] for sv in svs}
+    obs_types = {s: types for s in systems}
+    hdr = [f'{version:9.2f}           OBSERVATION DATA    M (MIXED)'.ljust(60) + 'RINEX VERSION / TYPE',
+           'teqc                UNAVCO              20211203 10:22:00UTCPGM / RUN BY / DATE',
+           'ROVER'.ljust(60) + 'MARKER NAME']
+    hdr += format_types(version, obs_types)
+    hdr += [f'{1.0/rate:10.3f}'.ljust(60) + 'INTERVAL', ' '*60 + 'END OF HEADER']
+    with open(fn, 'w') as fh:
+      fh.write('\n'.join(hdr) + '\n')
+      for i in range(n):
+        t = t0 + dt.timedelta(seconds=i/rate)
+        date = (t.year, t.month, t.day, t.hour, t.minute, t.second + t.microsecond*1e-6)
+        obs = {sv: [f'{value(sv, ty, _time(date)):14.3f}  ' for ty in types] for sv in svs}
+        fh.write(format_epoch(Obs_epoch(_time(date), date, 0, '', obs), version, obs_types))
+        if i == 5:
+          fh.write(event(version))
+
+  def event(version):
+    # Flag 4 comment block with blank time fields (as written by teqc)
+    flag_at = 31 if version >= 3.0 else 28
+    return (('>' if version >= 3.0 else ' ').ljust(flag_at) + '4  2\n' +
+            'EVENT: NEW SITE OCCUPATION'.ljust(60) + 'COMMENT\n' +
+            'EVENT: ANTENNA HEIGHT CHANGED'.ljust(60) + 'COMMENT\n')
+
+  def check_header(fn):
+    # Every header line has a label, END OF HEADER is the last one
+    with open(fn) as fh:
+      h = read_obs_header(fh)
+    assert all(l[60:80].strip() != '' for l in h.lines), h.lines
+    assert h.lines[-1][60:80].strip() == 'END OF HEADER'
+    return h
+
+  def value(sv, ty, t):
+    return int(sv[1:])*1e6 + (hash(ty) % 1000)*1e3 + (t % 1000)
+
+  tmp = tempfile.mkdtemp()
+  try:
+    t0 = dt.datetime(2021, 12, 3, 8, 0, 0)
+    svs = [f'G{p:02}' for p in range(1, 15)] + ['R07']
+    for version in (2.11, 3.04):
+      types = ['C1', 'L1', 'P2', 'L2', 'S1'] if version < 3.0 else ['C1C', 'L1C', 'C2W', 'L2W']
+      extra = ['D1', 'S2'] if version < 3.0 else ['D1C', 'S2W']
+      files = []
+      # 10 Hz segments of 60 s overlapping by 1 s, the second has more types
+      for k in range(3):
+        files.append(os.path.join(tmp, f'seg{k}_{int(version)}.obs'))
+        fixture(files[-1], version, types + (extra if k == 1 else []),
+                t0 + dt.timedelta(seconds=59*k), 600, 10.0, svs)
+      files.reverse()
+
+      out = os.path.join(tmp, f'merged_{int(version)}.obs')
+      now = time.perf_counter()
+      report = merge_obs(files, out)
+      t_merge = time.perf_counter() - now
+      assert report == {'epochs': 3*600 - 2*10, 'duplicates': 20, 'decimated': 0, 'gaps': 0}
+
+      check_header(out)
+      with open(out) as fh:
+        h = read_obs_header(fh)
+        eps = list(iter_obs_epochs(fh, h))
+      all_types = h.types_of(svs[0])
+      assert all_types == types + extra and len(eps) == report['epochs']
+      assert [ep.time for ep in eps] == sorted(ep.time for ep in eps)
+      assert any('TIME OF LAST OBS' in l and '     8     2   57.9000000' in l for l in h.lines)
+      for ep in eps[::97]:
+        for sv in (svs[0], svs[13]):
+          for ty, f in zip(all_types, ep.obs[sv]):
+            if f.strip() != '':
+              assert abs(float(f[:14]) - value(sv, ty, ep.time)) < 1e-3
+
+      report = merge_obs(files, out, interval=1.0)
+      assert report['epochs'] == 178 and report['gaps'] == 0
+
+      # A file with an event record only: a valid header without times
+      empty = os.path.join(tmp, f'empty_{int(version)}.obs')
+      fixture(empty, version, types, t0, 0, 10.0, svs)
+      with open(empty, 'a') as fh:
+        fh.write(event(version))
+      assert merge_obs([empty], out)['epochs'] == 0
+      h = check_header(out)
+      assert not any('TIME OF' in l for l in h.lines)
+
+      # A segment cut inside an epoch: ValueError, no output nor .part
+      cut = os.path.join(tmp, f'cut_{int(version)}.obs')
+      with open(files[0]) as fh:
+        lines = fh.readlines()
+      with open(cut, 'w') as fh:
+        fh.writelines(lines[:-3])
+      os.remove(out)
+      try:
+        merge_obs([files[1], cut], out)
+        assert False, 'truncated epoch not reported'
+      except ValueError as e:
+        assert 'truncated epoch at (2021, 12, 3, 8, 2, 57.9' in str(e), e
+      assert not os.path.exists(out) and not os.path.exists(out + '.part')
+      print(f'RINEX {version}: 3 x 600 epochs of {len(svs)} sats merged in {t_merge:.2f} s')
+  finally:
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  test()
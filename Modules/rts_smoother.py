@@ -0,0 +1,261 @@
+###############################################################################
+# File:  rts_smoother.py
+#
+# Description:
+# Bounded-memory Rauch-Tung-Striebel backward pass for the closed-loop error
+# state EKF of lc_ins_gnss.run_LC_EKF.
+#
+# The forward pass only records, at each GNSS update, the corrected
+# covariance P+ and the fed-back error estimate delta_x (RTS_store). Between
+# two updates no information enters the filter, so the smoothed error at any
+# IMU epoch k of the interval (j, j'] is
+#
+#   lambda_j' = inv(P-_j') (e_j' + delta_x_j')
+#   lambda_k  = F_(k+1).T lambda_(k+1)
+#   e_k       = P_k lambda_k
+#
+# with F_k and P_k recomputed from the forward output (out_profile_data) and
+# the IMU input, one interval at a time. Peak memory is therefore one GNSS
+# interval plus the RTS_store, which keeps up to `max_memory_mb` in RAM and
+# spills full chunks to memory-mapped .npy files beyond that.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import tempfile
+import shutil
+import os
+from Modules.ins_nav import a, e, RTOD, DTOR, Euler_to_CTM, CTM_to_Euler, skew
+from Modules.ins_ekf import Block_cov_propagator
+from Modules.imu_preintegration import preintegrate
+
+
+# Values stored per GNSS update: P+ (15x15) and delta_x (15)
+REC_SIZE = 15*15 + 15
+
+
+class RTS_store:
+  def __init__(self, max_memory_mb: float = 256,
+               dtype = np.float64,
+               spill_dir: str = '',
+               chunk_rows: int = 1024):
+    self.dtype = np.dtype(dtype)
+    self.chunk_rows = chunk_rows
+    self.max_bytes = int(max_memory_mb*1024*1024)
+    self.spill_dir = spill_dir
+    self.own_dir = False
+
+    self.rows: list = []       # Output row of every record
+    self.chunks: list = []     # In-memory arrays or read-only memmaps
+    self.n_mem = 0             # Chunks currently held in RAM
+    self.count = 0
+    self.peak_bytes = 0
+
+  def __len__(self):
+    return self.count
+
+  def chunk_bytes(self) -> int:
+    return self.chunk_rows*REC_SIZE*self.dtype.itemsize
+
+  def add(self, row: int, P, delta_x) -> None:
+    """
+      Record the corrected covariance and error estimate of an update.
+    """
+    i = self.count % self.chunk_rows
+    if i == 0:
+      self.__spill_if_needed()
+      self.chunks.append(np.empty((self.chunk_rows, REC_SIZE), dtype=self.dtype))
+      self.n_mem += 1
+      self.peak_bytes = max(self.peak_bytes, self.n_mem*self.chunk_bytes())
+
+    rec = self.chunks[-1][i]
+    rec[:225] = np.ravel(P)
+    rec[225:] = np.ravel(delta_x)
+    self.rows.append(int(row))
+    self.count += 1
+
+  def get(self, n: int):
+    """
+      Return (row, P+, delta_x) of the n-th record.
+    """
+    rec = self.chunks[n//self.chunk_rows][n % self.chunk_rows]
+    P = np.array(rec[:225], dtype=float).reshape(15, 15)
+    delta_x = np.array(rec[225:], dtype=float)
+    return self.rows[n], P, delta_x
+
+  def close(self) -> None:
+    """
+      Drop stored data and remove spill files created by this store.
+    """
+    self.chunks = []
+    self.rows = []
+    self.count = 0
+    self.n_mem = 0
+    if self.own_dir and os.path.exists(self.spill_dir):
+      shutil.rmtree(self.spill_dir)
+
+  def __spill_if_needed(self) -> None:
+    # Write the last full in-memory chunk to disk once the next one would
+    # exceed the memory budget
+    if len(self.chunks) == 0 or (self.n_mem + 1)*self.chunk_bytes() <= self.max_bytes:
+      return
+
+    if self.spill_dir == '':
+      self.spill_dir = tempfile.mkdtemp(prefix='rts_store_')
+      self.own_dir = True
+    elif not os.path.exists(self.spill_dir):
+      os.makedirs(self.spill_dir)
+
+    n = len(self.chunks) - 1
+    fn = os.path.join(self.spill_dir, f'chunk_{n:05}.npy')
+    np.save(fn, self.chunks[n])
+    self.chunks[n] = np.load(fn, mmap_mode='r')
+    self.n_mem -= 1
+
+
+def rts_smooth(out_profile_data, in_profile_data, no_epochs, KF_param,
+               store: RTS_store, mech_decimation = 1):
+
+  # Backward RTS pass over a forward run
+  #
+  # INPUTS:
+  #   out_profile_data    Output of run_LC_EKF(..., smoother=store)
+  #   in_profile_data     Input array given to run_LC_EKF
+  #   no_epochs           Number of valid rows in in_profile_data
+  #   KF_param            Kalman Filter parameters used in the forward run
+  #   store               RTS_store filled by the forward run
+  #   mech_decimation     Same value as in the forward run
+  #
+  # OUTPUTS
+  #   smoothed            Copy of out_profile_data with smoothed horizontal
+  #                       position/velocity, attitude and IMU biases
+  #
+  # The vertical channel is left as in the forward filter, which resets
+  # altitude and down velocity from GNSS.
+
+  out = out_profile_data
+  n_out = len(out)
+
+  # Specific force used by the forward filter at every output row
+  if mech_decimation > 1:
+    rows, d_theta, d_v = preintegrate(in_profile_data[:no_epochs, 0],
+                                      in_profile_data[:no_epochs, 7:10],
+                                      in_profile_data[:no_epochs, 10:13],
+                                      mech_decimation)
+    tor = np.diff(in_profile_data[rows, 0])
+    f_rows = np.zeros((n_out, 3))
+    f_rows[1:] = d_v[1:]/tor[:, None]
+  else:
+    f_rows = np.array(in_profile_data[:n_out, 10:13], dtype=float)
+
+  prop = Block_cov_propagator(KF_param, np.zeros((15, 15)))
+  smoothed = np.array(out, dtype=float)
+
+  # Smoothed error (relative to the corrected nominal) at the later update
+  e_next = np.zeros(15)
+  for n in range(len(store) - 1, -1, -1):
+    if n + 1 == len(store):
+      continue              # nothing to smooth after the last update
+    j, P_j, _ = store.get(n)
+    j_end, _, dx_end = store.get(n + 1)
+
+    # Recompute transitions and covariances over (j, j_end]
+    m = j_end - j
+    Fs = np.empty((m, 15, 15))
+    Ps = np.empty((m + 1, 15, 15))
+    Ps[0] = P_j
+    for i in range(m):
+      k = j + i + 1
+      old = out[k - 1]
+      tor_i = out[k][0] - old[0]
+      C = Euler_to_CTM(old[1:4]*DTOR)
+      f_b = f_rows[k] + old[13:16]
+      F, Q = prop.transition(tor_i, old[7]*DTOR, old[9], old[4:7], C, f_b)
+      Fs[i] = F
+      Ps[i + 1] = F@Ps[i]@F.T + Q
+
+    # Backward over the interval, rows j_end-1 .. j
+    lam = np.linalg.solve(Ps[m], e_next + dx_end)
+    for i in range(m - 1, -1, -1):
+      lam = Fs[i].T@lam
+      err = Ps[i]@lam
+      _apply_errors(smoothed[j + i], err)
+    e_next = err
+
+  return smoothed
+
+
+def _apply_errors(row, err) -> None:
+  # Remove the smoothed error from one output row (same convention as
+  # correct_NED_errors: error = estimate - truth)
+  latR = row[7]*DTOR
+  alt = row[9]
+  RN = a*(1.0-e**2)/(1.0-e**2.0*(np.sin(latR))**2.0)**1.5
+  RE = a/np.sqrt(1.0-e**2.0*(np.sin(latR))**2.0)
+  row[7] = (latR - err[0]/(RN+alt))*RTOD
+  row[8] = (row[8]*DTOR - err[1]/((RE+alt)*np.cos(latR)))*RTOD
+  row[10] -= err[0]
+  row[11] -= err[1]
+  row[4] -= err[3]
+  row[5] -= err[4]
+
+  C = (np.identity(3) + skew(err[6:9]).astype(float))@Euler_to_CTM(row[1:4]*DTOR)
+  row[1:4] = CTM_to_Euler(C)*RTOD
+  row[3] = (row[3] + 360) % 360
+  row[13:16] -= err[9:12]
+  row[16:19] -= err[12:15]
+
+
+def test():
+  import time
+  from Modules.ins_ekf import data_packet
+  from Modules.lc_ins_gnss import run_LC_EKF
+
+  # 200 Hz straight and level flight with 0.5 m GNSS noise at 5 Hz
+  rng = np.random.default_rng(0)
+  n = 12000
+  ts = np.arange(n)/200.0
+  ip = np.zeros((n, 16))
+  ip[:, 0] = 467000 + ts
+  RN = a*(1.0-e**2)/(1.0-e**2.0*np.sin(0.9)**2.0)**1.5
+  RE = a/np.sqrt(1.0-e**2.0*np.sin(0.9)**2.0)
+  ip[:, 1] = 0.9 + 10.0*ts/(RN + 100.0)
+  ip[:, 2] = 0.3
+  ip[:, 3] = 100.0
+  ip[:, 4] = 10.0
+  ip[:, 12] = -9.8
+  truth_N = 10.0*ts
+  noise = np.repeat(rng.normal(0.0, 0.5, (n//40 + 1, 2)), 40, axis=0)[:n]
+  ip[:, 1] += noise[:, 0]/(RN + 100.0)
+  ip[:, 2] += noise[:, 1]/((RE + 100.0)*np.cos(0.9))
+  KF_param = data_packet((0.5, 0.05, np.zeros(3), 0.05, np.zeros(3), 0.002))
+
+  now = time.perf_counter()
+  store = RTS_store()
+  out = run_LC_EKF(ip, n, KF_param, cov_decimation=40, smoother=store)
+  t_fwd = time.perf_counter() - now
+
+  now = time.perf_counter()
+  smo = rts_smooth(out, ip, n, KF_param, store)
+  t_bwd = time.perf_counter() - now
+
+  rms = lambda o: np.sqrt(np.mean((o[:, 10] - truth_N)**2 + o[:, 11]**2))
+  print(f'horizontal RMS: forward {rms(out):.3f} m, smoothed {rms(smo):.3f} m')
+  print(f'backward pass {t_bwd/t_fwd:.2f}x the forward pass, store {store.peak_bytes/1024:.0f} kB for {len(store)} updates')
+  assert rms(smo) < rms(out)
+
+  # Same run with a float32 store spilled to disk after 2 chunks
+  small = RTS_store(max_memory_mb=2*16*REC_SIZE*4/1024/1024, dtype=np.float32, chunk_rows=16)
+  run_LC_EKF(ip, n, KF_param, cov_decimation=40, smoother=small)
+  smo32 = rts_smooth(out, ip, n, KF_param, small)
+  print(f'spilled float32 store: {small.peak_bytes} bytes in RAM, '
+        f'max difference {np.abs(smo32[:, 10:12] - smo[:, 10:12]).max():.1e} m')
+  assert small.n_mem <= 2
+  assert np.abs(smo32[:, 10:12] - smo[:, 10:12]).max() < 1e-3
+  small.close()
+  store.close()
+
+
+if __name__ == '__main__':
+  test()
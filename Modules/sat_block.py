@@ -0,0 +1,195 @@
+###############################################################################
+# File:  sat_block.py
+#
+# Description:
+# Dense satellite/epoch container exchanged by Orbital_data.get_sats_pos,
+# FOV_model.get_sats and the Calcs, in place of the nested
+# {iso_time_str: {prn: ndarray(3)}} dicts (one object, hash and string key
+# per cell, about 32 x epochs small arrays).
+#
+#   times     (T,)       datetime64[us] epochs
+#   prns      (S,)       satellite ids, prn_index maps them to columns
+#   pos       (T, S, 3)  ECEF positions (m), NaN where unavailable
+#   visible   (T, S)     satellites kept (all available ones by default,
+#                        the FOV model sets the satellites in view)
+#
+# epochs() and with_visible() return blocks sharing the position array
+# (numpy views), nothing is copied. A block is also a read-only Mapping in
+# the old shape: block[time] is {prn: position} of the visible satellites,
+# with time an ISO string ('2021-12-03 08:25:31'), a datetime or a
+# datetime64, and to_dict()/from_dict() convert whole blocks.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import datetime as dt
+from collections.abc import Mapping
+
+
+def to_datetime64(times) -> np.ndarray:
+  # ISO strings, datetimes or datetime64 to datetime64[us]
+  out = []
+  for t in times:
+    if isinstance(t, str):
+      t = dt.datetime.fromisoformat(t)
+    out.append(np.datetime64(t, 'us'))
+  return np.array(out, dtype='datetime64[us]')
+
+
+class Sat_block(Mapping):
+  def __init__(self, times, prns, pos, visible = None):
+    self.times = to_datetime64(times) if not isinstance(times, np.ndarray) or times.dtype.kind != 'M' \
+                 else times.astype('datetime64[us]')
+    self.prns = np.asarray(prns)
+    self.pos = pos
+    self.visible = visible if visible is not None else np.all(np.isfinite(pos), axis=-1)
+    self.prn_index = {p: j for j, p in enumerate(self.prns)}
+    self.__keys = None
+    self.__order = None
+    if self.pos.shape != (len(self.times), len(self.prns), 3) or self.visible.shape != self.pos.shape[:2]:
+      raise ValueError(f'Sat_block: positions {self.pos.shape} and visibility {self.visible.shape} '
+                       f'do not match {len(self.times)} epochs and {len(self.prns)} satellites')
+
+  @classmethod
+  def from_dict(cls, sats: dict) -> 'Sat_block':
+    """
+      Block from the old {time: {prn: (x,y,z)}} shape
+    """
+    keys = list(sats.keys())
+    prns = sorted({p for t in keys for p in sats[t]})
+    col = {p: j for j, p in enumerate(prns)}
+    pos = np.full((len(keys), len(prns), 3), np.nan)
+    for i, t in enumerate(keys):
+      for p, xyz in sats[t].items():
+        pos[i, col[p]] = xyz
+    return cls(keys, prns, pos)
+
+  def epochs(self, start: int = None, stop: int = None, step: int = None) -> 'Sat_block':
+    """
+      Block of a range of epochs, sharing the arrays
+    """
+    s = slice(start, stop, step)
+    return Sat_block(self.times[s], self.prns, self.pos[s], self.visible[s])
+
+  def with_visible(self, visible) -> 'Sat_block':
+    """
+      Same epochs and positions with another visibility mask
+    """
+    return Sat_block(self.times, self.prns, self.pos, np.asarray(visible, dtype=bool))
+
+  def take(self, index) -> 'Sat_block':
+    """
+      Block of the given epoch indices (a view when they are a plain range)
+    """
+    index = np.asarray(index, dtype=int)
+    if len(index) > 0 and np.array_equal(index, np.arange(index[0], index[0] + len(index))):
+      return self.epochs(int(index[0]), int(index[0]) + len(index))
+    return Sat_block(self.times[index], self.prns, self.pos[index], self.visible[index])
+
+  def index_of(self, times) -> np.ndarray:
+    """
+      Epoch index of each time (ISO string, datetime, datetime64), -1 if the
+      block has no such epoch
+    """
+    t = to_datetime64(times) if not isinstance(times, np.ndarray) or times.dtype.kind != 'M' \
+        else times.astype('datetime64[us]')
+    if self.__order is None:
+      self.__order = np.argsort(self.times, kind='stable')
+    sorted_times = self.times[self.__order]
+    k = np.clip(np.searchsorted(sorted_times, t), 0, max(len(sorted_times) - 1, 0))
+    if len(sorted_times) == 0:
+      return np.full(len(t), -1)
+    return np.where(sorted_times[k] == t, self.__order[k], -1)
+
+  def row(self, i: int) -> tuple:
+    """
+      Visible satellites of epoch i: prns (k,) and positions (k, 3)
+    """
+    v = self.visible[i]
+    return self.prns[v], self.pos[i, v]
+
+  def n_visible(self) -> np.ndarray:
+    return np.count_nonzero(self.visible, axis=1)
+
+  def time_keys(self) -> list:
+    """
+      Epochs as ISO strings of the old dict keys ('2021-12-03 08:25:31')
+    """
+    if self.__keys is None:
+      self.__keys = [t.isoformat(sep=' ') for t in self.times.astype(dt.datetime)]
+    return self.__keys
+
+  def to_dict(self) -> dict:
+    """
+      Old {time: {prn: position}} shape, positions are views of the block
+    """
+    return {k: self[i] for i, k in enumerate(self.time_keys())}
+
+  # Mapping of the old shape, keyed by time
+  def __getitem__(self, key) -> dict:
+    if isinstance(key, (int, np.integer)):
+      i = int(key)
+    else:
+      i = int(self.index_of([key])[0])
+      if i < 0:
+        raise KeyError(key)
+    return {p: self.pos[i, j] for j, p in enumerate(self.prns) if self.visible[i, j]}
+
+  def __iter__(self):
+    return iter(self.time_keys())
+
+  def __len__(self) -> int:
+    return len(self.times)
+
+  def __contains__(self, key) -> bool:
+    try:
+      return int(self.index_of([key])[0]) >= 0
+    except (ValueError, TypeError):
+      return False
+
+  def __repr__(self) -> str:
+    return f'Sat_block({len(self.times)} epochs, {len(self.prns)} satellites, {int(self.visible.sum())} visible cells)'
+
+
+def test():
+  import sys
+  import time
+
+  # One day at 1 s, 32 satellites
+  T, S = 86400, 32
+  times = np.datetime64('2021-12-03T00:00:00', 'us') + np.arange(T)*np.timedelta64(1, 's')
+  prns = [f'G{k + 1:02d}' for k in range(S)]
+  rng = np.random.default_rng(0)
+  pos = rng.normal(0, 2e7, (T, S, 3))
+  pos[:, 30:] = np.nan
+  block = Sat_block(times, prns, pos)
+  assert block.n_visible()[0] == 30 and block.pos is pos
+
+  # Views, no copies
+  part = block.epochs(3600, 7200)
+  assert np.shares_memory(part.pos, pos) and len(part) == 3600
+  fov = part.with_visible(part.visible & (np.arange(S) % 2 == 0))
+  assert np.shares_memory(fov.pos, pos) and fov.n_visible()[0] == 15
+  assert np.shares_memory(block.take(np.arange(10, 20)).pos, pos)
+
+  # Old dict shape
+  assert '2021-12-03 01:00:00' in fov and set(fov['2021-12-03 01:00:00']) == set(prns[0:30:2])
+  assert np.array_equal(fov[dt.datetime(2021, 12, 3, 1, 0, 5)]['G03'], pos[3605, 2])
+  assert list(block.index_of(['2021-12-03 00:00:10', '2021-12-04 00:00:00'])) == [10, -1]
+  small = block.epochs(0, 100)
+  back = Sat_block.from_dict(small.to_dict())
+  assert list(back.prns) == prns[:30] and np.array_equal(back.pos, small.pos[:, :30])
+
+  # Memory of the old shape for one hour
+  now = time.perf_counter()
+  d = part.to_dict()
+  t_dict = time.perf_counter() - now
+  size = sys.getsizeof(d) + sum(sys.getsizeof(k) + sys.getsizeof(v) + sum(sys.getsizeof(p) + a.nbytes for p, a in v.items())
+                                for k, v in d.items())
+  print(f'1 h x {S} satellites: {part.pos.nbytes/1e6:.1f} MB dense view (shared), '
+        f'{size/1e6:.1f} MB as dicts built in {t_dict:.2f} s')
+
+
+if __name__ == '__main__':
+  test()
@@ -0,0 +1,186 @@
+###############################################################################
+# File:  time_alignment.py
+#
+# Description:
+# Alignment of GNSS fixes to the IMU time line without building the padded
+# in_profile_data array. Both streams stay at their own rate; an as-of join
+# (np.searchsorted) gives, for every fix, the IMU sample at which the EKF
+# applies it, and the measurement is brought to that sample time.
+#
+#   method 'asof'     first IMU sample at/after the fix, measurement as is
+#   method 'nearest'  closest IMU sample, measurement as is
+#   method 'linear'   first IMU sample at/after the fix, position/velocity
+#                     interpolated between the fix and the next one
+#
+# `latency` is the GNSS output delay (sec): a fix stamped t describes the
+# state at t - latency.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+
+
+ALIGN_METHODS = ('asof', 'nearest', 'linear')
+
+
+class Alignment:
+  def __init__(self, imu_rows, fix_rows, lla, vel):
+    self.imu_rows = imu_rows   # IMU sample of each update, increasing
+    self.fix_rows = fix_rows   # GNSS row used for each update
+    self.lla = lla             # Measurement at the IMU sample time (rad, rad, m)
+    self.vel = vel             # NED velocity at the IMU sample time (m/s)
+
+  def __len__(self):
+    return len(self.imu_rows)
+
+  def fix_of_imu(self, n_imu: int) -> np.ndarray:
+    """
+      Index (into the updates) of the last update at or before every IMU
+      sample, -1 before the first one.
+    """
+    return np.searchsorted(self.imu_rows, np.arange(n_imu), side='right') - 1
+
+  def decimate(self, interval: float, imu_time) -> 'Alignment':
+    """
+      Keep one update per `interval` seconds of IMU time (same rule as the
+      GNSS_epoch_interval of run_LC_EKF).
+    """
+    t = np.asarray(imu_time)[self.imu_rows]
+    keep = np.zeros(len(t), dtype=bool)
+    last = -np.inf
+    for i in range(len(t)):
+      if t[i] - last >= interval:
+        keep[i] = True
+        last = t[i]
+    return Alignment(self.imu_rows[keep], self.fix_rows[keep], self.lla[keep], self.vel[keep])
+
+
+def align_streams(imu_time, gnss_time, gnss_lla, gnss_vel,
+                  method: str = 'asof',
+                  latency: float = 0.0) -> Alignment:
+
+  # As-of join of the GNSS fixes onto the IMU time line
+  #
+  # INPUTS:
+  #   imu_time    IMU sample times (sec), increasing
+  #   gnss_time   GNSS fix times (sec), increasing
+  #   gnss_lla    GNSS lat/lon (rad) and altitude (m), shape (m, 3)
+  #   gnss_vel    GNSS NED velocity (m/s), shape (m, 3)
+  #   method      One of ALIGN_METHODS
+  #   latency     GNSS output latency (sec)
+  #
+  # OUTPUTS
+  #   Alignment   Fixes outside the IMU span are dropped; when several fixes
+  #               fall on one IMU sample the last one is kept
+
+  if method not in ALIGN_METHODS:
+    raise ValueError(f'Unknown alignment method "{method}", use one of {ALIGN_METHODS}')
+
+  imu_time = np.asarray(imu_time, dtype=float)
+  t_fix = np.asarray(gnss_time, dtype=float) - latency
+  gnss_lla = np.asarray(gnss_lla, dtype=float)
+  gnss_vel = np.asarray(gnss_vel, dtype=float)
+
+  if len(imu_time) == 0:
+    return Alignment(np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros((0, 3)), np.zeros((0, 3)))
+
+  # IMU sample of every fix
+  rows = np.searchsorted(imu_time, t_fix, side='left')
+  if method == 'nearest':
+    prev = np.clip(rows - 1, 0, len(imu_time) - 1)
+    nxt = np.clip(rows, 0, len(imu_time) - 1)
+    rows = np.where(np.abs(imu_time[prev] - t_fix) <= np.abs(imu_time[nxt] - t_fix), prev, nxt)
+    # Half a sample interval around the ends (none for a single sample)
+    half_first = 0.5*(imu_time[1] - imu_time[0]) if len(imu_time) > 1 else 0.0
+    half_last = 0.5*(imu_time[-1] - imu_time[-2]) if len(imu_time) > 1 else 0.0
+    valid = (t_fix >= imu_time[0] - half_first) & (t_fix <= imu_time[-1] + half_last)
+  else:
+    valid = (t_fix >= imu_time[0]) & (rows < len(imu_time))
+
+  fix_rows = np.flatnonzero(valid)
+  rows = rows[valid]
+
+  # Last fix per IMU sample
+  last = np.ones(len(rows), dtype=bool)
+  last[:-1] = rows[1:] != rows[:-1]
+  fix_rows = fix_rows[last]
+  rows = rows[last]
+
+  lla = gnss_lla[fix_rows]
+  vel = gnss_vel[fix_rows]
+  if method == 'linear' and len(fix_rows) > 0:
+    # Interpolate towards the next fix (held at the last one)
+    nxt = np.minimum(fix_rows + 1, len(t_fix) - 1)
+    dt = t_fix[nxt] - t_fix[fix_rows]
+    w = np.divide(imu_time[rows] - t_fix[fix_rows], dt, out=np.zeros(len(dt)), where=dt > 0)[:, None]
+    lla = lla + w*(gnss_lla[nxt] - lla)
+    vel = vel + w*(gnss_vel[nxt] - vel)
+
+  return Alignment(rows, fix_rows, lla, vel)
+
+
+def test():
+  from Modules.ins_ekf import data_packet
+  from Modules.lc_ins_gnss import run_LC_EKF, run_LC_EKF_aligned
+
+  imu_time = 1000.0 + np.arange(20000)/200.0
+  gnss_time = 999.5 + np.arange(0, 110, 0.2) + 0.0013
+  gnss_lla = np.stack([0.9 + 1e-7*gnss_time, 0.3 + 0*gnss_time, 100.0 + gnss_time], axis=1)
+  gnss_vel = np.stack([gnss_time, 0*gnss_time, 0*gnss_time], axis=1)
+
+  al = align_streams(imu_time, gnss_time, gnss_lla, gnss_vel)
+  assert np.all(imu_time[al.imu_rows] >= gnss_time[al.fix_rows])
+  assert np.all(imu_time[al.imu_rows] - gnss_time[al.fix_rows] < 1/200.0)
+  assert gnss_time[al.fix_rows[0]] >= imu_time[0] and al.imu_rows[-1] < len(imu_time)
+
+  lin = align_streams(imu_time, gnss_time, gnss_lla, gnss_vel, method='linear', latency=0.05)
+  assert np.allclose(lin.lla[:, 2] - 100.0, imu_time[lin.imu_rows] + 0.05)
+
+  near = align_streams(imu_time, gnss_time, gnss_lla, gnss_vel, method='nearest')
+  assert np.all(np.abs(imu_time[near.imu_rows] - gnss_time[near.fix_rows]) <= 0.5/200.0 + 1e-9)
+
+  # Short IMU streams: one sample takes the fixes at its time only
+  t3 = np.array([999.9, 1000.0, 1000.1])
+  for method in ALIGN_METHODS:
+    one = align_streams(imu_time[:1], t3, gnss_lla[:3], gnss_vel[:3], method=method)
+    assert list(one.imu_rows) == [0] and list(one.fix_rows) == [1]
+    assert len(align_streams(imu_time[:0], t3, gnss_lla[:3], gnss_vel[:3], method=method)) == 0
+
+  idx = al.fix_of_imu(len(imu_time))
+  assert idx[al.imu_rows[0] - 1] == -1 and np.all(idx[al.imu_rows] == np.arange(len(al)))
+  print(f'{len(al)} of {len(gnss_time)} fixes aligned to {len(imu_time)} IMU samples, '
+        f'{len(al.decimate(1.0, imu_time))} at 1 Hz')
+
+  # Same filter as the padded profile when the fixes fall on its update rows
+  n = 3000
+  ip = np.zeros((n, 16))
+  ip[:, 0] = imu_time[:n]
+  ip[:, 1] = 0.9 + 10.0*(imu_time[:n] - 1000.0)/6.4e6
+  ip[:, 2] = 0.3
+  ip[:, 3] = 100.0
+  ip[:, 4] = 10.0
+  ip[:, 7] = 0.002
+  ip[:, 12] = -9.8
+  KF_param = data_packet((0.5, 0.05, np.zeros(3), 0.05, np.zeros(3), 0.002))
+  ref = run_LC_EKF(ip, n, KF_param, cov_decimation=40)
+  fixes = [0]
+  for k in range(1, n):
+    if ip[k, 0] - ip[fixes[-1], 0] >= 0.2:
+      fixes.append(k)
+  al = align_streams(ip[:, 0], ip[fixes, 0], ip[fixes, 1:4], ip[fixes, 4:7])
+  out = run_LC_EKF_aligned(ip[:, 0], ip[:, 7:10], ip[:, 10:13], ip[0, 13:16], al, KF_param, cov_decimation=40)
+  assert np.abs(out - ref).max() < 1e-9
+  print(f'run_LC_EKF_aligned on {len(al)} fixes matches run_LC_EKF')
+
+  # No fix in the IMU time range: an error naming it
+  late = align_streams(ip[:, 0], ip[-1, 0] + 10.0 + np.arange(3), ip[:3, 1:4], ip[:3, 4:7])
+  try:
+    run_LC_EKF_aligned(ip[:, 0], ip[:, 7:10], ip[:, 10:13], ip[0, 13:16], late, KF_param)
+    assert False, 'empty alignment accepted'
+  except ValueError as e:
+    assert f'{ip[0, 0]:.3f} to {ip[-1, 0]:.3f} s' in str(e), e
+
+
+if __name__ == '__main__':
+  test()
@@ -0,0 +1,280 @@
+###############################################################################
+# File:  traj_simplify.py
+#
+# Description:
+# Trajectory simplification for the maps of 4_Visualization.ipynb, which
+# draw every fused/PPK point in one folium.PolyLine.
+#
+#   douglas_peucker  points kept so that the track stays within `tolerance`
+#                    metres of the original; all segments of one recursion
+#                    depth are processed together with numpy
+#   lttb             Largest Triangle Three Buckets decimation to n points
+#   lod_levels       one Douglas-Peucker level per map zoom band, the
+#                    tolerance being a fraction of the pixel size
+#   add_lod_polyline folium layers shown by zoom: coarse track at low zoom,
+#                    full detail only when zoomed in
+#
+# Positions are lat/lon in degrees, projected to a local north/east plane
+# (metres) around the mean position.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+import json
+from collections import namedtuple
+from Modules.ins_nav import a, e, DTOR
+from Modules.d_print import Info
+
+
+# Web Mercator ground resolution at zoom 0 on the equator (m/pixel)
+MERCATOR_RES0 = 156543.03392
+
+# Zoom band [min_zoom, max_zoom], tolerance (m), indices of the kept points
+Lod_level = namedtuple('Lod_level', ['min_zoom', 'max_zoom', 'tolerance', 'index'])
+
+
+def local_xy(lat, lon) -> np.ndarray:
+
+  # North/east coordinates (m) around the mean position, shape (n, 2)
+
+  lat = np.asarray(lat, dtype=float)*DTOR
+  lon = np.asarray(lon, dtype=float)*DTOR
+  lat0 = np.mean(lat)
+  sin_lat = np.sin(lat0)
+  RN = a*(1.0-e**2)/(1.0-e**2*sin_lat**2)**1.5
+  RE = a/np.sqrt(1.0-e**2*sin_lat**2)
+  return np.stack([(lat - lat0)*RN, (lon - np.mean(lon))*RE*np.cos(lat0)], axis=1)
+
+
+def douglas_peucker(xy, tolerance: float) -> np.ndarray:
+
+  # Douglas-Peucker simplification
+  #
+  # INPUTS:
+  #   xy          Points (m), shape (n, 2)
+  #   tolerance   Maximum distance (m) of a removed point to the simplified track
+  #
+  # OUTPUTS
+  #   index       Increasing indices of the kept points (first and last included)
+
+  xy = np.asarray(xy, dtype=float)
+  n = len(xy)
+  keep = np.zeros(n, dtype=bool)
+  keep[[0, n - 1]] = True
+  starts = np.array([0])
+  ends = np.array([n - 1])
+  while len(starts) > 0:
+    lengths = ends - starts - 1
+    active = lengths > 0
+    starts, ends, lengths = starts[active], ends[active], lengths[active]
+    if len(starts) == 0:
+      break
+
+    # Interior points of all segments at once
+    seg = np.repeat(np.arange(len(starts)), lengths)
+    first = np.cumsum(lengths) - lengths
+    idx = starts[seg] + 1 + np.arange(len(seg)) - first[seg]
+    A = xy[starts[seg]]
+    AB = xy[ends[seg]] - A
+    AP = xy[idx] - A
+    ab2 = np.sum(AB*AB, axis=1)
+    u = np.clip(np.divide(np.sum(AP*AB, axis=1), ab2, out=np.zeros(len(seg)), where=ab2 > 0), 0.0, 1.0)
+    d = np.linalg.norm(AP - u[:, None]*AB, axis=1)
+
+    # Farthest point of every segment
+    d_max = np.maximum.reduceat(d, first)
+    at_max = np.flatnonzero(d == d_max[seg])
+    _, k = np.unique(seg[at_max], return_index=True)
+    split = d_max > tolerance
+    far = idx[at_max[k]][split]
+    keep[far] = True
+    starts = np.concatenate([starts[split], far])
+    ends = np.concatenate([far, ends[split]])
+  return np.flatnonzero(keep)
+
+
+def lttb(xy, n_out: int) -> np.ndarray:
+
+  # Largest Triangle Three Buckets decimation of a track
+  #
+  # INPUTS:
+  #   xy          Points (m), shape (n, 2), in time order
+  #   n_out       Number of points to keep (>= 3)
+  #
+  # OUTPUTS
+  #   index       Increasing indices of the kept points
+
+  xy = np.asarray(xy, dtype=float)
+  n = len(xy)
+  if n_out >= n or n_out < 3:
+    return np.arange(n)
+  edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+  index = np.zeros(n_out, dtype=int)
+  index[-1] = n - 1
+  for i in range(n_out - 2):
+    lo, hi = edges[i], edges[i + 1]
+    nxt = xy[edges[i + 1]:edges[i + 2]] if i + 2 < len(edges) else xy[n - 1:n]
+    c = nxt.mean(axis=0)
+    p = xy[index[i]]
+    b = xy[lo:hi]
+    area = np.abs((p[0] - c[0])*(b[:, 1] - p[1]) - (p[0] - b[:, 0])*(c[1] - p[1]))
+    index[i + 1] = lo + np.argmax(area)
+  return index
+
+
+def pixel_size(zoom: int, lat: float) -> float:
+  # Web Mercator ground size of a pixel (m) at a zoom level and latitude (deg)
+  return MERCATOR_RES0*np.cos(lat*DTOR)/2**zoom
+
+
+def lod_levels(lat, lon, min_zoom: int = 10, full_zoom: int = 20,
+               pixel_fraction: float = 0.5, full_tolerance: float = 0.05) -> list:
+
+  # Multi-resolution levels of a track
+  #
+  # INPUTS:
+  #   lat, lon        Track (deg)
+  #   min_zoom        Coarsest zoom level
+  #   full_zoom       Zoom of the finest level
+  #   pixel_fraction  Tolerance as a fraction of the pixel size
+  #   full_tolerance  Tolerance (m) of the finest level (5 cm: below the
+  #                   noise of a PPK track), 0 keeps all points
+  #
+  # OUTPUTS
+  #   Lod_level list, coarse to full; zoom bands with the same number of
+  #   points are merged
+
+  xy = local_xy(lat, lon)
+  lat0 = float(np.mean(lat))
+  levels = []
+  for zoom in range(min_zoom, full_zoom + 1):
+    tol = pixel_fraction*pixel_size(zoom, lat0) if zoom < full_zoom else full_tolerance
+    index = douglas_peucker(xy, tol) if tol > 0 else np.arange(len(xy))
+    if len(levels) > 0 and len(levels[-1].index) == len(index):
+      levels[-1] = levels[-1]._replace(max_zoom=zoom)
+    else:
+      levels.append(Lod_level(zoom, zoom, tol, index))
+  return levels
+
+
+def lod_report(lat, lon, levels: list) -> list:
+
+  # Points and polyline size (JSON coordinates, 7 decimals) per level,
+  # relative to the full track. The map holds all levels: their total size
+  # is logged against the single full polyline.
+  #
+  # OUTPUTS
+  #   [{'zooms', 'tolerance', 'points', 'point_ratio', 'bytes', 'byte_ratio'}]
+
+  lat = np.asarray(lat, dtype=float)
+  lon = np.asarray(lon, dtype=float)
+
+  def size(index):
+    return len(json.dumps(np.round(np.stack([lat[index], lon[index]], axis=1), 7).tolist()))
+
+  full = size(np.arange(len(lat)))
+  report = []
+  for lv in levels:
+    b = size(lv.index)
+    report.append({'zooms': (lv.min_zoom, lv.max_zoom), 'tolerance': lv.tolerance,
+                   'points': len(lv.index), 'point_ratio': len(lv.index)/len(lat),
+                   'bytes': b, 'byte_ratio': b/full})
+    Info(f'zoom {lv.min_zoom}-{lv.max_zoom}: {len(lv.index)} of {len(lat)} points '
+         f'(tolerance {lv.tolerance:.2f} m), {b/1e3:.0f} of {full/1e3:.0f} kB')
+  total = sum(r['bytes'] for r in report)
+  Info(f'{len(levels)} levels: {total/1e3:.0f} kB of polylines instead of {full/1e3:.0f} kB ({total/full:.1%})')
+  return report
+
+
+def add_lod_polyline(fmap, lat, lon, levels: list = None, **polyline_args) -> list:
+
+  # Draw a track on a folium map, one layer per level shown only in its
+  # zoom band
+  #
+  # INPUTS:
+  #   fmap            folium.Map
+  #   lat, lon        Track (deg)
+  #   levels          lod_levels() output (computed if None)
+  #   polyline_args   folium.PolyLine arguments (color, weight, ...)
+  #
+  # OUTPUTS
+  #   lod_report() of the levels
+
+  import folium
+  from branca.element import MacroElement, Template
+
+  lat = np.asarray(lat, dtype=float)
+  lon = np.asarray(lon, dtype=float)
+  levels = levels if levels is not None else lod_levels(lat, lon)
+  groups = []
+  for lv in levels:
+    group = folium.FeatureGroup(name=f'track z{lv.min_zoom}-{lv.max_zoom}', control=False)
+    folium.PolyLine(np.stack([lat[lv.index], lon[lv.index]], axis=1).tolist(), **polyline_args).add_to(group)
+    group.add_to(fmap)
+    groups.append((group, lv))
+
+  # Show the layer of the current zoom band only
+  bands = ', '.join(f'[{g.get_name()}, {lv.min_zoom}, {lv.max_zoom if lv is not levels[-1] else 99}]'
+                    for g, lv in groups)
+  switch = MacroElement()
+  switch._template = Template(
+    '{% macro script(this, kwargs) %}'
+    f'(function() {{ var map = {fmap.get_name()}; var bands = [{bands}];'
+    ' function show() { var z = map.getZoom();'
+    '  bands.forEach(function(b) { if (z >= b[1] && z <= b[2]) { map.addLayer(b[0]); } else { map.removeLayer(b[0]); } }); }'
+    ' map.on("zoomend", show); show(); })();'
+    '{% endmacro %}')
+  fmap.add_child(switch)
+  return lod_report(lat, lon, levels)
+
+
+def test():
+  import time
+
+  # 1 h flight at 50 Hz: survey lines with turns, 3 m cross-track wander,
+  # 2 cm noise
+  rng = np.random.default_rng(4)
+  n = 180000
+  t = np.arange(n)/50.0
+  line = (t//300).astype(int)
+  along = np.where(line % 2 == 0, 1.0, -1.0)*(t % 300)*8.0
+  north = np.where(line % 2 == 0, 0.0, 2400.0) + along
+  east = line*60.0 + 30.0*np.clip((t % 300) - 290, 0, 10)/10 + 3.0*np.sin(t/7.0)
+  lat0, lon0 = 60.39, 5.32
+  lat = lat0 + (north + rng.normal(0, 0.02, n))/6.36e6/DTOR
+  lon = lon0 + (east + rng.normal(0, 0.02, n))/(6.39e6*np.cos(lat0*DTOR))/DTOR
+
+  xy = local_xy(lat, lon)
+  for tol in (5.0, 0.5):
+    now = time.perf_counter()
+    index = douglas_peucker(xy, tol)
+    dt = time.perf_counter() - now
+
+    # Every removed point lies within tolerance of the simplified track
+    seg = np.searchsorted(index, np.arange(n), side='right') - 1
+    seg = np.clip(seg, 0, len(index) - 2)
+    A, B = xy[index[seg]], xy[index[seg + 1]]
+    AB = B - A
+    u = np.clip(np.sum((xy - A)*AB, axis=1)/np.maximum(np.sum(AB*AB, axis=1), 1e-12), 0, 1)
+    err = np.linalg.norm(xy - A - u[:, None]*AB, axis=1)
+    assert err.max() <= tol + 1e-9 and index[0] == 0 and index[-1] == n - 1
+    print(f'Douglas-Peucker {tol} m: {len(index)} of {n} points in {dt:.2f} s, max error {err.max():.2f} m')
+
+  index = lttb(xy, 2000)
+  assert len(index) == 2000 and np.all(np.diff(index) > 0)
+
+  # All points in the finest level: the levels are larger than the track
+  report = lod_report(lat, lon, lod_levels(lat, lon, min_zoom=12, full_zoom=20, full_tolerance=0.0))
+  assert report[-1]['points'] == n and report[0]['points'] < report[-1]['points']/100
+  assert all(r1['points'] > r0['points'] for r0, r1 in zip(report, report[1:]))
+
+  # Defaults (as add_lod_polyline): finest level at the noise level (5 cm),
+  # all levels about 20% of the single full polyline
+  report = lod_report(lat, lon, lod_levels(lat, lon))
+  full = report[-1]['bytes']/report[-1]['byte_ratio']
+  assert sum(r['bytes'] for r in report) < 0.25*full and report[-1]['tolerance'] == 0.05
+
+
+if __name__ == '__main__':
+  test()
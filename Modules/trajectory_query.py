@@ -0,0 +1,205 @@
+###############################################################################
+# File:  trajectory_query.py
+#
+# Description:
+# Evaluation of the fused trajectory (out_profile_data of run_LC_EKF) at an
+# arbitrary array of times, e.g. the scanline times of a pushbroom sensor.
+# One np.searchsorted locates all query times; position and velocity are
+# interpolated linearly and attitude with quaternion SLERP, so headings that
+# wrap through 0/360 deg are handled. georeference() adds the lever arm and
+# boresight of a sensor mounted on the IMU body frame.
+#
+# Quaternions are [w, x, y, z], body to NED, with the same roll/pitch/yaw
+# (ZYX) convention as ins_nav.Euler_to_CTM.
+#                                                                             #
+###############################################################################
+
+# %%
+import numpy as np
+from collections import namedtuple
+from Modules.ins_nav import a, e, DTOR, RTOD
+
+
+# time (n,), lla (n, 3) rad/rad/m, vel NED (n, 3), q (n, 4), rpy (n, 3) deg
+Traj_sample = namedtuple('Traj_sample', ['time', 'lla', 'vel', 'q', 'rpy'])
+
+
+def euler_to_quat(rpy):
+
+  # Roll, pitch, yaw (rad), shape (n, 3) -> quaternions (n, 4)
+
+  rpy = np.asarray(rpy, dtype=float)
+  h = 0.5*rpy
+  cr, sr = np.cos(h[:, 0]), np.sin(h[:, 0])
+  cp, sp = np.cos(h[:, 1]), np.sin(h[:, 1])
+  cy, sy = np.cos(h[:, 2]), np.sin(h[:, 2])
+  return np.stack([cr*cp*cy + sr*sp*sy,
+                   sr*cp*cy - cr*sp*sy,
+                   cr*sp*cy + sr*cp*sy,
+                   cr*cp*sy - sr*sp*cy], axis=1)
+
+
+def quat_to_euler(q):
+
+  # Quaternions (n, 4) -> roll, pitch, yaw (rad), shape (n, 3)
+
+  w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+  roll = np.arctan2(2.0*(w*x + y*z), 1.0 - 2.0*(x*x + y*y))
+  pitch = np.arcsin(np.clip(2.0*(w*y - z*x), -1.0, 1.0))
+  yaw = np.arctan2(2.0*(w*z + x*y), 1.0 - 2.0*(y*y + z*z))
+  return np.stack([roll, pitch, yaw], axis=1)
+
+
+def quat_mult(p, q):
+
+  # Hamilton product of quaternion arrays (n, 4) or (4,)
+
+  p = np.atleast_2d(p)
+  q = np.atleast_2d(q)
+  return np.stack([p[:, 0]*q[:, 0] - p[:, 1]*q[:, 1] - p[:, 2]*q[:, 2] - p[:, 3]*q[:, 3],
+                   p[:, 0]*q[:, 1] + p[:, 1]*q[:, 0] + p[:, 2]*q[:, 3] - p[:, 3]*q[:, 2],
+                   p[:, 0]*q[:, 2] - p[:, 1]*q[:, 3] + p[:, 2]*q[:, 0] + p[:, 3]*q[:, 1],
+                   p[:, 0]*q[:, 3] + p[:, 1]*q[:, 2] - p[:, 2]*q[:, 1] + p[:, 3]*q[:, 0]], axis=1)
+
+
+def quat_rotate(q, v):
+
+  # Rotate vectors v (n, 3) or (3,) from body to NED with quaternions (n, 4)
+
+  u = q[:, 1:4]
+  v = np.broadcast_to(np.asarray(v, dtype=float), u.shape)
+  t = 2.0*np.cross(u, v)
+  return v + q[:, 0:1]*t + np.cross(u, t)
+
+
+def slerp(q0, q1, u):
+
+  # Spherical linear interpolation between quaternion arrays (n, 4), u (n,)
+
+  dot = np.sum(q0*q1, axis=1)
+  q1 = np.where(dot[:, None] < 0.0, -q1, q1)
+  dot = np.abs(dot)
+  theta = np.arccos(np.clip(dot, -1.0, 1.0))
+  s = np.sin(theta)
+  small = s < 1e-9
+  s = np.where(small, 1.0, s)
+  w0 = np.where(small, 1.0 - u, np.sin((1.0 - u)*theta)/s)
+  w1 = np.where(small, u, np.sin(u*theta)/s)
+  q = w0[:, None]*q0 + w1[:, None]*q1
+  return q/np.linalg.norm(q, axis=1)[:, None]
+
+
+class Trajectory:
+  def __init__(self, out_profile_data):
+    out = np.asarray(out_profile_data, dtype=float)
+    self.time = out[:, 0]
+    self.lla = np.stack([out[:, 7]*DTOR, out[:, 8]*DTOR, out[:, 9]], axis=1)
+    self.vel = out[:, 4:7]
+
+    # Quaternions with the sign of the previous one, so consecutive samples
+    # are on the same hemisphere
+    q = euler_to_quat(out[:, 1:4]*DTOR)
+    flip = np.sum(q[1:]*q[:-1], axis=1) < 0.0
+    sign = np.ones(len(q))
+    sign[1:] = np.where(np.cumsum(flip) % 2 == 1, -1.0, 1.0)
+    self.q = q*sign[:, None]
+
+  def __len__(self):
+    return len(self.time)
+
+  def query(self, t, extrapolate: bool = False) -> Traj_sample:
+    """
+      Position, velocity and attitude at times t. Outside the trajectory the
+      end values are held, or position/velocity extrapolated linearly from
+      the end segments if `extrapolate`.
+    """
+    t = np.asarray(t, dtype=float)
+    i = np.clip(np.searchsorted(self.time, t, side='right') - 1, 0, len(self.time) - 2)
+    t0 = self.time[i]
+    dt = self.time[i + 1] - t0
+    u = np.divide(t - t0, dt, out=np.zeros(len(t)), where=dt > 0)
+    u_att = np.clip(u, 0.0, 1.0)
+    if not extrapolate:
+      u = u_att
+
+    w = u[:, None]
+    lla = self.lla[i] + w*(self.lla[i + 1] - self.lla[i])
+    vel = self.vel[i] + w*(self.vel[i + 1] - self.vel[i])
+    q = slerp(self.q[i], self.q[i + 1], u_att)
+    rpy = quat_to_euler(q)*RTOD
+    rpy[:, 2] = (rpy[:, 2] + 360) % 360
+    return Traj_sample(t, lla, vel, q, rpy)
+
+  def georeference(self, t, lever_arm = (0.0, 0.0, 0.0),
+                   boresight = (0.0, 0.0, 0.0),
+                   extrapolate: bool = False) -> Traj_sample:
+    """
+      Position and attitude of a sensor at times t.
+        lever_arm   Sensor origin in the IMU body frame (m)
+        boresight   Roll, pitch, yaw of the sensor frame relative to the
+                    body frame (rad)
+    """
+    s = self.query(t, extrapolate)
+    lla = s.lla.copy()
+
+    # Lever arm resolved in NED, then as lat/lon/alt offsets
+    d_ned = quat_rotate(s.q, lever_arm)
+    sin_lat = np.sin(lla[:, 0])
+    RN = a*(1.0-e**2)/(1.0-e**2.0*sin_lat**2.0)**1.5
+    RE = a/np.sqrt(1.0-e**2.0*sin_lat**2.0)
+    lla[:, 1] += d_ned[:, 1]/((RE + lla[:, 2])*np.cos(lla[:, 0]))
+    lla[:, 0] += d_ned[:, 0]/(RN + lla[:, 2])
+    lla[:, 2] -= d_ned[:, 2]
+
+    # Sensor attitude: C_s_n = C_b_n C_s_b
+    q = quat_mult(s.q, euler_to_quat(np.atleast_2d(boresight)))
+    rpy = quat_to_euler(q)*RTOD
+    rpy[:, 2] = (rpy[:, 2] + 360) % 360
+    return Traj_sample(s.time, lla, s.vel, q, rpy)
+
+
+def test():
+  import time
+  from Modules.ins_nav import Euler_to_CTM
+
+  rng = np.random.default_rng(2)
+  eul = rng.uniform(-1.0, 1.0, (50, 3))*[3.0, 1.4, 3.0]
+  q = euler_to_quat(eul)
+  for k in range(len(eul)):
+    C = Euler_to_CTM(eul[k])
+    v = rng.normal(size=3)
+    assert np.allclose(quat_rotate(q[k:k+1], v)[0], C@v)
+  assert np.allclose(np.abs(np.sum(euler_to_quat(quat_to_euler(q))*q, axis=1)), 1.0)
+
+  # 200 Hz trajectory, heading turning through north (355 -> 5 deg)
+  n = 200000
+  out = np.zeros((n, 19))
+  out[:, 0] = 467000 + np.arange(n)/200.0
+  out[:, 1] = 2.0
+  out[:, 3] = (355.0 + 10.0*np.arange(n)/n) % 360
+  out[:, 4] = 10.0
+  out[:, 7] = 60.0 + 10.0*np.arange(n)/200.0/111000.0
+  out[:, 8] = 5.0
+  out[:, 9] = 500.0
+  traj = Trajectory(out)
+
+  t = np.sort(rng.uniform(out[0, 0], out[-1, 0], 2000000))
+  now = time.perf_counter()
+  s = traj.georeference(t, lever_arm=(0.5, 0.1, -0.2), boresight=(0.0, 0.0, 0.01))
+  dt = time.perf_counter() - now
+
+  yaw = (355.0 + 10.0*(t - out[0, 0])*200.0/n) % 360
+  s0 = traj.query(t)
+  d_yaw = np.abs((s0.rpy[:, 2] - yaw + 180) % 360 - 180)
+  print(f'{len(t)} scanlines georeferenced in {dt:.2f} s, max yaw error {d_yaw.max():.1e} deg')
+  assert d_yaw.max() < 1e-6
+  assert np.allclose(s0.rpy[:, 0], 2.0)
+
+  # Lever arm moves the sensor 0.5 m forward along the heading
+  d_N = (s.lla[:, 0] - s0.lla[:, 0])*6.36e6
+  assert np.all(np.abs(d_N - 0.5*np.cos(yaw*DTOR)) < 0.02)
+  assert np.all(np.abs(s.lla[:, 2] - s0.lla[:, 2] - (0.2*np.cos(2.0*DTOR) - 0.1*np.sin(2.0*DTOR))) < 1e-3)
+
+
+if __name__ == '__main__':
+  test()